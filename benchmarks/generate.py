@@ -0,0 +1,81 @@
+"""Generators for synthetic stress queries, to benchmark translation of very large or deeply nested queries"""
+import random
+
+DATASETS = ("ethereum", "gnosis", "optimism", "bnb", "polygon")
+
+
+def _address(rng, prefix):
+    return prefix + "".join(rng.choice("0123456789abcdef") for _ in range(40))
+
+
+def many_ctes(n, dialect="postgres", seed=0):
+    """A query with `n` CTEs, each selecting from a v1 table and the CTE before it"""
+    rng = random.Random(seed)
+    tables = ("dex.trades", "erc20.tokens", "prices.usd", "nft.trades", "erc20.erc20_evt_transfer")
+    ctes = ["cte_0 AS (SELECT * FROM dex.trades WHERE block_time > '2022-01-01')"]
+    for i in range(1, n):
+        table = rng.choice(tables)
+        ctes.append(
+            f"cte_{i} AS (SELECT t.*, c.block_time AS block_time_{i} FROM {table} t "
+            f"JOIN cte_{i - 1} c ON t.block_time = c.block_time WHERE t.amount / 2 > {i})"
+        )
+    return f"WITH {', '.join(ctes)} SELECT * FROM cte_{n - 1}"
+
+
+def nested_subqueries(depth, dialect="postgres", seed=0):
+    """A query nesting `depth` subqueries, each filtering on a date and a parameter"""
+    query = "SELECT * FROM dex.trades WHERE token_a_symbol = 'WETH'"
+    for i in range(depth):
+        query = f"SELECT * FROM ({query}) AS q{i} WHERE q{i}.block_time > '2022-01-01' AND q{i}.x = {{{{param_{i}}}}}"
+    return query
+
+
+def in_list(n, dialect="postgres", seed=0):
+    """A query filtering on an IN list of `n` addresses"""
+    rng = random.Random(seed)
+    prefix = "\\x" if dialect == "postgres" else "0x"
+    addresses = ", ".join(f"'{_address(rng, prefix)}'" for _ in range(n))
+    return f"SELECT * FROM erc20.tokens WHERE contract_address IN ({addresses}) AND \"from\" = '{prefix}00'"
+
+
+def pipe_chain(n, dialect="postgres", seed=0):
+    """A query concatenating `n` hex strings with the || operator"""
+    rng = random.Random(seed)
+    return "SELECT " + " || ".join(f"'{_address(rng, '0x')}'" for _ in range(n))
+
+
+def union_all(n, dialect="postgres", seed=0):
+    """A UNION ALL of `n` selects from v1 tables"""
+    rng = random.Random(seed)
+    tables = ("dex.trades", "prices.usd", "nft.trades", "erc20.tokens")
+    selects = [
+        f"SELECT {i} AS i, usd_amount / 2 AS half FROM {rng.choice(tables)} t{i} WHERE t{i}.symbol = 'WETH'"
+        for i in range(n)
+    ]
+    return " UNION ALL ".join(selects)
+
+
+def or_chain(n, dialect="postgres", seed=0):
+    """A query filtering on `n` ORed conditions"""
+    rng = random.Random(seed)
+    conditions = " OR ".join(f"\"from\" = '{_address(rng, '0x')}'" for _ in range(n))
+    return f"SELECT * FROM ethereum.transactions WHERE {conditions}"
+
+
+def dex_or_chain(n, dialect="postgres", seed=0):
+    """A query filtering dex.trades, whose columns are renamed in DuneSQL, on `n` ORed conditions on a renamed column"""
+    rng = random.Random(seed)
+    prefix = "\\x" if dialect == "postgres" else "0x"
+    conditions = " OR ".join(f"token_a_address = '{_address(rng, prefix)}'" for _ in range(n))
+    return f"SELECT * FROM dex.trades WHERE {conditions}"
+
+
+# Name, generator and size at scale 1
+GENERATORS = (
+    ("many_ctes", many_ctes, 300),
+    ("nested_subqueries", nested_subqueries, 30),
+    ("in_list", in_list, 10_000),
+    ("pipe_chain", pipe_chain, 300),
+    ("union_all", union_all, 200),
+    ("or_chain", or_chain, 2_000),
+)
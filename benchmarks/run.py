@@ -0,0 +1,194 @@
+"""Benchmark translation and optimization, on the test case corpus and on synthetic stress queries
+
+Run from the repository root with
+
+    python -m benchmarks.run --output results.json
+
+and compare two runs with
+
+    python -m benchmarks.run --compare before.json after.json
+"""
+import argparse
+import json
+import logging
+import platform
+import statistics
+import sys
+import time
+import tracemalloc
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from pathlib import Path
+
+import sqlglot
+
+from benchmarks.generate import DATASETS, GENERATORS
+from dune.harmonizer import TranslationStats, translate_postgres, translate_spark
+from dune.harmonizer.cache import harmonizer_version
+from dune.harmonizer.dunesql.dunesql import DuneSQL
+from dune.harmonizer.dunesql.optimize import optimize
+from tests.cases import postgres_test_cases, spark_test_cases
+from tests.dunesql.test_optimize import testcases as optimize_test_cases
+
+
+@dataclass
+class BenchmarkCase:
+    name: str
+    dialect: str
+    query: str
+    dataset: str = None
+    schema: dict = field(default_factory=dict)
+    scoped: bool = False
+
+
+def corpus_cases():
+    """The queries in tests/test_cases"""
+    root = Path(__file__).parent.parent / "tests"
+    for tc in postgres_test_cases:
+        query = (root / tc.in_filename).read_text()
+        yield BenchmarkCase(f"corpus/postgres/{Path(tc.in_filename).stem}/{tc.dataset}", "postgres", query, tc.dataset)
+    for tc in spark_test_cases:
+        query = (root / tc.in_filename).read_text()
+        yield BenchmarkCase(f"corpus/spark/{Path(tc.in_filename).stem}", "spark", query)
+
+
+def synthetic_cases(scale):
+    """Synthetic stress queries, translated from Postgres on every dataset and from Spark"""
+    for name, generate, size in GENERATORS:
+        n = max(1, int(size * scale))
+        for dataset in DATASETS:
+            yield BenchmarkCase(f"synthetic/{name}/postgres/{dataset}", "postgres", generate(n, "postgres"), dataset)
+        yield BenchmarkCase(f"synthetic/{name}/spark", "spark", generate(n, "spark"))
+
+
+def optimize_cases(scale):
+    """The optimizer test cases, and a filter on a wide table, optimized both fully and scoped"""
+    columns = {f"col_{i}": "varbinary" if i % 2 else "varchar" for i in range(max(2, int(500 * scale)))}
+    query = "SELECT * FROM ethereum.transactions WHERE col_1 = '0xdeadbeef' AND col_2 = 0xdeadbeef"
+    for scoped, prefix in ((False, "optimize"), (True, "optimize_scoped")):
+        for i, tc in enumerate(optimize_test_cases):
+            yield BenchmarkCase(f"{prefix}/testcase_{i}", "dunesql", tc["in"], schema=tc["schema"], scoped=scoped)
+        schema = {"ethereum": {"transactions": columns}}
+        yield BenchmarkCase(f"{prefix}/wide_table", "dunesql", query, schema=schema, scoped=scoped)
+
+
+def translate(case):
+    if case.dialect == "spark":
+        return translate_spark(case.query)
+    return translate_postgres(case.query, dataset=case.dataset)
+
+
+def translate_stages(case):
+    """Translate with a `TranslationStats` observer, to get the time spent per stage and per rule"""
+    stats = TranslationStats()
+    if case.dialect == "spark":
+        translate_spark(case.query, observer=stats)
+    else:
+        translate_postgres(case.query, dataset=case.dataset, observer=stats)
+    return stats
+
+
+def run_optimize(case):
+    return optimize(sqlglot.parse_one(case.query, read=DuneSQL), schema=case.schema, scoped=case.scoped).sql(DuneSQL)
+
+
+def _summary(samples):
+    return {"min": min(samples), "median": statistics.median(samples), "max": max(samples)}
+
+
+def _peak_memory(f, case):
+    tracemalloc.start()
+    try:
+        f(case)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def benchmark(case, repeat):
+    """Time a case `repeat` times, and measure its peak memory use in a separate run"""
+    f = run_optimize if case.dialect == "dunesql" else translate
+    result = {"dialect": case.dialect, "dataset": case.dataset, "query_length": len(case.query)}
+    try:
+        samples, stages, rules = [], {}, {}
+        for _ in range(repeat):
+            start = time.perf_counter()
+            f(case)
+            samples.append(time.perf_counter() - start)
+            if f is translate:
+                stats = translate_stages(case)
+                for stage, seconds in stats.stages.items():
+                    stages.setdefault(stage, []).append(seconds)
+                for rule, rule_stats in stats.rules.items():
+                    rules.setdefault(rule, []).append(rule_stats.seconds)
+        result["seconds"] = _summary(samples)
+        result["stages"] = {stage: _summary(s) for stage, s in stages.items()}
+        result["rules"] = {rule: _summary(s) for rule, s in rules.items()}
+        result["peak_memory_bytes"] = _peak_memory(f, case)
+    except Exception as e:  # a benchmark that fails (e.g. with a RecursionError) is reported, not fatal
+        result["error"] = f"{type(e).__name__}: {getattr(e, 'detail', e)}"[:500]
+    return result
+
+
+def run(repeat, scale, name_filter=None):
+    cases = [*corpus_cases(), *synthetic_cases(scale), *optimize_cases(scale)]
+    results = {}
+    for case in cases:
+        if name_filter and name_filter not in case.name:
+            continue
+        results[case.name] = benchmark(case, repeat)
+        seconds = results[case.name].get("seconds", {}).get("median")
+        status = f"{seconds * 1000:10.2f} ms" if seconds is not None else f"  {results[case.name]['error']}"
+        print(f"{case.name:<55} {status}", file=sys.stderr)
+    return {
+        "meta": {
+            "harmonizer": harmonizer_version(),
+            "sqlglot": sqlglot.__version__,
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "repeat": repeat,
+            "scale": scale,
+        },
+        "results": results,
+    }
+
+
+def compare(before, after):
+    """Print the change in median time and peak memory per case between two runs"""
+    print(f"{'case':<55} {'before ms':>10} {'after ms':>10} {'ratio':>7} {'memory ratio':>13}")
+    for name, new in after["results"].items():
+        old = before["results"].get(name)
+        if old is None or "seconds" not in old or "seconds" not in new:
+            status = (old or {}).get("error") or new.get("error") or "missing in before"
+            print(f"{name:<55} {status}")
+            continue
+        old_ms, new_ms = old["seconds"]["median"] * 1000, new["seconds"]["median"] * 1000
+        memory_ratio = new["peak_memory_bytes"] / max(old["peak_memory_bytes"], 1)
+        print(f"{name:<55} {old_ms:10.2f} {new_ms:10.2f} {new_ms / old_ms:7.2f} {memory_ratio:13.2f}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=5, help="number of timed runs per case")
+    parser.add_argument("--scale", type=float, default=1.0, help="scale the size of the synthetic queries")
+    parser.add_argument("--filter", help="only run cases with this in their name")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    parser.add_argument("--compare", nargs=2, metavar=("BEFORE", "AFTER"), help="compare two JSON results")
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        before, after = (json.loads(Path(p).read_text()) for p in args.compare)
+        compare(before, after)
+        return
+
+    logging.disable(logging.WARNING)  # SQLGlot logs a warning for every array index it translates
+    results = run(args.repeat, args.scale, args.filter)
+    if args.output:
+        Path(args.output).write_text(json.dumps(results, indent=2))
+    else:
+        print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
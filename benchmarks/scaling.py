@@ -0,0 +1,83 @@
+"""Benchmark how translation time grows with the length of long chains of operators
+
+Translates the `or_chain`, `dex_or_chain` and `pipe_chain` stress queries at doubling sizes, and reports the time per
+item, which stays flat when translation takes linear time. The pretty printed output of a `||` chain nests a
+bytearray_concat call per item, each indented one more level, so its length grows quadratically: the time per
+character of output is reported too. Run from the repository root with
+
+    python -m benchmarks.scaling --output scaling.json
+"""
+import argparse
+import json
+import logging
+import platform
+import statistics
+import sys
+import time
+from pathlib import Path
+
+import sqlglot
+
+from benchmarks.generate import dex_or_chain, or_chain, pipe_chain
+from dune.harmonizer import translate_postgres, translate_spark
+
+SIZES = {
+    "or_chain": (1_000, 2_000, 4_000, 8_000, 16_000),
+    "dex_or_chain": (1_000, 2_000, 4_000, 8_000, 16_000),
+    "pipe_chain": (250, 500, 1_000, 2_000, 4_000),
+}
+
+
+def _translate(query, dialect):
+    if dialect == "spark":
+        return translate_spark(query)
+    return translate_postgres(query, dataset="ethereum")
+
+
+def run(repeat, scale):
+    results = {}
+    for name, generate in (("or_chain", or_chain), ("dex_or_chain", dex_or_chain), ("pipe_chain", pipe_chain)):
+        for size in SIZES[name]:
+            n = max(1, int(size * scale))
+            for dialect in ("postgres", "spark"):
+                query = generate(n, dialect)
+                samples = []
+                for _ in range(repeat):
+                    start = time.perf_counter()
+                    output = _translate(query, dialect)
+                    samples.append(time.perf_counter() - start)
+                seconds = statistics.median(samples)
+                results[f"{name}/{dialect}/{n}"] = {
+                    "n": n,
+                    "seconds": seconds,
+                    "seconds_per_item": seconds / n,
+                    "output_length": len(output),
+                    "seconds_per_output_char": seconds / len(output),
+                }
+    return {
+        "meta": {"sqlglot": sqlglot.__version__, "python": platform.python_version(), "repeat": repeat},
+        "results": results,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=3, help="number of times to translate each query")
+    parser.add_argument("--scale", type=float, default=1.0, help="multiply the sizes of the queries by this")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    args = parser.parse_args(argv)
+
+    logging.disable(logging.WARNING)
+    results = run(args.repeat, args.scale)
+    for case, result in results["results"].items():
+        print(
+            f"{case:<30} {result['seconds'] * 1000:10.2f} ms {result['seconds_per_item'] * 1e6:10.2f} us/item"
+            f" {result['seconds_per_output_char'] * 1e9:10.2f} ns/char",
+            file=sys.stderr,
+        )
+    if args.output:
+        Path(args.output).write_text(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+"""Benchmark the cold start of a translation worker: importing the package, and the first translations
+
+Each run is a fresh Python process. Run from the repository root with
+
+    python -m benchmarks.startup --output startup.json
+"""
+import argparse
+import json
+import platform
+import statistics
+import subprocess
+import sys
+from pathlib import Path
+
+import sqlglot
+
+# Runs in a fresh process, and prints the time in seconds of each step as JSON
+_script = """
+import json, logging, time
+logging.disable(logging.WARNING)
+timings = {}
+start = time.perf_counter()
+import dune.harmonizer as harmonizer
+timings["import"] = time.perf_counter() - start
+if WARMUP:
+    start = time.perf_counter()
+    harmonizer.warmup()
+    timings["warmup"] = time.perf_counter() - start
+for name, translate in [
+    ("first_postgres", lambda: harmonizer.translate_postgres("SELECT * FROM erc20.tokens WHERE x = 1", "polygon")),
+    ("first_spark", lambda: harmonizer.translate_spark("SELECT '0xdeadbeef' FROM tokens.erc20 WHERE x = 1")),
+    ("second_postgres", lambda: harmonizer.translate_postgres("SELECT * FROM erc20.tokens WHERE x = 2", "polygon")),
+    ("second_spark", lambda: harmonizer.translate_spark("SELECT '0xdeadbeef' FROM tokens.erc20 WHERE x = 2")),
+]:
+    start = time.perf_counter()
+    translate()
+    timings[name] = time.perf_counter() - start
+print(json.dumps(timings))
+"""
+
+
+def run_once(warmup):
+    output = subprocess.run(
+        [sys.executable, "-c", _script.replace("WARMUP", str(warmup))],
+        capture_output=True,
+        check=True,
+        text=True,
+        cwd=Path(__file__).parent.parent,
+    ).stdout
+    return json.loads(output)
+
+
+def run(repeat):
+    results = {}
+    for warmup in (False, True):
+        samples = [run_once(warmup) for _ in range(repeat)]
+        results["warmup" if warmup else "cold"] = {
+            step: statistics.median(s[step] for s in samples) for step in samples[0]
+        }
+    return {
+        "meta": {"sqlglot": sqlglot.__version__, "python": platform.python_version(), "repeat": repeat},
+        "results": results,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=10, help="number of processes to start per case")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    args = parser.parse_args(argv)
+
+    results = run(args.repeat)
+    for case, timings in results["results"].items():
+        for step, seconds in timings.items():
+            print(f"{case + '/' + step:<30} {seconds * 1000:10.2f} ms", file=sys.stderr)
+    if args.output:
+        Path(args.output).write_text(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,19 +1,246 @@
-from dune.harmonizer.translate import _clean_dataset, _translate_query
+from dune.harmonizer.batch import TranslationRequest, _translate_many
+from dune.harmonizer.cache import TranslationCache  # noqa: F401
+from dune.harmonizer.instrumentation import TranslationObserver, TranslationStats, observe  # noqa: F401
+from dune.harmonizer.result import TranslationResult  # noqa: F401
+from dune.harmonizer.script import StatementTranslation, _translate_script  # noqa: F401
+from dune.harmonizer.shapes import ShapeCache  # noqa: F401
+from dune.harmonizer.table_replacements import TableMappingIndex  # noqa: F401
+from dune.harmonizer.translate import _clean_dataset, _translate_query, _translate_result, _warmup
 
 
-def translate_spark(query):
-    """Translate a Dune query from Spark SQL to DuneSQL"""
-    return _translate_query(query, sqlglot_dialect="spark")
+def translate_spark(query, cache=None, observer=None, shape_cache=None, schema=None):
+    """Translate a Dune query from Spark SQL to DuneSQL
+
+    Pass a `TranslationCache` as `cache` to reuse results of earlier translations.
+    Pass a `ShapeCache` as `shape_cache` to reuse translations of queries that only differ in literals.
+    Pass a `TranslationObserver` as `observer` to get the timings of each stage and rule of the translation.
+    Pass a schema as `schema` to optimize the translated query with it, see `dune.harmonizer.dunesql.optimize`.
+    A `ShapeCache` isn't used for queries translated with a schema, and a `TranslationCache` only if it's a dictionary.
+    """
+    return _translate_query(
+        query, sqlglot_dialect="spark", cache=cache, observer=observer, shape_cache=shape_cache, schema=schema
+    )
 
 
-def translate_postgres(query, dataset="ethereum", syntax_only=False, table_mapping=None):
+def translate_postgres(
+    query,
+    dataset="ethereum",
+    syntax_only=False,
+    table_mapping=None,
+    cache=None,
+    observer=None,
+    table_mapping_index=None,
+    shape_cache=None,
+    schema=None,
+):
     """Translate a Dune query from PostgreSQL to DuneSQL
 
     By default, this will replace any known v1 to v2 differences in datasets.
     To only translate the syntax, call this with `syntax_only=True`.
+    Pass a `TableMappingIndex` as `table_mapping_index` to map v1 tables with it instead of the built-in mapping,
+    and a dictionary as `table_mapping` to map more tables (or map them differently) on top of either.
+    Pass a `TranslationCache` as `cache` to reuse results of earlier translations.
+    Pass a `ShapeCache` as `shape_cache` to reuse translations of queries that only differ in literals.
+    Pass a `TranslationObserver` as `observer` to get the timings of each stage and rule of the translation.
+    Pass a schema as `schema` to optimize the translated query with it, see `dune.harmonizer.dunesql.optimize`.
+    A `ShapeCache` isn't used for queries translated with a schema, and a `TranslationCache` only if it's a dictionary.
     """
     dataset = _clean_dataset(dataset)
     translated = _translate_query(
-        query, sqlglot_dialect="postgres", dataset=dataset, syntax_only=syntax_only, table_mapping=table_mapping
+        query,
+        sqlglot_dialect="postgres",
+        dataset=dataset,
+        syntax_only=syntax_only,
+        table_mapping=table_mapping,
+        cache=cache,
+        observer=observer,
+        table_mapping_index=table_mapping_index,
+        shape_cache=shape_cache,
+        schema=schema,
     )
     return translated
+
+
+def translate_spark_result(query, observer=None, schema=None):
+    """Translate a Dune query from Spark SQL to DuneSQL, as a `TranslationResult` with the tree of the query
+
+    The SQL of the result is only generated when it's asked for, see `translate_spark`.
+    """
+    return _translate_result(query, sqlglot_dialect="spark", observer=observer, schema=schema)
+
+
+def translate_postgres_result(
+    query,
+    dataset="ethereum",
+    syntax_only=False,
+    table_mapping=None,
+    observer=None,
+    table_mapping_index=None,
+    schema=None,
+):
+    """Translate a Dune query from PostgreSQL to DuneSQL, as a `TranslationResult` with the tree of the query
+
+    The SQL of the result is only generated when it's asked for, see `translate_postgres`.
+    """
+    return _translate_result(
+        query,
+        sqlglot_dialect="postgres",
+        dataset=_clean_dataset(dataset),
+        syntax_only=syntax_only,
+        table_mapping=table_mapping,
+        observer=observer,
+        table_mapping_index=table_mapping_index,
+        schema=schema,
+    )
+
+
+def translate_script_spark(script, cache=None, observer=None, shape_cache=None, schema=None, sink=None):
+    """Translate a script of Spark SQL statements to DuneSQL, one statement at a time
+
+    The script is a string or a text file, which is read a chunk at a time. Returns an iterator of a
+    `StatementTranslation` per statement, with the translated statement or its error, which translates each statement
+    when it's reached. If a file-like `sink` is given, the translated statements are also written to it, as a script.
+    The other arguments are those of `translate_spark`.
+    """
+    return _translate_script(
+        script,
+        sqlglot_dialect="spark",
+        cache=cache,
+        observer=observer,
+        shape_cache=shape_cache,
+        schema=schema,
+        sink=sink,
+    )
+
+
+def translate_script_postgres(
+    script,
+    dataset="ethereum",
+    syntax_only=False,
+    table_mapping=None,
+    cache=None,
+    observer=None,
+    table_mapping_index=None,
+    shape_cache=None,
+    schema=None,
+    sink=None,
+):
+    """Translate a script of PostgreSQL statements to DuneSQL, one statement at a time
+
+    See `translate_script_spark`, and `translate_postgres` for the other arguments.
+    """
+    return _translate_script(
+        script,
+        sqlglot_dialect="postgres",
+        dataset=_clean_dataset(dataset),
+        syntax_only=syntax_only,
+        table_mapping=table_mapping,
+        cache=cache,
+        observer=observer,
+        table_mapping_index=table_mapping_index,
+        shape_cache=shape_cache,
+        schema=schema,
+        sink=sink,
+    )
+
+
+async def atranslate_spark(query, cache=None, observer=None, timeout=None, translator=None):
+    """Translate a Dune query from Spark SQL to DuneSQL without blocking the event loop, see `translate_spark`
+
+    The translation runs on `translator`, a `dune.harmonizer.aio.AsyncTranslator`, which bounds the number of
+    concurrent translations. By default, that's a shared pool of threads. After `timeout` seconds, this raises
+    `asyncio.TimeoutError`.
+    """
+    from dune.harmonizer.aio import default_translator
+
+    translator = translator or default_translator()
+    return await translator.translate_spark(query, cache=cache, observer=observer, timeout=timeout)
+
+
+async def atranslate_postgres(
+    query,
+    dataset="ethereum",
+    syntax_only=False,
+    table_mapping=None,
+    cache=None,
+    observer=None,
+    table_mapping_index=None,
+    timeout=None,
+    translator=None,
+):
+    """Translate a Dune query from PostgreSQL to DuneSQL without blocking the event loop, see `translate_postgres`
+
+    The translation runs on `translator`, a `dune.harmonizer.aio.AsyncTranslator`, which bounds the number of
+    concurrent translations. By default, that's a shared pool of threads. After `timeout` seconds, this raises
+    `asyncio.TimeoutError`.
+    """
+    from dune.harmonizer.aio import default_translator
+
+    translator = translator or default_translator()
+    return await translator.translate_postgres(
+        query,
+        dataset=dataset,
+        syntax_only=syntax_only,
+        table_mapping=table_mapping,
+        cache=cache,
+        observer=observer,
+        table_mapping_index=table_mapping_index,
+        timeout=timeout,
+    )
+
+
+def translate_many(requests, max_workers=None, chunksize=1, executor=None, cache=None):
+    """Translate many Dune queries, each given as a `TranslationRequest`, over a pool of worker processes
+
+    Returns a list in the same order as the input, where each item is either the translated query
+    or the exception raised while translating it: a `DuneTranslationError` for a query that can't be translated,
+    or any other error, like a `ValueError` for a query that fails to tokenize. A failing query doesn't stop the
+    others from being translated.
+    """
+    return _translate_many(requests, max_workers=max_workers, chunksize=chunksize, executor=executor, cache=cache)
+
+
+def translate_many_spark(queries, max_workers=None, chunksize=1, executor=None, cache=None):
+    """Translate many Dune queries from Spark SQL to DuneSQL, see `translate_many`"""
+    requests = (TranslationRequest(query=q, dialect="spark", dataset=None) for q in queries)
+    return _translate_many(requests, max_workers=max_workers, chunksize=chunksize, executor=executor, cache=cache)
+
+
+def translate_many_postgres(
+    queries,
+    dataset="ethereum",
+    syntax_only=False,
+    table_mapping=None,
+    max_workers=None,
+    chunksize=1,
+    executor=None,
+    cache=None,
+    table_mapping_index=None,
+):
+    """Translate many Dune queries from PostgreSQL to DuneSQL, see `translate_many`
+
+    The dataset, `syntax_only` flag, table mapping and table mapping index apply to every query. Use
+    `translate_many` with `TranslationRequest`s to set these per query.
+    """
+    requests = (
+        TranslationRequest(
+            query=q,
+            dialect="postgres",
+            dataset=dataset,
+            syntax_only=syntax_only,
+            table_mapping=table_mapping,
+            table_mapping_index=table_mapping_index,
+        )
+        for q in queries
+    )
+    return _translate_many(requests, max_workers=max_workers, chunksize=chunksize, executor=executor, cache=cache)
+
+
+def warmup(optimizer=False):
+    """Do the one-time setup of translation, so that the first translation is as fast as the ones after it
+
+    Call this when a worker process starts, before it gets any queries. Modules that only some translations need
+    are imported on first use; this imports them as well. With `optimizer=True`, this also sets up the DuneSQL
+    optimizer in `dune.harmonizer.dunesql.optimize`.
+    """
+    _warmup(optimizer=optimizer)
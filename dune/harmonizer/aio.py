@@ -0,0 +1,168 @@
+import asyncio
+import contextvars
+import functools
+import threading
+import weakref
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from dune.harmonizer.batch import (
+    TranslationRequest,
+    _cacheable,
+    _request_cache_key,
+    _translate_request,
+    _validate_request,
+)
+from dune.harmonizer.constants import SQLGLOT_POSTGRES, SQLGLOT_SPARK
+from dune.harmonizer.errors import DuneTranslationError
+from dune.harmonizer.translate import _translate_query, _warmup
+
+
+class AsyncTranslator:
+    """Runs translations and optimizations for asyncio code on a bounded executor, so they don't block the event loop
+
+    By default, calls run on a pool of `max_workers` threads. Translation holds the GIL, so with `processes=True` they
+    run on a pool of worker processes instead, which are warmed up when they start. An existing executor can be given
+    as `executor`; it's not shut down by `close`. At most `max_concurrency` calls (by default, the number of workers)
+    per event loop are handed to the executor at a time, the others wait for a slot without taking up a worker.
+
+    A call that times out (after `timeout` seconds, or the `timeout` of the call itself) or is cancelled before it got
+    a worker is never run. A call that has already started can't be interrupted: it runs to completion in its worker,
+    and its slot is freed once it's done, but its result is dropped.
+
+    Results are the same as those of the synchronous functions. In a process pool, an observer can't be used, a cache
+    is looked up and filled in the calling process, and `optimize` returns an optimized copy of the expression."""
+
+    def __init__(self, max_workers=None, max_concurrency=None, timeout=None, processes=False, executor=None):
+        self._owns_executor = executor is None
+        if executor is None:
+            if processes:
+                executor = ProcessPoolExecutor(max_workers=max_workers, initializer=_warmup)
+            else:
+                executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="harmonizer")
+        self.executor = executor
+        self._in_process = not isinstance(executor, ProcessPoolExecutor)
+        self.max_concurrency = max_concurrency or max_workers or getattr(executor, "_max_workers", None) or 1
+        self.timeout = timeout
+        self._semaphores = weakref.WeakKeyDictionary()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """Shut down the executor, if this created it, without waiting for the calls that are running"""
+        if self._owns_executor:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+
+    async def translate_spark(self, query, cache=None, observer=None, timeout=None):
+        """Translate a Dune query from Spark SQL to DuneSQL, see `dune.harmonizer.translate_spark`"""
+        request = _validate_request(TranslationRequest(query=query, dialect=SQLGLOT_SPARK, dataset=None))
+        return await self._translate(request, cache, observer, timeout)
+
+    async def translate_postgres(
+        self,
+        query,
+        dataset="ethereum",
+        syntax_only=False,
+        table_mapping=None,
+        cache=None,
+        observer=None,
+        table_mapping_index=None,
+        timeout=None,
+    ):
+        """Translate a Dune query from PostgreSQL to DuneSQL, see `dune.harmonizer.translate_postgres`"""
+        request = _validate_request(
+            TranslationRequest(
+                query=query,
+                dialect=SQLGLOT_POSTGRES,
+                dataset=dataset,
+                syntax_only=syntax_only,
+                table_mapping=table_mapping,
+                table_mapping_index=table_mapping_index,
+            )
+        )
+        return await self._translate(request, cache, observer, timeout)
+
+    async def optimize(self, expr, schema, scoped=False, timeout=None):
+        """Optimize a DuneSQL expression, see `dune.harmonizer.dunesql.optimize.optimize`"""
+        from dune.harmonizer.dunesql.optimize import optimize
+
+        return await self.run(optimize, expr, schema, scoped, timeout=timeout)
+
+    async def run(self, fn, *args, timeout=None):
+        """Call `fn(*args)` on the executor, within the limits of this translator, and return its result"""
+        if self._in_process:
+            # Threads don't inherit the context, which holds the observer set with `observe`
+            fn = functools.partial(contextvars.copy_context().run, fn)
+        return await asyncio.wait_for(self._submit(fn, *args), self.timeout if timeout is None else timeout)
+
+    async def _translate(self, request, cache, observer, timeout):
+        if self._in_process:
+            translate = functools.partial(
+                _translate_query,
+                request.query,
+                sqlglot_dialect=request.dialect,
+                dataset=request.dataset,
+                syntax_only=request.syntax_only,
+                table_mapping=request.table_mapping,
+                cache=cache,
+                observer=observer,
+                table_mapping_index=request.table_mapping_index,
+            )
+            return await self.run(translate, timeout=timeout)
+
+        if observer is not None:
+            raise ValueError("an observer can't be used with a process pool")
+        key = _request_cache_key(request) if cache is not None else None
+        result = cache.get(key) if cache is not None else None
+        if result is None:
+            result = await self.run(_translate_request, request, timeout=timeout)
+            if cache is not None and _cacheable(result):
+                cache.put(key, result)
+        if isinstance(result, DuneTranslationError):
+            raise DuneTranslationError(result.detail)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    async def _submit(self, fn, *args):
+        loop = asyncio.get_running_loop()
+        semaphore = self._semaphore(loop)
+        await semaphore.acquire()
+        try:
+            future = self.executor.submit(fn, *args)
+        except BaseException:
+            semaphore.release()
+            raise
+        # The slot is freed when the call is done, not when its caller stops waiting for it
+        future.add_done_callback(functools.partial(_release, loop, semaphore))
+        return await asyncio.wrap_future(future)
+
+    def _semaphore(self, loop):
+        semaphore = self._semaphores.get(loop)
+        if semaphore is None:
+            semaphore = self._semaphores[loop] = asyncio.Semaphore(self.max_concurrency)
+        return semaphore
+
+
+def _release(loop, semaphore, future):
+    # Runs in the worker, or in the event loop if the call was cancelled before it started
+    try:
+        loop.call_soon_threadsafe(semaphore.release)
+    except RuntimeError:  # the event loop is closed
+        pass
+
+
+_default_translator = None
+_default_translator_lock = threading.Lock()
+
+
+def default_translator():
+    """The translator the `atranslate_` functions use when they're not given one, on a pool of threads"""
+    global _default_translator
+    with _default_translator_lock:
+        if _default_translator is None:
+            _default_translator = AsyncTranslator()
+        return _default_translator
@@ -0,0 +1,151 @@
+import json
+import time
+from dataclasses import dataclass
+from typing import Iterable, Optional
+
+from dune.harmonizer.cache import cache_key
+from dune.harmonizer.constants import SQLGLOT_POSTGRES, SQLGLOT_SPARK
+from dune.harmonizer.errors import DuneTranslationError
+from dune.harmonizer.table_replacements import TableMappingIndex
+from dune.harmonizer.translate import _clean_dataset, _translate_query
+
+
+@dataclass
+class TranslationRequest:
+    """A single query to translate as part of a batch, with its own dataset and table mapping"""
+
+    query: str
+    dialect: str = SQLGLOT_POSTGRES
+    dataset: Optional[str] = "ethereum"
+    syntax_only: bool = False
+    table_mapping: Optional[dict[str, str]] = None
+    table_mapping_index: Optional[TableMappingIndex] = None
+
+
+def _validate_request(request):
+    """Check the arguments of a request up front, so that a bad argument fails before any work is done"""
+    if request.dialect == SQLGLOT_SPARK:
+        if request.syntax_only:
+            raise ValueError("the `syntax_only` flag does not apply for Spark queries")
+        return TranslationRequest(query=request.query, dialect=SQLGLOT_SPARK, dataset=None)
+    if request.dialect == SQLGLOT_POSTGRES:
+        return TranslationRequest(
+            query=request.query,
+            dialect=SQLGLOT_POSTGRES,
+            dataset=_clean_dataset(request.dataset),
+            syntax_only=request.syntax_only,
+            table_mapping=request.table_mapping,
+            table_mapping_index=request.table_mapping_index,
+        )
+    raise ValueError(f"Unknown dialect: {request.dialect}")
+
+
+def _translate_request(request):
+    """Translate a single request, returning the error instead of raising it so one query can't abort the batch
+
+    Besides a `DuneTranslationError`, that's any other exception the translation raises, like a `ValueError` for a
+    query that fails to tokenize, or a `RecursionError` for one that's too deep."""
+    try:
+        return _translate_query(
+            request.query,
+            sqlglot_dialect=request.dialect,
+            dataset=request.dataset,
+            syntax_only=request.syntax_only,
+            table_mapping=request.table_mapping,
+            table_mapping_index=request.table_mapping_index,
+        )
+    except Exception as e:
+        return e
+
+
+def _cacheable(result):
+    """Whether a result of `_translate_request` can be cached: a translated query or a `DuneTranslationError`"""
+    return not isinstance(result, Exception) or isinstance(result, DuneTranslationError)
+
+
+def _request_cache_key(request):
+    return cache_key(
+        request.query,
+        request.dialect,
+        request.dataset,
+        request.syntax_only,
+        request.table_mapping,
+        request.table_mapping_index,
+    )
+
+
+def translate_line(line, default_dialect=SQLGLOT_POSTGRES, default_dataset="ethereum", table_mapping_index=None):
+    """Translate one JSON line, like an input line of the `harmonizer` command, to one output record
+
+    Never raises, errors are reported in the record. The `harmonizer` command and the corpus migration share this."""
+    start = time.perf_counter()
+    try:
+        record = json.loads(line)
+    except Exception as e:
+        return {"id": None, "error": str(e), "error_type": type(e).__name__, "seconds": time.perf_counter() - start}
+    return translate_record(record, default_dialect, default_dataset, table_mapping_index, start)
+
+
+def translate_record(
+    record, default_dialect=SQLGLOT_POSTGRES, default_dataset="ethereum", table_mapping_index=None, start=None
+):
+    """Translate one input record, a dictionary like a parsed input line, to one output record. Never raises."""
+    start = time.perf_counter() if start is None else start
+    record_id = None
+    try:
+        record_id = record.get("id")
+        request = _validate_request(
+            TranslationRequest(
+                query=record["query"],
+                dialect=record.get("dialect", default_dialect),
+                dataset=record.get("dataset", default_dataset),
+                syntax_only=record.get("syntax_only", False),
+                table_mapping=record.get("table_mapping"),
+                table_mapping_index=table_mapping_index,
+            )
+        )
+        translated = _translate_request(request)
+        if isinstance(translated, DuneTranslationError):
+            result = {"id": record_id, "error": translated.detail, "error_type": type(translated).__name__}
+        elif isinstance(translated, Exception):
+            result = {"id": record_id, "error": str(translated), "error_type": type(translated).__name__}
+        else:
+            result = {"id": record_id, "query": translated}
+    except Exception as e:  # a bad line or a bug in a rule must not stop the stream
+        result = {"id": record_id, "error": str(e), "error_type": type(e).__name__}
+    result["seconds"] = time.perf_counter() - start
+    return result
+
+
+def _translate_many(
+    requests: Iterable[TranslationRequest], max_workers=None, chunksize=1, executor=None, cache=None
+) -> list[str | Exception]:
+    """Translate many requests, spreading them over a process pool, and return the results in input order
+
+    With `max_workers=1` the requests are translated in the current process, without starting a pool.
+    An existing `concurrent.futures.Executor` can be passed in to reuse its workers across batches.
+    If a `TranslationCache` is given, only the requests that aren't cached are sent to the workers. Errors other
+    than a `DuneTranslationError` aren't cached."""
+    requests = [_validate_request(r) for r in requests]
+    results = [None] * len(requests)
+    if cache is not None:
+        keys = [_request_cache_key(r) for r in requests]
+        results = [cache.get(key) for key in keys]
+    todo = [i for i, result in enumerate(results) if result is None]
+    todo_requests = [requests[i] for i in todo]
+
+    if executor is not None:
+        translated = executor.map(_translate_request, todo_requests, chunksize=chunksize)
+    elif max_workers == 1 or len(todo_requests) <= 1:
+        translated = map(_translate_request, todo_requests)
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+
+        with ProcessPoolExecutor(max_workers=max_workers) as pool:
+            translated = list(pool.map(_translate_request, todo_requests, chunksize=chunksize))
+
+    for i, result in zip(todo, translated):
+        results[i] = result
+        if cache is not None and _cacheable(result):
+            cache.put(keys[i], result)
+    return results
@@ -0,0 +1,220 @@
+import hashlib
+import json
+import os
+import re
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from functools import cache
+
+import sqlglot
+
+from dune.harmonizer.constants import SQLGLOT_POSTGRES, SQLGLOT_SPARK
+from dune.harmonizer.errors import DuneTranslationError
+
+
+@cache
+def harmonizer_version():
+    """The installed version of this package, looked up on first use since importlib.metadata is slow to import"""
+    from importlib.metadata import PackageNotFoundError, version
+
+    try:
+        return version("dune-harmonizer")
+    except PackageNotFoundError:  # running from a source checkout
+        return "dev"
+
+
+# String literals, quoted identifiers, comments and Dune parameters are kept as is, since they end up in the output.
+# Any other run of whitespace is insignificant, since the output is pretty printed. A string or name that isn't closed
+# runs to the end of the query, so whitespace is only collapsed where it surely isn't in one.
+_common_tokens = r"--[^\n]*|/\*.*?(?:\*/|\Z)|{{.*?}}|\s+"
+_token_regexes = {
+    # In Postgres, a quote in a string or name is written as two quotes, except in E'' strings, which have backslash
+    # escapes. Strings can also be dollar quoted, like $$...$$ or $tag$...$tag$, and a tag can't follow a name.
+    SQLGLOT_POSTGRES: re.compile(
+        r"(?<![\w$])[eE]'(?:[^'\\]|\\.|'')*'?|'(?:[^']|'')*'?|\"(?:[^\"]|\"\")*\"?"
+        r"|(?<![\w$])\$(?P<tag>(?:[A-Za-z_]\w*)?)\$.*?(?:\$(?P=tag)\$|\Z)|" + _common_tokens,
+        flags=re.DOTALL,
+    ),
+    # In Spark, both quotes are for strings, with backslash escapes, and backticks are for names
+    SQLGLOT_SPARK: re.compile(
+        r"'(?:[^'\\]|\\.)*'?|\"(?:[^\"\\]|\\.)*\"?|`(?:[^`]|``)*`?|" + _common_tokens, flags=re.DOTALL
+    ),
+}
+
+
+def _normalize_query(query, sqlglot_dialect=SQLGLOT_POSTGRES):
+    """Collapse whitespace outside of literals, identifiers, comments and parameters"""
+
+    def normalize(match):
+        token = match.group(0)
+        if token[0].isspace():
+            return " "
+        if token.startswith("--"):
+            return token + "\n"  # a line comment must still end the line
+        return token
+
+    token_regex = _token_regexes.get(sqlglot_dialect, _token_regexes[SQLGLOT_POSTGRES])
+    return token_regex.sub(normalize, query).strip()
+
+
+def cache_key(
+    query,
+    sqlglot_dialect,
+    dataset=None,
+    syntax_only=False,
+    table_mapping=None,
+    table_mapping_index=None,
+    schema=None,
+):
+    """A digest of everything that determines the translation of a query"""
+    return settings_digest(
+        _normalize_query(query, sqlglot_dialect),
+        sqlglot_dialect,
+        dataset,
+        syntax_only,
+        table_mapping,
+        table_mapping_index,
+        schema,
+    )
+
+
+def settings_digest(
+    text,
+    sqlglot_dialect,
+    dataset=None,
+    syntax_only=False,
+    table_mapping=None,
+    table_mapping_index=None,
+    schema=None,
+):
+    """A digest of the text and the settings of a translation, along with the versions that translate it
+
+    A schema must be a dictionary, see `is_cacheable_schema`."""
+    mapping = sorted((table_mapping or {}).items())
+    if table_mapping_index is not None:
+        mapping = [mapping, table_mapping_index.digest]
+    mapping_digest = hashlib.sha256(json.dumps(mapping).encode()).hexdigest()
+    settings = [
+        text,
+        sqlglot_dialect,
+        dataset,
+        syntax_only,
+        mapping_digest,
+        harmonizer_version(),
+        sqlglot.__version__,
+    ]
+    if schema is not None:
+        settings.append(hashlib.sha256(json.dumps(schema, sort_keys=True).encode()).hexdigest())
+    return hashlib.sha256(json.dumps(settings).encode()).hexdigest()
+
+
+def is_cacheable_schema(schema):
+    """Whether translations with the schema can be cached: a dictionary is part of the key of the translation, but a
+    SQLGlot `Schema` object, like a `SQLiteSchema` that reads a database that can change, isn't"""
+    return schema is None or isinstance(schema, dict)
+
+
+@dataclass
+class CacheStats:
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+    persistent_hits: int = 0
+
+
+class TranslationCache:
+    """A cache of translation results, both translated queries and translation errors
+
+    Entries are kept in memory in least recently used order, bounded by number of entries and total size in bytes.
+    If `path` is given, entries are also stored in a SQLite database at that path, which can be shared between
+    processes. Entries in the database are never evicted.
+    """
+
+    def __init__(self, max_entries=10_000, max_bytes=64 * 1024 * 1024, path=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.path = path
+        self.stats = CacheStats()
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._connection = None
+        self._connection_pid = None
+
+    def __getstate__(self):
+        # Only the configuration is sent to other processes, they start with an empty in-memory cache
+        return {"max_entries": self.max_entries, "max_bytes": self.max_bytes, "path": self.path}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """Return the cached translated query or `DuneTranslationError` for the key, or None if it's not cached"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.stats.hits += 1
+                return _from_entry(entry)
+            if self.path is not None:
+                row = self._db().execute("SELECT ok, value FROM translations WHERE key = ?", (key,)).fetchone()
+                if row is not None:
+                    entry = (bool(row[0]), row[1])
+                    self._store(key, entry)
+                    self.stats.hits += 1
+                    self.stats.persistent_hits += 1
+                    return _from_entry(entry)
+            self.stats.misses += 1
+            return None
+
+    def put(self, key, result):
+        """Cache a translated query or a `DuneTranslationError`"""
+        entry = (False, result.detail) if isinstance(result, DuneTranslationError) else (True, result)
+        with self._lock:
+            self._store(key, entry)
+            if self.path is not None:
+                with self._db() as db:
+                    db.execute("INSERT OR REPLACE INTO translations VALUES (?, ?, ?)", (key, *entry))
+
+    def clear(self):
+        """Remove all entries from the in-memory cache (but not from the database) and reset the stats"""
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+            self.stats = CacheStats()
+
+    def _store(self, key, entry):
+        if key in self._entries:
+            self._bytes -= _entry_size(key, self._entries.pop(key))
+        self._entries[key] = entry
+        self._bytes += _entry_size(key, entry)
+        while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+            evicted_key, evicted_entry = self._entries.popitem(last=False)
+            self._bytes -= _entry_size(evicted_key, evicted_entry)
+            self.stats.evictions += 1
+
+    def _db(self):
+        # SQLite connections can't be shared with forked processes, so each process opens its own
+        if self._connection is None or self._connection_pid != os.getpid():
+            import sqlite3
+
+            self._connection = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS translations (key TEXT PRIMARY KEY, ok INTEGER, value TEXT)"
+            )
+            self._connection_pid = os.getpid()
+        return self._connection
+
+
+def _entry_size(key, entry):
+    return len(key) + len(entry[1].encode())
+
+
+def _from_entry(entry):
+    ok, value = entry
+    return value if ok else DuneTranslationError(value)
@@ -0,0 +1,110 @@
+"""Translate queries in bulk, reading JSON lines and streaming the results as JSON lines
+
+Each input line is a JSON object with the query to translate and its id, dialect and dataset, like
+
+    {"id": 1, "dialect": "postgres", "dataset": "polygon", "query": "SELECT * FROM erc20.tokens"}
+
+`syntax_only` and `table_mapping` can also be set per query. Each output line has the id, and either the translated
+query or the error, and the time the translation took:
+
+    {"id": 1, "query": "SELECT ...", "seconds": 0.002}
+    {"id": 2, "error": "...", "error_type": "DuneTranslationError", "seconds": 0.001}
+"""
+import argparse
+import json
+import sys
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+from dune.harmonizer.batch import translate_line
+from dune.harmonizer.constants import SQLGLOT_POSTGRES
+from dune.harmonizer.table_replacements import TableMappingIndex
+
+
+def translate_lines(
+    lines,
+    workers=1,
+    ordered=False,
+    max_in_flight=None,
+    dialect=SQLGLOT_POSTGRES,
+    dataset="ethereum",
+    table_mapping_index=None,
+):
+    """Translate JSON lines, yielding a result record per line as soon as it's done
+
+    At most `max_in_flight` lines are read ahead and being translated at any time, so memory use is bounded
+    no matter how many lines there are. With `ordered=True`, results are yielded in input order.
+    A `TableMappingIndex` loaded from a file is loaded once by each worker."""
+    lines = (line for line in lines if line.strip())
+    if workers == 1:
+        for line in lines:
+            yield translate_line(line, dialect, dataset, table_mapping_index)
+        return
+
+    max_in_flight = max_in_flight or 4 * workers
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        in_flight = deque()
+        for line in lines:
+            in_flight.append(pool.submit(translate_line, line, dialect, dataset, table_mapping_index))
+            while len(in_flight) >= max_in_flight:
+                yield from _done(in_flight, ordered)
+        while in_flight:
+            yield from _done(in_flight, ordered)
+
+
+def _done(in_flight, ordered):
+    """Wait for (at least) one translation to be done, and yield the results that can be output"""
+    if ordered:
+        yield in_flight.popleft().result()
+        while in_flight and in_flight[0].done():
+            yield in_flight.popleft().result()
+        return
+    done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+    for future in done:
+        in_flight.remove(future)
+        yield future.result()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="harmonizer", description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("input", nargs="?", default="-", help="file with JSON lines to translate, - for stdin")
+    parser.add_argument("-o", "--output", default="-", help="file to write the results to, - for stdout")
+    parser.add_argument("-j", "--workers", type=int, default=1, help="number of worker processes")
+    parser.add_argument("--ordered", action="store_true", help="output results in the order of the input")
+    parser.add_argument("--max-in-flight", type=int, help="max number of queries being translated at once")
+    parser.add_argument("--dialect", default=SQLGLOT_POSTGRES, help="dialect for lines that don't set one")
+    parser.add_argument("--dataset", default="ethereum", help="dataset for lines that don't set one")
+    parser.add_argument("--table-mapping-file", help="JSON file or SQLite database to load the table mappings from")
+    parser.add_argument("--table-mapping-table", help="table with the table mappings, if the file is a SQLite database")
+    args = parser.parse_args(argv)
+
+    table_mapping_index = None
+    if args.table_mapping_file:
+        table_mapping_index = TableMappingIndex.load(args.table_mapping_file, args.table_mapping_table)
+
+    source = sys.stdin if args.input == "-" else open(args.input)
+    sink = sys.stdout if args.output == "-" else open(args.output, "w")
+    try:
+        results = translate_lines(
+            source,
+            workers=args.workers,
+            ordered=args.ordered,
+            max_in_flight=args.max_in_flight,
+            dialect=args.dialect,
+            dataset=args.dataset,
+            table_mapping_index=table_mapping_index,
+        )
+        for result in results:
+            sink.write(json.dumps(result) + "\n")
+            sink.flush()
+    finally:
+        if source is not sys.stdin:
+            source.close()
+        if sink is not sys.stdout:
+            sink.close()
+
+
+if __name__ == "__main__":
+    main()
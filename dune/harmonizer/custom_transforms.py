@@ -1,136 +1,59 @@
-import re
-from functools import partial
+from dataclasses import dataclass, field
+from functools import partial, reduce
+from typing import Callable, Optional
 
 import sqlglot
 from sqlglot import exp
 from sqlglot.expressions import to_interval
 
-from dune.harmonizer.table_replacements import table_replacements
-
-
-def extract_nested_select(text):
-    stack = []
-    results = []
-    for i, char in enumerate(text):
-        if char == "(":
-            stack.append(i)
-        elif char == ")":
-            if len(stack) > 1:
-                stack.pop()  # if a ")" is found but stack is greater than 1, we're still in a nested select
-            else:  # if stack is 1, we're at the end of the nested select
-                end = i + 1
-                substring = text[stack[0] : end].strip()
-                stack = []  # reset the stack after an end is found
-                # if substring starts with "(select "
-                if re.search(r"^\(\s*select\b", substring, re.IGNORECASE):
-                    results.append(substring)
-    return results
-
-
-def recurse_where(node, required_tables, condition_add):
-    """
-    we can't just iterate through the tree because of weird replace node behaviors, so this iterates
-    through SELECT statements and specifically adds WHERE statements with a specific condition_add
-    for a given set of required_tables, then goes through each removed select recursively to do the same thing
-
-    Useful for adding aliased "blockchain = 'ethereum'"  or other where statements in the right places.
-    """
-    if isinstance(node, sqlglot.Expression):
-        statement = node.sql(dialect="trino")
-    elif isinstance(node, str):
-        statement = node
-    else:
-        raise ValueError(f"node must be a sqlglot.Expression or string, not {type(node)}")
-    condition_add = condition_add.strip()  # remove whitespace
-
-    # we're going to remove inner selects, add WHERE statements, then put them back in.
-    match_groups = extract_nested_select(statement)
-
-    placeholder = "(SELECT * FROM __PLACEHOLDER"
-    for i, group in enumerate(match_groups):
-        statement = statement.replace(group, f"{placeholder}{i}__)")
-
-    tables = sqlglot.parse_one(statement, read="trino").find_all(sqlglot.exp.Table)
-    for table in tables:
-        for req in required_tables:
-            if req in str(table).replace('"', ""):
-                if len(table.alias) > 0:
-                    statement_to_add = " where " + table.alias + "." + condition_add
-                else:
-                    statement_to_add = " where " + condition_add
-
-                # check if there is already a where statement
-                where_statement = re.split("where", statement, flags=re.IGNORECASE)
-
-                if len(where_statement) > 1:
-                    statement = re.sub(
-                        "where",
-                        statement_to_add + " and ",
-                        statement,
-                        flags=re.IGNORECASE,
-                    )  # add to front of statement
-                else:
-                    # add statement_to_add before the last relevant keyword in statement
-                    if "group by" in statement:
-                        statement = re.sub(
-                            "group",
-                            statement_to_add + " group ",
-                            statement,
-                            flags=re.IGNORECASE,
-                        )
-                    elif "order by" in statement:
-                        statement = re.sub(
-                            "order",
-                            statement_to_add + " order ",
-                            statement,
-                            flags=re.IGNORECASE,
-                        )
-                    elif "limit" in statement:
-                        statement = re.sub(
-                            "limit",
-                            statement_to_add + " limit ",
-                            statement,
-                            flags=re.IGNORECASE,
-                        )
-                    elif "offset" in statement:
-                        statement = re.sub(
-                            "offset",
-                            statement_to_add + " offset ",
-                            statement,
-                            flags=re.IGNORECASE,
-                        )
-                    else:
-                        # add to end of statement if none of the above keywords exist
-                        statement = statement + statement_to_add
-
-    # if nothing to replace anymore, return
-    if len(match_groups) == 0:
-        return statement
-
-    # if there are still placeholders to recurse through
-    for i, group in enumerate(match_groups):
-        # remove the outer parens so it isn't caught in infinite single recursion
-        parsed_group = recurse_where(group[1:-1], required_tables, condition_add)
-        statement = statement.replace(f"{placeholder}{i}__)", "(" + parsed_group + ")")
-
-    return statement
+from dune.harmonizer.dunesql.dunesql import DuneSQL
+from dune.harmonizer.dunesql.parameters import QueryParameter, is_parameter
+from dune.harmonizer.dunesql.traversal import SKIP, copy_tree, replace_descendants
+from dune.harmonizer.instrumentation import RuleCounter, current_observer
+from dune.harmonizer.table_replacements import (
+    column_replacements,
+    index_table_mapping,
+    spellbook_column_mapping,
+    table_replacements,
+)
+
+# The trades, tokens and prices tables that have data for all chains, and need a filter on the `blockchain` column
+multichain_tables = {
+    ("nft", "trades"),
+    ("dex", "trades"),
+    ("tokens", "erc20"),
+    ("tokens", "nft"),
+    ("prices", "usd"),
+}
 
 
 def chain_where_blockchain(node, blockchain):
-    # add a blockchain = 'ethereum' to the WHERE statement for trades, tokens, and prices tables.
-    required_tables = [
-        "nft.trades",
-        "dex.trades",
-        "tokens.erc20",
-        "tokens.nft",
-        "prices.usd",
+    """Add a `blockchain = '<blockchain>'` filter to the WHERE clause of a SELECT, for each multichain table it
+    selects from directly
+
+    The filter uses the table alias if the table has one. Tables in subqueries are handled when the transform
+    visits the subquery's own SELECT."""
+    if not isinstance(node, exp.Select):
+        return node
+
+    from_ = node.args.get("from")
+    tables = ([from_.this] if from_ else []) + [join.this for join in node.args.get("joins") or []]
+    conditions = [
+        exp.Column(
+            this=exp.to_identifier("blockchain"),
+            table=table.args["alias"].this.copy() if table.alias else None,
+        ).eq(exp.Literal.string(blockchain))
+        for table in tables
+        if isinstance(table, exp.Table) and (table.db.lower(), table.name.lower()) in multichain_tables
     ]
-    condition_add = f"blockchain = '{blockchain}'"
-
-    # only run this for the highest level select, then it will recurse down
-    if node.key == "select" and node.parent is None:
-        statement = recurse_where(node, required_tables, condition_add)  # function defined above
-        return sqlglot.parse_one(statement, read="trino")
+    if not conditions:
+        return node
+
+    where = node.args.get("where")
+    if where is not None:
+        # Only an OR needs parentheses when it's put after the new conditions in the AND chain
+        conditions.append(exp.paren(where.this, copy=False) if isinstance(where.this, exp.Or) else where.this)
+    node.set("where", exp.Where(this=reduce(lambda left, right: exp.And(this=left, expression=right), conditions)))
     return node
 
 
@@ -141,149 +64,78 @@ chain_where_bnb = partial(chain_where_blockchain, blockchain="bnb")
 chain_where_polygon = partial(chain_where_blockchain, blockchain="polygon")
 
 
-def dex_trades_fixes(node):
-    """Fixes to dex.trades"""
-    # doesn't matter if subquery or not, it will replace the found filter.
-    if node.key == "select":
-        if "dex.trades" in node.sql(dialect="trino").replace('"', ""):
-            # change exchange_contract_address to project_contract_address
-            final_where = node.sql(dialect="trino").replace("exchange_contract_address", "project_contract_address")
-
-            # removing category from WHERE statement since that isn't in dex.in.trades anymore
-            clean_matches = [
-                # uses alias
-                r'(?i)\w+\.[\'"]?category[\'"]?\s*=\s*[\'"]dex.in[\'"]\s*and',  # there is a following AND
-                r'(?i)and\s*\w+\.[\'"]?category[\'"]?\s*=\s*[\'"]dex.in[\'"]',  # there is a preceding AND
-                # it is the only thing in the WHERE statement doesn't use alias
-                r'(?i)where\s*\w+\.[\'"]?category[\'"]?\s*=\s*[\'"]dex.in[\'"]',
-                r'(?i)[\'"]?category[\'"]?\s*=\s*[\'"]dex.in[\'"]\s*and',  # there is a following AND
-                r'(?i)and\s*[\'"]?category[\'"]?\s*=\s*[\'"]dex.in[\'"]',  # there is a preceding AND
-                # it is the only thing in the WHERE statement
-                r'(?i)where\s*[\'"]?category[\'"]?\s*=\s*[\'"]dex.in[\'"]',
-            ]
-
-            for match in clean_matches:
-                if re.search(match, final_where):
-                    # if category = 'DEX' is the only thing in the WHERE statement, remove the WHERE statement
-                    final_where = re.sub(match, "", final_where, flags=re.IGNORECASE)
-
-            # fix token columns
-            final_where = re.sub(
-                "token_a_address",
-                "token_sold_address",
-                final_where,
-                flags=re.IGNORECASE,
-            )
-            final_where = re.sub(
-                "token_a_symbol",
-                "token_sold_symbol",
-                final_where,
-                flags=re.IGNORECASE,
-            )
-            final_where = re.sub(
-                "token_a_amount",
-                "token_sold_amount",
-                final_where,
-                flags=re.IGNORECASE,
-            )
-            final_where = re.sub(
-                "token_a_amount_raw",
-                "token_sold_amount_raw",
-                final_where,
-                flags=re.IGNORECASE,
-            )
-            final_where = re.sub(
-                "token_b_address",
-                "token_bought_address",
-                final_where,
-                flags=re.IGNORECASE,
-            )
-            final_where = re.sub(
-                "token_b_symbol",
-                "token_bought_symbol",
-                final_where,
-                flags=re.IGNORECASE,
-            )
-            final_where = re.sub(
-                "token_b_amount",
-                "token_bought_amount",
-                final_where,
-                flags=re.IGNORECASE,
-            )
-            final_where = re.sub(
-                "token_b_amount_raw",
-                "token_bought_amount_raw",
-                final_where,
-                flags=re.IGNORECASE,
-            )
-
-            return sqlglot.parse_one(final_where, read="trino")
-    return node
+def _quoted_text(node):
+    """The text of a string literal or a quoted identifier, or None if the node is neither"""
+    if isinstance(node, exp.Literal) and node.is_string:
+        return node.this
+    if isinstance(node, exp.Column) and not node.table and node.this.args.get("quoted"):
+        return node.name
+    return None
 
 
-param_left_placeholder = "left_param_"
-param_right_placeholder = "_right_param"
-double_quoted_param_left_placeholder = f'"{param_left_placeholder}'
-double_quoted_param_right_placeholder = f'{param_right_placeholder}"'
-single_quoted_param_left_placeholder = f"'{param_left_placeholder}"
-single_quoted_param_right_placeholder = f"{param_right_placeholder}'"
+def _is_timestamp_parameter(node):
+    """Whether the node is a string literal with a parameter that looks like a date or time, like '{{start date}}'"""
+    if not (isinstance(node, exp.Literal) and node.is_string):
+        return False
+    text = node.this
+    return text.startswith("{{") and text.endswith("}}") and any(d in text.lower() for d in ("date", "time"))
 
 
 def bytearray_parameter_fix(node):
-    """Take care of parameters that use bytearrays"""
-    if node.key == "eq":
-        if all(
-            a_param in node.sql(dialect="trino").lower()
-            for a_param in (
-                "0x",
-                "substring(",
-                double_quoted_param_left_placeholder,
-                double_quoted_param_right_placeholder,
-            )
-        ):
-            # include param_left variables in regex pattern
-            pattern = (
-                r".*SUBSTRING\(\s*['\"]"
-                + re.escape(double_quoted_param_left_placeholder)
-                + r"(.*?)"
-                + re.escape(double_quoted_param_right_placeholder)
-                + r"['\"].*?\)"
-            )
-            match = re.search(pattern, node.sql(dialect="trino"))
-            return sqlglot.parse_one(
-                node.sql(dialect="trino").split("=")[0] + '= lower("{{' + match.group(1) + '}}")', read="trino"
-            )
+    """Take care of parameters that use bytearrays
+
+    Like `x = concat('0x', substring("{{address}}" from 3))`, which becomes `x = {{address}}`. The parameter has to be
+    in double quotes, either as a quoted identifier or in a string, like `'"{{address}}"'`."""
+    if isinstance(node, exp.EQ) and any(
+        literal.is_string and "0x" in literal.this.lower() for literal in node.find_all(exp.Literal)
+    ):
+        for substring in node.find_all(exp.Substring):
+            text = _quoted_text(substring.this)
+            if isinstance(substring.this, exp.Literal):
+                text = text[1:-1] if len(text) > 1 and text[0] == text[-1] == '"' else None
+            if text is not None and is_parameter(text):
+                return exp.EQ(this=node.left, expression=QueryParameter(this=text))
+    return node
+
+
+def remove_lower_on_parameters(node):
+    """Remove lower function call from bytearray parameters, like `lower('{{address}}')`
+
+    Parameters that are cast to timestamps by `cast_timestamp_parameters` are left as they are."""
+    if isinstance(node, exp.Lower) and not _is_timestamp_parameter(node.this):
+        text = _quoted_text(node.this)
+        if text is not None and text.startswith("{{") and text.endswith("}}"):
+            return QueryParameter(this=text)
     return node
 
 
 def cast_timestamp_parameters(node):
     """Look for parameters with 'date' or 'time' in, and cast these as timestamps"""
-    if node.key == "literal":
-        # or if it is a param that contains date/time
-        pattern = "('" + param_left_placeholder + r".*?" + param_right_placeholder + "')"
-        if any(d in node.sql(dialect="trino").lower() for d in ("date", "time")):
-            q = re.sub(pattern, r"timestamp \1", node.sql(dialect="trino"))
-            return sqlglot.parse_one(q, read="trino")
+    if _is_timestamp_parameter(node):
+        return exp.Cast(this=node, to=exp.DataType.build("timestamp"))
     return node
 
 
 def warn_sequence(node):
     """Add a warning that links to docs if the query uses generate_series/sequence"""
     if node.name.lower() in ("generate_series", "sequence"):
+        # DuneSQL is Trino, with the parameters that may be in the arguments
         return sqlglot.parse_one(
-            node.sql(dialect="trino")
+            node.sql(dialect=DuneSQL)
             + (
                 "-- WARNING: Check out the docs for example of time series generation: "
                 "https://dune.com/docs/query/syntax-differences/"
             ),
-            read="trino",
+            read=DuneSQL,
         )
     return node
 
 
 def cast_division_to_double(node):
     """Spark casts division to double, but Trino doesn't, so we cast the denumerator to a double"""
-    return node.transform(lambda e: e.left / exp.cast(e.right, "double") if isinstance(e, exp.Div) else e)
+    if isinstance(node, exp.Div):
+        return node.left / exp.cast(node.right, "double")
+    return node
 
 
 def null_safe_indexing(node):
@@ -294,22 +146,16 @@ def null_safe_indexing(node):
 
     We also add 1 to the index used, since Spark arrays are 0-indexed, while Trino's are 1-indexed.
     """
-    return node.transform(
-        lambda e: exp.Anonymous(this="element_at", expressions=[e.this, e.expressions[0] + 1])
-        if isinstance(e, exp.Bracket)
-        else e
-    )
+    if isinstance(node, exp.Bracket):
+        return exp.Anonymous(this="element_at", expressions=[node.this, node.expressions[0] + 1])
+    return node
 
 
-def rename_amount_column(query):
+def rename_amount_column(node):
     """Rename the usd_amount column"""
-    return sqlglot.parse_one(query.sql(dialect="trino").replace("usd_amount", "amount_usd"), read="trino")
-
-
-def fix_bytearray_param(query):
-    """Remove lower function call from bytearray parameters"""
-    pattern = r"lower\(\s*['\"]\{\{(.*?)\}\}['\"]\s*\)"
-    return re.sub(pattern, r"{{\1}}", query, flags=re.IGNORECASE)
+    if isinstance(node, exp.Identifier) and "usd_amount" in node.name:
+        return exp.Identifier(this=node.name.replace("usd_amount", "amount_usd"), quoted=node.args.get("quoted"))
+    return node
 
 
 def chain_where(dataset):
@@ -322,114 +168,302 @@ def chain_where(dataset):
     }[dataset]
 
 
-def transform_interval_cast(query):
-    query_tree = sqlglot.parse_one(query, read="postgres")
-    query_tree = query_tree.transform(
-        lambda e: to_interval(e.this) if isinstance(e, exp.TryCast) and e.to == exp.DataType.build("interval") else e
-    )
-    return query_tree.sql(dialect="postgres")
+interval_type = exp.DataType.build("interval")
 
 
-def explicit_alias_on_cast(query_tree):
+def interval_cast_to_interval(node):
+    """Postgres casts strings like '1 day' to intervals, turn these casts into interval literals"""
+    if isinstance(node, exp.TryCast) and node.to == interval_type and node.this.is_string:
+        try:
+            return to_interval(node.this)
+        except ValueError:  # not an interval string we can parse, keep the cast
+            return node
+    return node
+
+
+def explicit_alias_on_cast(node):
     """In Postgres, a simple cast of a column will retain the column name, so we add an explicit cast"""
-    return query_tree.transform(
-        lambda e: sqlglot.exp.Alias(this=e, alias=e.alias_or_name)
-        if isinstance(e, sqlglot.exp.Cast)
-        and isinstance(e.this, sqlglot.exp.Column)
-        and isinstance(e.parent, sqlglot.exp.Select)
-        else e
-    )
+    if (
+        isinstance(node, sqlglot.exp.Cast)
+        and isinstance(node.this, sqlglot.exp.Column)
+        and isinstance(node.parent, sqlglot.exp.Select)
+    ):
+        return sqlglot.exp.Alias(this=node, alias=node.alias_or_name)
+    return node
 
 
-def wrap_generate_series_with_explode(query_tree):
+def wrap_generate_series_with_explode(node):
     """Explicitly explode a generate_series
 
     In Postgres, generate_series returns a set of rows, but in Trino it returns a single row with an array,
     so we explicitly explode the array to get the same behaviour in Trino as in Postgres.
     """
-    return query_tree.transform(
-        lambda e: sqlglot.exp.Explode(this=e)
-        if isinstance(e, sqlglot.exp.GenerateSeries)
-        and not isinstance(e.parent, (sqlglot.exp.Unnest, sqlglot.exp.Explode))
-        and not isinstance(e.parent, sqlglot.exp.Table)
-        and not (isinstance(e.parent, sqlglot.exp.Alias) and isinstance(e.parent.parent, sqlglot.exp.Unnest))
-        else e
+    if (
+        isinstance(node, sqlglot.exp.GenerateSeries)
+        and not isinstance(node.parent, (sqlglot.exp.Unnest, sqlglot.exp.Explode))
+        and not isinstance(node.parent, sqlglot.exp.Table)
+        and not (isinstance(node.parent, sqlglot.exp.Alias) and isinstance(node.parent.parent, sqlglot.exp.Unnest))
+    ):
+        return sqlglot.exp.Explode(this=node)
+    return node
+
+
+@dataclass
+class QueryFeatures:
+    """The node types and names present in a query tree, used to skip rules that can't apply to it
+
+    Names are those of nodes named by a string, like identifiers, function calls and literals.
+    """
+
+    types: set[type[exp.Expression]] = field(default_factory=set)
+    names: set[str] = field(default_factory=set)
+
+    @classmethod
+    def scan(cls, query_tree):
+        features = cls()
+        for node, _, _ in query_tree.walk():
+            features.types.add(type(node))
+            if isinstance(node.this, str):
+                features.names.add(node.this.lower())
+        return features
+
+    def __or__(self, other):
+        return QueryFeatures(self.types | other.types, self.names | other.names)
+
+    def __le__(self, other):
+        return self.types <= other.types and self.names <= other.names
+
+    def has_type(self, node_types):
+        return any(issubclass(t, node_types) for t in self.types)
+
+    def has_parameters(self):
+        return any("{{" in name for name in self.names)
+
+
+@dataclass(frozen=True)
+class Rule:
+    """A transform of a single node, applied to nodes of the given types (or to every node, if no types are given)
+
+    A rule is skipped if none of its node types are in the query tree, or if `applies` returns False for the
+    `QueryFeatures` of the tree. For this to be correct, a rule must only change a node if the features it
+    depends on are present in that node or its children."""
+
+    transform: Callable[[exp.Expression], exp.Expression]
+    node_types: tuple[type[exp.Expression], ...] = ()
+    applies: Optional[Callable[[QueryFeatures], bool]] = None
+
+    @property
+    def name(self):
+        transform = self.transform.func if isinstance(self.transform, partial) else self.transform
+        return getattr(transform, "__name__", type(transform).__name__)
+
+    def applies_to(self, features):
+        if self.node_types and not features.has_type(self.node_types):
+            return False
+        return self.applies is None or bool(self.applies(features))
+
+
+def apply_rules(query_tree, rules, copy=True):
+    """Apply a sequence of rules to the query tree in a single traversal
+
+    This gives the same result as calling `query_tree.transform(rule.transform)` for each rule in order:
+    the tree is visited top-down, the rules are applied in order on each node, and a rule is not applied again
+    inside a node it has replaced. Rules are dispatched on node type, so a node only pays for the rules that
+    apply to it, and rules that can't apply to the tree at all are skipped."""
+    if copy:
+        query_tree = copy_tree(query_tree)
+    features = QueryFeatures.scan(query_tree)
+    active = [rule.applies_to(features) for rule in rules]
+    observer = current_observer()
+    if not any(active):
+        if observer is not None:
+            for rule in rules:
+                observer.on_rule(rule.name, 0.0, 0, 0)
+        return query_tree
+
+    transforms = [rule.transform for rule in rules]
+    if observer is not None:
+        transforms = [RuleCounter(transform) for transform in transforms]
+    dispatch = {}
+
+    def rules_for(node_type):
+        if node_type not in dispatch:
+            dispatch[node_type] = [
+                (i, transforms[i])
+                for i, rule in enumerate(rules)
+                if active[i] and (not rule.node_types or issubclass(node_type, rule.node_types))
+            ]
+        return dispatch[node_type]
+
+    def add_features(new_node):
+        # A replaced node can bring in new features, which later rules may need
+        nonlocal features
+        new_features = QueryFeatures.scan(new_node)
+        if new_features <= features:
+            return
+        features = features | new_features
+        for i, rule in enumerate(rules):
+            if not active[i] and rule.applies_to(features):
+                active[i] = True
+                dispatch.clear()
+
+    def apply(node, replaced_by):
+        next_rule = 0
+        replaced = True
+        while replaced:
+            replaced = False
+            for i, transform in rules_for(type(node)):
+                if i < next_rule or i in replaced_by:
+                    continue
+                new_node = transform(node)
+                if new_node is None or not isinstance(new_node, exp.Expression):
+                    return new_node, SKIP
+                if new_node is not node:
+                    # Keep applying the remaining rules to the new node, dispatching on its type
+                    new_node.parent = node.parent
+                    add_features(new_node)
+                    node, next_rule, replaced_by, replaced = new_node, i + 1, replaced_by | {i}, True
+                    break
+        return node, replaced_by
+
+    query_tree, replaced_by = apply(query_tree, frozenset())
+    if isinstance(query_tree, exp.Expression):
+        # Visit the rest of the tree with an explicit stack, since deep trees would hit the recursion limit
+        replace_descendants(query_tree, apply, context=replaced_by)
+    if observer is not None:
+        for rule, counter in zip(rules, transforms):
+            observer.on_rule(rule.name, counter.seconds, counter.nodes_visited, counter.nodes_rewritten)
+    return query_tree
+
+
+def _has_sequence(features):
+    return "generate_series" in features.names or "sequence" in features.names
+
+
+def _has_usd_amount(features):
+    return any("usd_amount" in name for name in features.names)
+
+
+v1_rules = (
+    Rule(interval_cast_to_interval, (exp.TryCast,)),
+    Rule(cast_timestamp_parameters, (exp.Literal,), applies=QueryFeatures.has_parameters),
+    Rule(warn_sequence, applies=_has_sequence),
+    Rule(bytearray_parameter_fix, (exp.EQ,), applies=QueryFeatures.has_parameters),
+    Rule(remove_lower_on_parameters, (exp.Lower,), applies=QueryFeatures.has_parameters),
+    Rule(explicit_alias_on_cast, (exp.Cast,)),
+    Rule(wrap_generate_series_with_explode, (exp.GenerateSeries,)),
+)
+
+v2_rules = (
+    Rule(cast_timestamp_parameters, (exp.Literal,), applies=QueryFeatures.has_parameters),
+    Rule(remove_lower_on_parameters, (exp.Lower,), applies=QueryFeatures.has_parameters),
+    Rule(warn_sequence, applies=_has_sequence),
+    Rule(cast_division_to_double, (exp.Div,)),
+    Rule(null_safe_indexing, (exp.Bracket,)),
+)
+
+
+def v1_table_rules(dataset, mapping):
+    """Rules for translating from the v1 tables in Postgres datasets to the v2 tables, that apply to single nodes
+
+    The table `mapping` is indexed like the mappings that `TableMappingIndex.for_dataset` returns."""
+    return (
+        Rule(table_replacements(dataset, mapping), (exp.Table,)),
+        Rule(cast_division_to_double, (exp.Div,)),
+    )
+
+
+def v1_spell_fixes(query_tree, dataset):
+    """Apply the fixes for spells that need the table replacements to be done on the whole tree first"""
+    query_tree = column_replacements(query_tree, spellbook_column_mapping())
+    return apply_rules(
+        query_tree,
+        (
+            Rule(chain_where(dataset), (exp.Select,)),
+            Rule(rename_amount_column, (exp.Identifier,), applies=_has_usd_amount),
+        ),
+        copy=False,
     )
 
 
-def v1_transforms(query_tree):
-    """Apply a series of transforms to the query tree, recursively using SQLGlot's recursive transform function.
+def v1_transforms(query_tree, copy=True):
+    """Apply a series of transforms to the query tree, in a single traversal of the tree.
 
     Each transform takes and returns a sqlglot.Expression"""
-    transforms = (
-        cast_timestamp_parameters,
-        warn_sequence,
-        bytearray_parameter_fix,
-        explicit_alias_on_cast,
-        wrap_generate_series_with_explode,
-    )
-    for f in transforms:
-        query_tree = query_tree.transform(f)
-    return query_tree
+    return apply_rules(query_tree, v1_rules, copy=copy)
 
 
 def v1_tables_to_v2_tables(query_tree, dataset, mapping):
-    """Apply a series of transforms to the query tree, recursively using SQLGlot's recursive transform function.
+    """Apply a series of transforms to the query tree, in as few traversals of the tree as possible.
 
     Each transform takes and returns a sqlglot.Expression.
     The transforms are concerned with translating from the v1 tables in Postgres datasets to the v2 tables.
     The replacements are given by the `mapping` dictionary."""
-    transforms = (
-        table_replacements(dataset, mapping),
-        dex_trades_fixes,
-        chain_where(dataset),
-        rename_amount_column,
-        cast_division_to_double,
-    )
-    for f in transforms:
-        query_tree = query_tree.transform(f)
-    return query_tree
+    query_tree = apply_rules(query_tree, v1_table_rules(dataset, index_table_mapping(mapping)))
+    return v1_spell_fixes(query_tree, dataset)
 
 
-def v2_transforms(query_tree):
-    """Apply a series of transforms to the query tree, recursively using SQLGlot's recursive transform function.
+def v2_transforms(query_tree, copy=True):
+    """Apply a series of transforms to the query tree, in a single traversal of the tree.
 
     Each transform takes and returns a sqlglot.Expression"""
-    transforms = (
-        cast_timestamp_parameters,
-        warn_sequence,
-        cast_division_to_double,
-        null_safe_indexing,
+    return apply_rules(query_tree, v2_rules, copy=copy)
+
+
+# The columns that the v2 spells dropped, whose filters are removed depending on the value they're compared to
+_dropped_columns = {
+    name
+    for columns in spellbook_column_mapping().values()
+    for name, new_name in columns.items()
+    if not isinstance(new_name, str)
+}
+
+
+def literal_affects_rules(node, has_parameters):
+    """Whether the rules above may translate a query differently if this literal had another value
+
+    Only the values of string literals are looked at: those with parameters (which also turn on the rules for
+    parameters), those that name a time series function, strings cast to intervals, strings compared to a column
+    that the v2 spells dropped, and, in queries with parameters, strings with `0x` in. Anything else a literal's
+    value changes is done while generating DuneSQL, or by `add_warnings`. Keep this up to date with the rules, since
+    `ShapeCache` relies on it to reuse translations."""
+    if not (isinstance(node, exp.Literal) and node.is_string):
+        return False
+    value = node.this.lower()
+    return (
+        "{{" in value
+        or value in ("generate_series", "sequence")
+        or (isinstance(node.parent, (exp.Cast, exp.TryCast)) and node.parent.to == interval_type)
+        or (isinstance(node.parent, exp.EQ) and _compared_to_dropped_column(node))
+        or (has_parameters and "0x" in value)
     )
-    for f in transforms:
-        query_tree = query_tree.transform(f)
-    return query_tree
 
 
-def add_warnings(query):
-    """Add a success banner at the top, and look for a few cases of things we don't fix and add a warning if present"""
+def _compared_to_dropped_column(node):
+    other = node.parent.expression if node.parent.this is node else node.parent.this
+    return isinstance(other, exp.Column) and other.name.lower() in _dropped_columns
+
+
+generated_view_warning = (
+    "/* !Generated view warning: you can't query views in dune_user_generated anymore. "
+    "All queries in DuneSQL are by default views though (try querying the table 'query_1747157') */"
+)
+
+
+def translation_warnings(query):
+    """Warnings about a few cases of things we don't fix in the translated query, as comments, in the order they're
+    shown at the top of the query"""
+    warnings = []
+    if "dune_user_generated" in query.lower():
+        warnings.append(generated_view_warning)
     if "lower('{{" in query.lower():
-        query = (
+        warnings.append(
             "/* !Bytea parameter warning: Make sure to change \\x to 0x in the parameters, bytea types are "
             "native now (no need for quotes or lower or \\x)' */"
-            "\n\n"
-        ) + query
-
-    if "dune_user_generated" in query.lower():
-        query = (
-            "/* !Generated view warning: you can't query views in dune_user_generated anymore. "
-            "All queries in DuneSQL are by default views though (try querying the table 'query_1747157') */"
-            "\n\n"
-        ) + query
-
-    return query
+        )
+    return warnings
 
 
-def parameter_placeholder(p):
-    return (
-        p.replace("{{", param_left_placeholder)
-        .replace("}}", param_right_placeholder)
-        .replace(" ", "_")
-        .replace("-", "_")
-        .lower()
-    )
+def add_warnings(query):
+    """Add a success banner at the top, and look for a few cases of things we don't fix and add a warning if present"""
+    return "".join(f"{warning}\n\n" for warning in translation_warnings(query)) + query
@@ -1,9 +1,31 @@
 from sqlglot.dialects.postgres import Postgres
 
+from dune.harmonizer.dunesql.parameters import ParameterTokenizer, QueryParameter, parameter_sql, placeholder_parsers
+
 
 class DunePostgres(Postgres):
     """
-    Overwrite Postgres dialect to nulls are last
+    Overwrite Postgres dialect to nulls are last, and to parse Dune query parameters
     """
 
     NULL_ORDERING = "nulls_are_last"
+
+    class Tokenizer(ParameterTokenizer, Postgres.Tokenizer):
+        pass
+
+    class Parser(Postgres.Parser):
+        PLACEHOLDER_PARSERS = placeholder_parsers(Postgres.Parser)
+
+    class Generator(Postgres.Generator):
+        TRANSFORMS = Postgres.Generator.TRANSFORMS | {QueryParameter: parameter_sql}
+
+
+def bytea_to_hex_strings(query):
+    """Update bytearray syntax for postgres, before the query is tokenized
+
+    SQLGlot parses x'deadbeef' as a HexString, but it doesn't parse \\x as a hex string,
+    because it's just a general byte array notation. But we want to always parse it as a hex string."""
+    query = query.replace(r"'\x", "x'")
+
+    # SQLGlot is unable to tokenize x'' so work around it
+    return query.replace("x''", "'x'")
@@ -0,0 +1,18 @@
+from sqlglot.dialects.spark import Spark
+
+from dune.harmonizer.dunesql.parameters import ParameterTokenizer, QueryParameter, parameter_sql, placeholder_parsers
+
+
+class DuneSpark(Spark):
+    """
+    Overwrite Spark dialect to parse Dune query parameters
+    """
+
+    class Tokenizer(ParameterTokenizer, Spark.Tokenizer):
+        pass
+
+    class Parser(Spark.Parser):
+        PLACEHOLDER_PARSERS = placeholder_parsers(Spark.Parser)
+
+    class Generator(Spark.Generator):
+        TRANSFORMS = Spark.Generator.TRANSFORMS | {QueryParameter: parameter_sql}
@@ -1,23 +1,155 @@
+import collections
+
 from sqlglot import TokenType, exp, transforms
 from sqlglot.dialects.trino import Trino
 
+from dune.harmonizer.dunesql.parameters import ParameterTokenizer, QueryParameter, parameter_sql, placeholder_parsers
 from dune.harmonizer.dunesql.transform import (
-    cast_boolean_strings,
-    cast_date_strings,
-    concat_of_hex_string_to_bytearray_concat,
-    pipe_of_hex_strings_to_bytearray_concat,
-    remove_calls_on_hex_strings,
-    rename_bytea2numeric_to_bytearray_to_bigint,
-    replace_0x_strings_with_hex_strings,
+    cast_boolean_string,
+    cast_date_string,
+    concat_to_bytearray_concat_call,
+    hex_string_of_0x_string,
+    pipe_expression_to_bytearray_concat_call,
+    remove_call_on_hex_string,
+    rename_bytea2numeric_call,
 )
+from dune.harmonizer.dunesql.traversal import copy_tree, replace_descendants
+
+
+def explode_to_unnest(expression):
+    """`sqlglot.transforms.explode_to_unnest`, skipped for selects without an explode in their projections
+
+    The SQLGlot transform collects the scope of the select first, which walks the whole tree recursively."""
+    for select in expression.selects:
+        if isinstance(select, (exp.Alias, exp.Aliases)):
+            select = select.this
+        if isinstance(select, (exp.Explode, exp.Posexplode)):
+            return transforms.explode_to_unnest(expression)
+    return expression
+
+
+# The transforms that generating DuneSQL does on selects. Generating a select transforms it with all of them, in
+# order, like `sqlglot.transforms.preprocess`, which transforms the selects in it as well, before they are generated
+# and transformed again. `to_dunesql` does them once, on the whole tree, with the same result, in a traversal down
+# the tree and one up:
+# - the transforms of a select itself, on the outermost selects on the way down, and on the selects in them on the
+#   way up, after the nodes in them, like generating a select nested in another one does them,
+# - the rewrites of single nodes in selects, on the way down, in order on each node, but not again inside a node
+#   they replaced in the same select, like `traversal.transform` does them,
+# - the optimizations of calls and operators on hex strings, on the way up, since they need their operands rewritten.
+# The rename of `bytea2numeric` calls and the removal of calls on hex strings are the only rewrites that can apply to
+# a node again after they replaced it or one of its ancestors. Each select a node is in does these once more, so
+# of nested calls, as many are rewritten as there are selects around them, like generating them does.
+SELECT_TRANSFORMS = [
+    # Transforms from SQLGlot
+    transforms.eliminate_qualify,
+    explode_to_unnest,
+]
+NODE_TRANSFORMS = [
+    cast_boolean_string,
+    cast_date_string,
+    hex_string_of_0x_string,
+]
+
+
+def _transform_select(select):
+    transformed = select
+    for transform in SELECT_TRANSFORMS:
+        transformed = transform(transformed)
+    if transformed is not select:
+        # The select is now nested in the one that replaced it, like a select that `eliminate_qualify` wraps
+        _transform_select(select)
+    return transformed
+
+
+def _rewrite_node(node, context):
+    """Rewrite a node on the way down, given the node transforms that replaced its ancestors in the same select, and
+    the number of selects around it that can still rename a `bytea2numeric` call in it, or None outside of selects"""
+    if type(node) is exp.Select and context is None:
+        node = _transform_select(node)
+    if type(node) is exp.Select:
+        # Generating a select transforms all of it, whatever replaced the nodes around it
+        context = (frozenset(), (context[1] if context else 0) + 1)
+    if context is None:
+        return node, None
+    replaced_by, renames = context
+    if renames:
+        # Of nested calls, each select renames the outermost one that it hasn't renamed yet
+        renamed = rename_bytea2numeric_call(node)
+        if renamed is not node:
+            renamed.parent = node.parent
+            node, renames = renamed, renames - 1
+    for i, transform in enumerate(NODE_TRANSFORMS):
+        if i in replaced_by:
+            continue
+        new_node = transform(node)
+        if new_node is not node:
+            new_node.parent = node.parent
+            node, replaced_by = new_node, replaced_by | {i}
+    return node, (replaced_by, renames)
+
+
+def _count_selects(node, selects):
+    return node, selects + (type(node) is exp.Select)
+
+
+def _optimizer():
+    """Optimize a node on the way up, given the number of selects it's in (itself included)"""
+    # The number of calls removed from each hex string. Each select removes the innermost call on a hex string that's
+    # left, so no more calls are removed than there are selects around them.
+    removed = {}
+
+    def optimize(node, selects):
+        if not selects:
+            return node
+        if type(node) is exp.Select and selects > 1:
+            return _transform_select(node)
+        if removed.get(id(node.this), 0) < selects:
+            hex_string = remove_call_on_hex_string(node)
+            if hex_string is not node:
+                removed[id(hex_string)] = removed.get(id(hex_string), 0) + 1
+                return hex_string
+        node = concat_to_bytearray_concat_call(node)
+        if isinstance(node, exp.DPipe) and not (isinstance(node.parent, exp.DPipe) and node.arg_key == "this"):
+            # A chain of || is a left-deep tree. Like on the way down, the pipe at the top of the chain is rewritten
+            # first, and only if it isn't, the pipes on its left.
+            pipe = node
+            while True:
+                new_node = pipe_expression_to_bytearray_concat_call(pipe)
+                if new_node is not pipe:
+                    if pipe is node:
+                        return new_node
+                    pipe.replace(new_node)
+                    break
+                if not isinstance(pipe.this, exp.DPipe):
+                    break
+                pipe = pipe.this
+        return node
+
+    return optimize
+
+
+def to_dunesql(expression):
+    """A copy of the expression with the transforms of selects done, as generating it as DuneSQL does them
+
+    The copy is the tree of the DuneSQL that the expression is generated as, with hex strings, casts of date strings
+    and so on, so it can be optimized or inspected like a parsed DuneSQL query. Nodes outside of selects are left
+    as they are."""
+    root, replaced_by = _rewrite_node(copy_tree(expression), None)
+    replace_descendants(root, _rewrite_node, context=replaced_by)
+
+    selects = int(type(root) is exp.Select)
+    optimize = _optimizer()
+    replace_descendants(root, _count_selects, optimize, context=selects)
+    return optimize(root, selects)
 
 
 class DuneSQL(Trino):
     """The DuneSQL dialect is the dialect used to execute SQL queries on Dune's crypto data sets
 
-    DuneSQL is the Trino dialect with slight modifications."""
+    DuneSQL is the Trino dialect with slight modifications, and Dune query parameters like `{{ start date }}`."""
 
-    class Tokenizer(Trino.Tokenizer):
+    class Tokenizer(ParameterTokenizer, Trino.Tokenizer):
         """Text -> Tokens"""
 
         HEX_STRINGS = ["0x", ("X'", "'")]
@@ -26,26 +158,101 @@ class DuneSQL(Trino):
             "INT256": TokenType.INT256,
         }
 
+    class Parser(Trino.Parser):
+        """Tokens -> AST"""
+
+        PLACEHOLDER_PARSERS = placeholder_parsers(Trino.Parser)
+
     class Generator(Trino.Generator):
         """AST -> SQL"""
 
         TRANSFORMS = Trino.Generator.TRANSFORMS | {
             exp.HexString: lambda self, e: f"0x{e.this}",
-            # preprocess will call each function in order, manipulating the AST, before it is converted to SQL
-            exp.Select: transforms.preprocess(
-                [
-                    # Transforms from SQLGlot
-                    transforms.eliminate_qualify,
-                    transforms.explode_to_unnest,
-                    # Custom transforms
-                    rename_bytea2numeric_to_bytearray_to_bigint,
-                    cast_boolean_strings,
-                    cast_date_strings,
-                    replace_0x_strings_with_hex_strings,
-                    # Optimizations
-                    remove_calls_on_hex_strings,
-                    concat_of_hex_string_to_bytearray_concat,
-                    pipe_of_hex_strings_to_bytearray_concat,
-                ]
-            ),
+            QueryParameter: parameter_sql,
         }
+        # The transforms of selects are done on the whole tree before it's generated, see `to_dunesql`
+        TRANSFORMS.pop(exp.Select)
+
+        def generate(self, expression, cache=None):
+            return super().generate(to_dunesql(expression) if expression is not None else None, cache)
+
+        def anonymous_sql(self, expression):
+            # Long chains of || of hex strings become calls nested in their first argument, like
+            # bytearray_concat(bytearray_concat(0x01, 0x02), 0x03). Generate these in a loop rather than recursively,
+            # and without copying the SQL of the inner calls at every level, so it takes time linear in the output.
+            chain = [expression]
+            while (
+                chain[-1].expressions
+                and type(chain[-1].expressions[0]) is exp.Anonymous
+                and chain[-1].expressions[0].name == expression.name
+                and not chain[-1].expressions[0].comments
+            ):
+                chain.append(chain[-1].expressions[0])
+            if len(chain) == 1:
+                return super().anonymous_sql(expression)
+            inner = super().anonymous_sql(chain.pop())
+            prefixes, suffixes, width = [], [inner], len(inner)
+            lines = None
+            for depth, node in enumerate(reversed(chain)):
+                name = self.normalize_func(node.name)
+                args = [self.sql(arg) for arg in node.expressions[1:] if arg is not None]
+                width += sum(len(arg) for arg in args)
+                if lines is None and not (self.pretty and width > self.max_text_width):
+                    # Like `self.func(name, inner, *args)`, with the SQL of the inner calls in between
+                    prefixes.append(f"{name}(")
+                    suffixes.append("".join(f", {arg}" for arg in args) + ")")
+                    width += len(name) + 2 * len(args) + 2
+                    continue
+                if lines is None:
+                    # The arguments don't fit on a line anymore, and neither will those of the calls around these:
+                    # from here on, they're put on their own lines, indented by one more level for each call
+                    inner = "".join(reversed(prefixes)) + "".join(suffixes)
+                    lines = collections.deque([depth, line] for line in inner.split("\n"))
+                for arg in args:
+                    lines[-1][1] += ","
+                    lines.extend([depth, line] for line in arg.split("\n"))
+                lines.appendleft([depth + 1, f"{name}("])
+                lines.append([depth + 1, ")"])
+                width += len(name) + 2 * len(args) + 4
+            if lines is None:
+                return "".join(reversed(prefixes)) + "".join(suffixes)
+            return "\n".join(f"{' ' * ((len(chain) - depth) * self.pad)}{line}" for depth, line in lines)
+
+        def binary(self, expression, op):
+            # Long chains of the same operator, like `a OR b OR c ...` or `a || b || c ...`, are parsed as left-deep
+            # trees. Generate them in a loop rather than by recursing into the left operand, so they can be any length.
+            if type(expression) not in _CHAINED_OPERATORS or type(expression) in self.TRANSFORMS:
+                return super().binary(expression, op)
+            chain = [expression]
+            while type(chain[-1].this) is type(expression):
+                chain.append(chain[-1].this)
+            sql = self.sql(chain[-1], "this")
+            for node in reversed(chain):
+                sql = f"{sql} {self.maybe_comment(op, comments=node.comments)} {self.sql(node, 'expression')}"
+            return sql
+
+        def connector_sql(self, expression, op):
+            if not self.pretty:
+                return self.binary(expression, op)
+            # Like `Generator.connector_sql`, but flattens the chain of connectors without recursion
+            sqls = tuple(
+                self.maybe_comment(self.sql(e), e, e.parent.comments or []) if i != 1 else self.sql(e)
+                for i, e in enumerate(_flatten(expression))
+            )
+            sep = "\n" if self.text_width(sqls) > self.max_text_width else " "
+            return f"{sep}{op} ".join(sqls)
+
+
+# Operators that are generated by `Generator.binary` alone, so a chain of them can be generated in a loop
+_CHAINED_OPERATORS = (exp.And, exp.Or, exp.DPipe, exp.Add, exp.Sub, exp.Mul, exp.Div, exp.Mod)
+
+
+def _flatten(expression):
+    """The operands of a chain of the same connector, like `expression.flatten(unnest=False)`"""
+    stack = [expression]
+    while stack:
+        node = stack.pop()
+        if type(node) is type(expression):
+            stack.extend(reversed([child for _, child in node.iter_expressions()]))
+        else:
+            yield node
@@ -1,30 +1,70 @@
 from sqlglot import exp
-from sqlglot.expressions import replace_children
 from sqlglot.optimizer import optimizer
 from sqlglot.optimizer.annotate_types import TypeAnnotator
+from sqlglot.optimizer.scope import Scope, traverse_scope, walk_in_scope
+from sqlglot.schema import ensure_schema
 
+from dune.harmonizer.dunesql.traversal import balanced_chains, transform_post_order
 
-def optimize(expr, schema):
+
+def optimize(expr, schema, scoped=False):
     """Optimize a DuneSQL expression (AST) according to a provided schema
 
+    The schema is either a dictionary like `{table: {column: type}}`, or a SQLGlot `Schema`, like the
+    `dune.harmonizer.schemas.SQLiteSchema` that looks up tables in a SQLite database as they're needed.
+
     Involves fully qualifying all table and column names.
     Current rules supported are
-    - casting types in equals"""
+    - casting types in equals
+
+    With `scoped=True`, the query isn't qualified. Instead, only the operands of the comparisons the rules look at
+    get their types annotated, by resolving the columns in them through the scopes of the query, which are
+    computed once. A `*` is only looked into to find the type of a column selected through it, and never expanded.
+    The same casts are added, but the rest of the query is left as it was written. This is much faster on queries
+    on wide tables. The exception is a join `USING` columns of different types: the full mode turns it into a join
+    `ON` the columns being equal, and casts one of them, while the scoped mode leaves the join as it is, without a
+    cast. A column of the join elsewhere in the query gets the type of the first table that has it, like in the full
+    mode."""
     annotators = TypeAnnotator.ANNOTATORS | {
         exp.HexString: lambda self, expr: self._annotate_with_type(expr, exp.DataType.Type.VARBINARY),
     }
     coerces_to = TypeAnnotator.COERCES_TO
 
-    annotated_expr = optimizer.annotate_types(
-        expression=optimizer.qualify(
-            expression=expr,
+    # Qualifying, annotating and building the scopes walk the tree recursively, so long chains of conditions are
+    # balanced while they do
+    with balanced_chains(expr):
+        if scoped:
+            types = _ScopedTypes(_OperandAnnotator(ensure_schema(schema), annotators, coerces_to))
+            for scope in traverse_scope(expr):
+                # Innermost comparisons first, so a comparison of comparisons sees the casts of its operands
+                for comparison in reversed(list(scope.find_all(exp.EQ, exp.NEQ))):
+                    types.annotate(scope, comparison.left)
+                    types.annotate(scope, comparison.right)
+                    _cast_types_in_equal(comparison, coerces_to)
+            return expr
+
+        annotated_expr = optimizer.annotate_types(
+            expression=optimizer.qualify(
+                expression=expr,
+                schema=schema,
+            ),
             schema=schema,
-        ),
-        schema=schema,
-        annotators=annotators,
-        coerces_to=coerces_to,
-    )
-    return _cast_types_in_equals(annotated_expr, coerces_to=coerces_to)
+            annotators=annotators,
+            coerces_to=coerces_to,
+        )
+        return _cast_types_in_equals(annotated_expr, coerces_to=coerces_to)
+
+
+async def aoptimize(expr, schema, scoped=False, timeout=None, translator=None):
+    """Optimize a DuneSQL expression without blocking the event loop, see `optimize`
+
+    The optimization runs on `translator`, a `dune.harmonizer.aio.AsyncTranslator`, which bounds the number of
+    concurrent calls. By default, that's a shared pool of threads. After `timeout` seconds, this raises
+    `asyncio.TimeoutError`."""
+    from dune.harmonizer.aio import default_translator
+
+    translator = translator or default_translator()
+    return await translator.optimize(expr, schema, scoped=scoped, timeout=timeout)
 
 
 def _handle_varchar_varbinary(e):
@@ -98,23 +138,137 @@ def _handle_varchar_varbinary(e):
 
 def _cast_types_in_equals(expression, coerces_to):
     """Ensure types in equals expressions are the same type, if possible"""
-    replace_children(expression, _cast_types_in_equals, coerces_to=coerces_to)
-    if isinstance(expression, (exp.EQ, exp.NEQ)):
-        left_type, right_type = expression.left.type.this, expression.right.type.this
-
-        # Treat comparisons between varbinary and varchar
-        types = (left_type, right_type)
-        if exp.DataType.Type.VARBINARY in types and exp.DataType.Type.VARCHAR in types:
-            return _handle_varchar_varbinary(expression)
-
-        # Otherwise use coercion hierarchy to cast one type to the other
-        left_coerces_to, right_coerces_to = coerces_to.get(left_type, set()), coerces_to.get(right_type, set())
-        # Cast left operand to type of right
-        if right_type in left_coerces_to:
-            cast = exp.Cast(this=expression.left, to=exp.DataType.build(right_type))
-            return expression.replace(type(expression)(this=cast, expression=expression.right))
-        # Cast right operand to type of left
-        if left_type in right_coerces_to:
-            cast = exp.Cast(this=expression.right, to=exp.DataType.build(left_type))
-            return expression.replace(type(expression)(this=expression.left, expression=cast))
+    return transform_post_order(
+        expression, lambda e: _cast_types_in_equal(e, coerces_to) if isinstance(e, (exp.EQ, exp.NEQ)) else e
+    )
+
+
+def _cast_types_in_equal(expression, coerces_to):
+    """Cast one side of an annotated equals (or not equals) expression to the type of the other, if needed"""
+    left_type, right_type = expression.left.type.this, expression.right.type.this
+
+    # Treat comparisons between varbinary and varchar
+    types = (left_type, right_type)
+    if exp.DataType.Type.VARBINARY in types and exp.DataType.Type.VARCHAR in types:
+        return _handle_varchar_varbinary(expression)
+
+    # Otherwise use coercion hierarchy to cast one type to the other
+    left_coerces_to, right_coerces_to = coerces_to.get(left_type, set()), coerces_to.get(right_type, set())
+    # Cast left operand to type of right
+    if right_type in left_coerces_to:
+        cast = exp.Cast(this=expression.left, to=exp.DataType.build(right_type))
+        return expression.replace(type(expression)(this=cast, expression=expression.right))
+    # Cast right operand to type of left
+    if left_type in right_coerces_to:
+        cast = exp.Cast(this=expression.right, to=exp.DataType.build(left_type))
+        return expression.replace(type(expression)(this=expression.left, expression=cast))
     return expression
+
+
+class _OperandAnnotator(TypeAnnotator):
+    """A `TypeAnnotator` for single expressions, whose columns already have their types
+
+    `TypeAnnotator.annotate` resolves the columns of the scopes in the expression itself, and gives the columns it
+    can't resolve an unknown type, while `_ScopedTypes` resolves them on its own."""
+
+    def annotate_operand(self, expression):
+        return self._maybe_annotate(expression)
+
+
+class _ScopedTypes:
+    """Annotates the types of expressions, resolving the columns in them through the scopes of the query
+
+    Columns are resolved to the table they're selected from, through aliases, subqueries, CTEs and stars, without
+    qualifying or expanding anything in the query. A column of a subquery that isn't selected from one of its own
+    sources is looked up in the scopes it's nested in, like a correlated column. The type of a column selected from
+    a subquery is the type of its projection there, which is annotated (and cached) on first use."""
+
+    def __init__(self, annotator):
+        self.annotator = annotator
+        self.schema = annotator.schema
+        self._source_types = {}
+
+    def annotate(self, scope, expression):
+        for node, _, _ in walk_in_scope(expression):
+            if isinstance(node, exp.Column) and not isinstance(node.this, exp.Star) and node._type is None:
+                if node.table:
+                    source_scope = next((s for s in _outer_scopes(scope) if node.table in s.selected_sources), scope)
+                    table = node.table
+                else:
+                    source_scope, table = self._source_of(scope, node.name)
+                node.type = self._column_type(source_scope, table, node.name)
+        return self.annotator.annotate_operand(expression)
+
+    def _source_of(self, scope, name):
+        """The scope and the name of the source in it that an unqualified column in the scope comes from
+
+        The name is None if it can't be found."""
+        for source_scope in _outer_scopes(scope):
+            source = self._local_source_of(source_scope, name)
+            if source is not None:
+                return source_scope, source
+        # A table that's not in the schema can only be known to have the column if it's the only source
+        sources = list(scope.selected_sources)
+        return scope, (sources[0] if len(sources) == 1 else None)
+
+    def _local_source_of(self, scope, name):
+        """The name of the source in the scope that has a column, if it can be found"""
+        return next((source for source in scope.selected_sources if self._has_column(scope, source, name)), None)
+
+    def _has_column(self, scope, source_name, name):
+        _, source = scope.selected_sources.get(source_name, (None, None))
+        if isinstance(source, exp.Table):
+            return name.lower() in (column.lower() for column in self.schema.column_names(source))
+        if isinstance(source, Scope):
+            source = _leftmost(source)
+            for select in source.expression.selects:
+                if isinstance(select, exp.Star):
+                    if self._local_source_of(source, name) is not None or len(source.selected_sources) == 1:
+                        return True
+                elif isinstance(select, exp.Column) and isinstance(select.this, exp.Star):
+                    if self._has_column(source, select.table, name):
+                        return True
+                elif select.alias_or_name.lower() == name.lower():
+                    return True
+        return False
+
+    def _column_type(self, scope, source_name, name):
+        key = (id(scope), source_name, name.lower())
+        if key not in self._source_types:
+            self._source_types[key] = self._resolve_column_type(scope, source_name, name)
+        return self._source_types[key]
+
+    def _resolve_column_type(self, scope, source_name, name):
+        _, source = scope.selected_sources.get(source_name, (None, None))
+        if isinstance(source, exp.Table):
+            return self.schema.get_column_type(source, name)
+        if isinstance(source, Scope) and isinstance(source.expression, exp.Subqueryable):
+            source = _leftmost(source)
+            for select in source.expression.selects:
+                if not isinstance(select, exp.Star) and select.alias_or_name.lower() == name.lower():
+                    return self.annotate(source, select).type
+            # Not a named projection, so it can only be selected through a star
+            for select in source.expression.selects:
+                if isinstance(select, exp.Star):
+                    source_scope, table = self._source_of(source, name)
+                    if table is not None:
+                        return self._column_type(source_scope, table, name)
+                elif isinstance(select, exp.Column) and isinstance(select.this, exp.Star):
+                    if self._has_column(source, select.table, name):
+                        return self._column_type(source, select.table, name)
+        return exp.DataType.build("unknown")
+
+
+def _outer_scopes(scope):
+    """The scope, and the scopes it's nested in that its columns can come from, if it's a subquery"""
+    yield scope
+    while scope.is_subquery and scope.parent is not None:
+        scope = scope.parent
+        yield scope
+
+
+def _leftmost(scope):
+    """The scope of the first select of a union, which names its columns"""
+    while scope.union_scopes:
+        scope = scope.union_scopes[0]
+    return scope
@@ -0,0 +1,102 @@
+"""Dune query parameters, like `{{ start date }}`, as tokens and nodes of the query AST
+
+A parameter on its own is tokenized as a parameter token (like `@name` in some dialects), and parsed as a
+`QueryParameter` node wherever SQLGlot accepts placeholders: as an expression, a table name, an interval unit, and so
+on. A parameter that is part of a word, like `erc20_{{chain}}`, is kept in the name of the identifier. Parameters in
+strings, quoted identifiers and comments are just part of their text. Either way, a parameter is generated exactly as
+it was written."""
+import re
+
+from sqlglot import TokenType, exp
+
+
+class QueryParameter(exp.Expression):
+    """A Dune query parameter, with `this` being the parameter as it was written, braces included"""
+
+    arg_types = {"this": True}
+
+
+def is_parameter(text):
+    """Whether the text is a parameter, like `{{ start date }}`"""
+    return _parameter_end(text, 0) == len(text)
+
+
+def _parameter_end(sql, start):
+    """The index after the parameter that starts at `start` in `sql`, or None if there isn't one
+
+    Like the Dune query editor, a parameter can't span lines."""
+    if not sql.startswith("{{", start):
+        return None
+    end = sql.find("}}", start + 2)
+    if end == -1 or "\n" in sql[start:end]:
+        return None
+    return end + 2
+
+
+class ParameterTokenizer:
+    """A tokenizer mixin, that tokenizes parameters as parameter tokens, and keeps parameters in words in the word"""
+
+    def _scan_keywords(self):
+        end = _parameter_end(self.sql, self._current - 1)
+        if end is None:
+            return super()._scan_keywords()
+        self._advance(end - self._current)
+        self._scan_var()
+
+    def _scan_var(self):
+        while True:
+            end = _parameter_end(self.sql, self._current) if self._peek == "{" else None
+            if end is not None:
+                self._advance(end - self._current)
+                continue
+            char = self._peek.strip()
+            if char and (char in self.VAR_SINGLE_TOKENS or char not in self.SINGLE_TOKENS):
+                self._advance(alnum=True)
+            else:
+                break
+
+        text = self._text
+        if is_parameter(text):
+            self._add(TokenType.PARAMETER)
+        elif "{{" in text:
+            self._add(TokenType.VAR)
+        elif (
+            self.tokens and self.tokens[-1].token_type == TokenType.PARAMETER and not is_parameter(self.tokens[-1].text)
+        ):
+            self._add(TokenType.VAR)  # like `@name`
+        else:
+            self._add(self.KEYWORDS.get(text.upper(), TokenType.VAR))
+
+
+def placeholder_parsers(parser_class):
+    """The placeholder parsers of the parser class, with parameter tokens that are Dune parameters parsed as such"""
+    parse_parameter = parser_class.PLACEHOLDER_PARSERS[TokenType.PARAMETER]
+
+    def _parse_parameter(self):
+        if is_parameter(self._prev.text):
+            return self.expression(QueryParameter, this=self._prev.text)
+        return parse_parameter(self)
+
+    return {**parser_class.PLACEHOLDER_PARSERS, TokenType.PARAMETER: _parse_parameter}
+
+
+def parameter_sql(self, expression):
+    return expression.this
+
+
+_parameter_regex = re.compile(r"{{([^}\n]*)}}")
+
+
+def parameter_names(expression):
+    """The names of the parameters in the expression, like `start date` for `{{ start date }}`, each once, in the
+    order the tree is walked depth first
+
+    Parameters are found wherever they're kept: as parameter nodes, in names, and in strings."""
+    names = {}
+    stack = [expression]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, (QueryParameter, exp.Identifier, exp.Literal, exp.Var)) and "{{" in node.name:
+            names.update((name.strip(), None) for name in _parameter_regex.findall(node.name))
+        stack.extend(reversed([child for _, child in node.iter_expressions()]))
+    return list(names)
@@ -0,0 +1,206 @@
+"""A compact binary form of query trees, to pass them between processes without generating and parsing SQL
+
+Pickling a SQLGlot tree recurses once per level of the tree, and stores every node as a dictionary of its arguments.
+`dumps` writes the nodes of the tree one after the other instead, breadth first, each as a few variable-length
+integers: the class of the node, and for each of its arguments, the name of the argument and its value. Class names,
+argument names and strings are stored once, and referred to by their index. Like pickle, `loads` must only be given
+data from a trusted source."""
+import importlib
+import marshal
+from collections import deque
+from enum import Enum
+from functools import lru_cache
+
+from sqlglot import exp
+
+# Bumped whenever the layout changes, so that data from another version is rejected rather than misread
+FORMAT_VERSION = 1
+
+# The tags of argument values, followed by: nothing, the index of a node, the index of a string, an integer, the
+# length and values of a list, the indices of the class and member name of an enum, or a marshalled value
+_NONE, _FALSE, _TRUE, _NODE, _STR, _INT, _LIST, _ENUM, _OTHER = range(9)
+
+# Flags of the optional parts of a node, written after its class
+_COMMENTS, _TYPE, _META = 1, 2, 4
+
+# Modules that classes of nodes and enums can be loaded from
+_MODULES = ("sqlglot.", "dune.harmonizer.")
+
+
+def dumps(expression):
+    """The expression, with all its descendants, as bytes"""
+    strings = {}
+    out = bytearray()
+    queue = deque([expression])
+    numbered = {id(expression): 0}
+
+    def write_int(n):
+        # Unsigned LEB128
+        while n > 0x7F:
+            out.append(n & 0x7F | 0x80)
+            n >>= 7
+        out.append(n)
+
+    def write_str(text):
+        write_int(strings.setdefault(text, len(strings)))
+
+    def write_node(node):
+        # Nodes are numbered as they're found, and written in that order
+        if id(node) not in numbered:
+            numbered[id(node)] = len(numbered)
+            queue.append(node)
+        write_int(numbered[id(node)])
+
+    def write_value(value):
+        if value is None or value is False or value is True:
+            out.append(_NONE if value is None else _TRUE if value else _FALSE)
+        elif isinstance(value, exp.Expression):
+            out.append(_NODE)
+            write_node(value)
+        elif type(value) is str:
+            out.append(_STR)
+            write_str(value)
+        elif type(value) is int:
+            out.append(_INT)
+            write_int(value << 1 if value >= 0 else (-value << 1) - 1)
+        elif type(value) is list:
+            out.append(_LIST)
+            write_int(len(value))
+            for item in value:
+                write_value(item)
+        elif isinstance(value, Enum):
+            out.append(_ENUM)
+            write_str(_class_path(type(value)))
+            write_str(value.name)
+        else:
+            out.append(_OTHER)
+            data = marshal.dumps(value)
+            write_int(len(data))
+            out.extend(data)
+
+    while queue:
+        node = queue.popleft()
+        write_str(_class_path(type(node)))
+        flags = (
+            (_COMMENTS if node.comments else 0)
+            | (_TYPE if node._type is not None else 0)
+            | (_META if node._meta is not None else 0)
+        )
+        out.append(flags)
+        if flags & _COMMENTS:
+            write_value(node.comments)
+        if flags & _TYPE:
+            write_node(node._type)
+        if flags & _META:
+            write_value(node._meta)
+        # Arguments that are None are left out, as they are when comparing or generating nodes
+        args = [(key, value) for key, value in node.args.items() if value is not None]
+        write_int(len(args))
+        for key, value in args:
+            write_str(key)
+            write_value(value)
+    return marshal.dumps((FORMAT_VERSION, tuple(strings), bytes(out)))
+
+
+def loads(data):
+    """The expression that `dumps` gave the bytes of"""
+    version, strings, data = marshal.loads(data)
+    if version != FORMAT_VERSION:
+        raise ValueError(f"Unsupported tree format version: {version}")
+    position = 0
+
+    def read_int():
+        nonlocal position
+        n = shift = 0
+        while True:
+            byte = data[position]
+            position += 1
+            n |= (byte & 0x7F) << shift
+            if byte < 0x80:
+                return n
+            shift += 7
+
+    def read_value():
+        nonlocal position
+        tag = data[position]
+        position += 1
+        if tag <= _TRUE:
+            return None if tag == _NONE else tag == _TRUE
+        if tag == _NODE:
+            return _Ref(read_int())
+        if tag == _STR:
+            return strings[read_int()]
+        if tag == _INT:
+            n = read_int()
+            return -((n + 1) >> 1) if n & 1 else n >> 1
+        if tag == _LIST:
+            return [read_value() for _ in range(read_int())]
+        if tag == _ENUM:
+            cls = _load_class(strings[read_int()])
+            return cls[strings[read_int()]]
+        length = read_int()
+        position += length
+        return marshal.loads(data[position - length : position])
+
+    # Nodes only refer to nodes after them, so all nodes are read first, and then linked to their children
+    nodes = []
+    records = []
+    while position < len(data):
+        node = _load_class(strings[read_int()])()
+        flags = data[position]
+        position += 1
+        if flags & _COMMENTS:
+            node.comments = read_value()
+        type_ref = read_int() if flags & _TYPE else None
+        if flags & _META:
+            node._meta = read_value()
+        args = [(strings[read_int()], read_value()) for _ in range(read_int())]
+        nodes.append(node)
+        records.append((type_ref, args))
+
+    def link(value, node, key):
+        if type(value) is _Ref:
+            child = nodes[value.index]
+            child.parent = node
+            child.arg_key = key
+            return child
+        if type(value) is list:
+            return [link(item, node, key) for item in value]
+        return value
+
+    for node, (type_ref, args) in zip(nodes, records):
+        if type_ref is not None:
+            node._type = nodes[type_ref]
+        for key, value in args:
+            node.args[key] = link(value, node, key)
+    return nodes[0]
+
+
+class _Ref:
+    """A reference to a node that's read later"""
+
+    __slots__ = ("index",)
+
+    def __init__(self, index):
+        self.index = index
+
+
+def _class_path(cls):
+    # Most classes are SQLGlot expressions, which are stored by their name alone
+    if cls.__module__ == exp.__name__:
+        return cls.__qualname__
+    return f"{cls.__module__}:{cls.__qualname__}"
+
+
+@lru_cache(maxsize=None)
+def _load_class(path):
+    module_name, _, qualname = path.rpartition(":")
+    module_name = module_name or exp.__name__
+    if not module_name.startswith(_MODULES):
+        raise ValueError(f"Not a class of query trees: {path}")
+    cls = importlib.import_module(module_name)
+    for attribute in qualname.split("."):
+        cls = getattr(cls, attribute, None)
+    if not (isinstance(cls, type) and issubclass(cls, (exp.Expression, Enum))):
+        raise ValueError(f"Not a class of query trees: {path}")
+    return cls
@@ -2,12 +2,15 @@ import re
 
 from sqlglot import exp
 
+from dune.harmonizer.dunesql.traversal import transform
 
-def replace_0x_strings_with_hex_strings(expression: exp.Expression):
-    """Recursively replace string literals starting with '0x' with the equivalent HexString"""
-    return expression.transform(
-        lambda e: exp.HexString(this=e.this[2:])
-        if isinstance(e, exp.Literal) and e.is_string and e.this.startswith("0x")
+
+def hex_string_of_0x_string(e: exp.Expression):
+    """A HexString for a string literal starting with '0x'"""
+    if (
+        isinstance(e, exp.Literal)
+        and e.is_string
+        and e.this.startswith("0x")
         # workaround for optimization: don't force hex string in binary expressions if we have type information
         and not (
             (
@@ -18,44 +21,58 @@ def replace_0x_strings_with_hex_strings(expression: exp.Expression):
             or isinstance(e.parent, exp.Unhex)
             or (isinstance(e.parent, exp.Cast) and e.parent.this.type is not None)
         )
-        else e
-    )
+    ):
+        return exp.HexString(this=e.this[2:])
+    return e
+
+
+def replace_0x_strings_with_hex_strings(expression: exp.Expression):
+    """Recursively replace string literals starting with '0x' with the equivalent HexString"""
+    return transform(expression, hex_string_of_0x_string)
+
+
+def remove_call_on_hex_string(e: exp.Expression):
+    """The hex string in a LOWER(), FROM_HEX(), or (TRY)CAST to varbinary of a hex string"""
+    if isinstance(e.this, exp.HexString) and (
+        isinstance(e, (exp.Lower, exp.Unhex))
+        or (isinstance(e, (exp.Cast, exp.TryCast)) and e.to.this == exp.DataType.Type.VARBINARY)
+    ):
+        return e.this
+    return e
 
 
 def remove_calls_on_hex_strings(expression: exp.Expression):
     """Remove LOWER(), FROM_HEX(), and (TRY)CAST functions used on hex strings, since hex strings are varbinary"""
-    return expression.transform(
-        lambda e: e.this
-        if isinstance(e.this, exp.HexString)
-        and (
-            isinstance(e, (exp.Lower, exp.Unhex))
-            or (isinstance(e, (exp.Cast, exp.TryCast)) and e.to.this == exp.DataType.Type.VARBINARY)
-        )
-        else e
-    )
+    return transform(expression, remove_call_on_hex_string)
+
+
+def rename_bytea2numeric_call(e: exp.Expression):
+    if isinstance(e, exp.Anonymous) and e.name.lower() == "bytea2numeric":
+        return exp.Anonymous(this="bytearray_to_bigint", expressions=e.expressions)
+    return e
 
 
 def rename_bytea2numeric_to_bytearray_to_bigint(expression: exp.Expression):
     """Rename our custom UDF `bytea2numeric` to our Trino function `bytearray_to_bigint`"""
-    return expression.transform(
-        lambda e: exp.Anonymous(this="bytearray_to_bigint", expressions=e.expressions)
-        if isinstance(e, exp.Anonymous) and e.name.lower() == "bytea2numeric"
-        else e
-    )
+    return transform(expression, rename_bytea2numeric_call)
+
+
+def cast_boolean_string(e: exp.Expression):
+    if (
+        isinstance(e, exp.Literal)
+        and e.is_string
+        and (e.this.lower() == "true" or e.this.lower() == "false")
+        and (not isinstance(e.parent, exp.Cast))
+    ):
+        return exp.Boolean(this=True if e.this.lower() == "true" else False)
+    return e
 
 
 def cast_boolean_strings(expression: exp.Expression):
     """Explicitly cast strings with booleans in them to booleans
 
     Spark and Postgres implicitly convert strings with 'true' or 'false' into booleans when needed"""
-    return expression.transform(
-        lambda e: exp.Boolean(this=True if e.this.lower() == "true" else False)
-        if isinstance(e, exp.Literal)
-        and e.is_string
-        and (e.this.lower() == "true" or e.this.lower() == "false")
-        and (not isinstance(e.parent, exp.Cast))
-        else e
-    )
+    return transform(expression, cast_boolean_string)
 
 
 date_regex = re.compile(r"^\d{4}-\d{2}-\d{2}$")
@@ -67,47 +84,72 @@ def _looks_like_timestamp(e: str):
     return timestamp_regex.match(e) or timestamp_regex_seconds.match(e) or date_regex.match(e)
 
 
+def cast_date_string(e: exp.Expression):
+    if (
+        isinstance(e, exp.Literal)
+        and e.is_string
+        and _looks_like_timestamp(e.this)
+        and (not isinstance(e.parent, exp.Cast))
+    ):
+        return exp.Cast(this=e, to=exp.DataType.build("timestamp"))
+    return e
+
+
 def cast_date_strings(expression: exp.Expression):
     """Explicitly cast all strings that look like timestamps to timestamps
 
     Spark and Postgres implicitly convert strings like this into timestamps when needed"""
-    return expression.transform(
-        lambda e: exp.Cast(this=e, to=exp.DataType.build("timestamp"))
-        if isinstance(e, exp.Literal)
-        and e.is_string
-        and _looks_like_timestamp(e.this)
-        and (not isinstance(e.parent, exp.Cast))
-        else e
-    )
+    return transform(expression, cast_date_string)
 
 
-def concat_of_hex_string_to_bytearray_concat(expression: exp.Expression):
-    """Replace any CONCAT call with bytearray_concat function call if arguments are hex strings"""
-    return expression.transform(
-        lambda e: exp.Anonymous(this="bytearray_concat", expressions=e.expressions)
-        if isinstance(e, (exp.Concat, exp.SafeConcat))
+def concat_to_bytearray_concat_call(e: exp.Expression):
+    if (
+        isinstance(e, (exp.Concat, exp.SafeConcat))
         and all(isinstance(arg, exp.HexString) for arg in e.expressions)
         and len(e.expressions) == 2  # bytearray_concat isn't variadic; only supports 2 arguments
-        else e
-    )
+    ):
+        return exp.Anonymous(this="bytearray_concat", expressions=e.expressions)
+    return e
+
+
+def concat_of_hex_string_to_bytearray_concat(expression: exp.Expression):
+    """Replace any CONCAT call with bytearray_concat function call if arguments are hex strings"""
+    return transform(expression, concat_to_bytearray_concat_call)
+
+
+def _is_pipe_of_hex_string(e):
+    return isinstance(e, exp.DPipe) and isinstance(e.right, exp.HexString)
 
 
 def pipe_expression_to_bytearray_concat_call(e: exp.Expression):
     """Replace the pipe operator || in this expression with a bytearray_concat function call
 
-    If arguments are hex strings. Not recursive!
+    If arguments are hex strings. Not recursive! A chain of pipes like `0x01 || 0x02 || 0x03` is parsed as a
+    left-deep tree, which is walked down iteratively, so long chains don't hit the recursion limit.
     """
-    if isinstance(e, exp.DPipe) and isinstance(e.right, exp.HexString):
-        if isinstance(e.left, exp.HexString):
-            return exp.Anonymous(this="bytearray_concat", expressions=[e.left, e.right])
-        elif isinstance(e.left, exp.DPipe):
-            # call recursively on left to handle nested pipes
-            return exp.Anonymous(
-                this="bytearray_concat", expressions=[pipe_of_hex_strings_to_bytearray_concat(e.left), e.right]
-            )
-    return e
+    if not _is_pipe_of_hex_string(e):
+        return e
+    # Walk down the nested pipes on the left, until the innermost pipe of hex strings
+    pipes = [e]
+    while _is_pipe_of_hex_string(pipes[-1].left):
+        pipes.append(pipes[-1].left)
+    innermost = pipes.pop()
+    if isinstance(innermost.left, exp.HexString):
+        concat = exp.Anonymous(this="bytearray_concat", expressions=[innermost.left, innermost.right])
+    elif isinstance(innermost.left, exp.DPipe):
+        concat = exp.Anonymous(
+            this="bytearray_concat",
+            expressions=[pipe_of_hex_strings_to_bytearray_concat(innermost.left), innermost.right],
+        )
+    elif pipes:
+        concat = pipe_of_hex_strings_to_bytearray_concat(innermost)
+    else:
+        return e
+    for pipe in reversed(pipes):
+        concat = exp.Anonymous(this="bytearray_concat", expressions=[concat, pipe.right])
+    return concat
 
 
 def pipe_of_hex_strings_to_bytearray_concat(expression: exp.Expression):
     """Replace all || with bytearray_concat function call if arguments are hex strings"""
-    return expression.transform(pipe_expression_to_bytearray_concat_call)
+    return transform(expression, pipe_expression_to_bytearray_concat_call)
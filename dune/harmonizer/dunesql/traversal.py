@@ -0,0 +1,224 @@
+"""Iterative versions of SQLGlot's recursive tree traversals
+
+SQLGlot's `Expression.copy`, `Expression.transform` and `replace_children` recurse once per level of the tree,
+so they raise a RecursionError on deep trees, like the left-deep trees that parsing long chains of AND, OR or ||
+gives. The functions here do the same with an explicit stack, so they work on trees of any depth. For SQLGlot code that
+has no iterative version, like building the scopes of a query, `balanced_chains` makes those trees shallow while it
+runs."""
+from contextlib import contextmanager
+from copy import deepcopy
+
+from sqlglot import exp
+from sqlglot.helper import ensure_collection, seq_get
+
+# Returned by the `enter` function of `replace_descendants` to not visit the children of a node
+SKIP = object()
+
+
+def copy_tree(expression):
+    """A deep copy of the expression, like `expression.copy()`"""
+    root = _copy_node(expression)
+    root.parent = expression.parent
+    stack = [(expression, root)]
+    while stack:
+        node, new_node = stack.pop()
+        for key, value in node.args.items():
+            if type(value) is list:
+                new_node.args[key] = [_copy_child(item, new_node, key, stack) for item in value]
+            else:
+                new_node.args[key] = _copy_child(value, new_node, key, stack)
+    return root
+
+
+def _copy_node(node):
+    new_node = node.__class__()
+    if node.comments is not None:
+        new_node.comments = list(node.comments)
+    if node._type is not None:
+        new_node._type = node._type.copy()
+    if node._meta is not None:
+        new_node._meta = deepcopy(node._meta)
+    return new_node
+
+
+def _copy_child(value, parent, key, stack):
+    if not isinstance(value, exp.Expression):
+        return deepcopy(value)
+    child = _copy_node(value)
+    child.parent = parent
+    child.arg_key = key
+    stack.append((value, child))
+    return child
+
+
+class _Children:
+    """The state of replacing the children of a node: the argument and child that are next, and the replacements"""
+
+    def __init__(self, node, context):
+        self.node = node
+        self.context = context
+        self.args = iter(list(node.args.items()))
+        self.key = None
+        self.is_list = False
+        self.children = iter(())
+        self.replacements = None
+
+    def next_child(self):
+        """The next child expression to replace, or None when all have been replaced"""
+        while True:
+            for child in self.children:
+                if isinstance(child, exp.Expression):
+                    return child
+                self.replacements.append(child)
+            if self.replacements is not None:
+                self.node.args[self.key] = self.replacements if self.is_list else seq_get(self.replacements, 0)
+                self.replacements = None
+            arg = next(self.args, None)
+            if arg is None:
+                return None
+            self.key, value = arg
+            self.is_list = type(value) is list
+            self.children = iter(value if self.is_list else [value])
+            self.replacements = []
+
+    def replace(self, replacement):
+        for node in ensure_collection(replacement):
+            self.replacements.append(node)
+            node.parent = self.node
+            node.arg_key = self.key
+
+
+def replace_descendants(expression, enter=None, leave=None, context=None):
+    """Replace the descendants of the expression in place, visiting them depth first
+
+    This is the iterative version of recursively calling `replace_children`. `enter(node, context)` is called when
+    a node is visited, before its children, and returns its replacement and the context for replacing the children
+    of the replacement, or `SKIP` to leave them as they are. `leave(node, context)` is called after the children of
+    a node are replaced, and returns its replacement. A replacement is an expression, a list of expressions, or None
+    to remove the node."""
+    stack = [_Children(expression, context)]
+    while stack:
+        children = stack[-1]
+        child = children.next_child()
+        if child is None:
+            stack.pop()
+            if stack and leave is not None:
+                stack[-1].replace(leave(children.node, children.context))
+            elif stack:
+                stack[-1].replace(children.node)
+            continue
+        replacement, child_context = enter(child, children.context) if enter is not None else (child, context)
+        if child_context is SKIP or not isinstance(replacement, exp.Expression):
+            children.replace(replacement)
+        else:
+            stack.append(_Children(replacement, child_context))
+    return expression
+
+
+def transform(expression, fun, copy=True):
+    """Apply `fun` to every node of the tree top-down, like `expression.transform(fun, copy=copy)`
+
+    The children of a node that `fun` replaces aren't visited."""
+    node = copy_tree(expression) if copy else expression
+    new_node = fun(node)
+    if new_node is None or not isinstance(new_node, exp.Expression):
+        return new_node
+    if new_node is not node:
+        new_node.parent = node.parent
+        return new_node
+
+    def enter(node, _):
+        new_node = fun(node)
+        return new_node, (None if new_node is node else SKIP)
+
+    return replace_descendants(new_node, enter)
+
+
+def transform_post_order(expression, fun):
+    """Apply `fun` to every node of the tree in place, bottom-up, so the children of a node are replaced before it"""
+    replace_descendants(expression, leave=lambda node, _: fun(node))
+    return fun(expression)
+
+
+# Chains shorter than this are left as they are by `balanced_chains`
+_min_chain_length = 64
+
+
+@contextmanager
+def balanced_chains(expression, min_length=_min_chain_length):
+    """Make the chains of the same binary operator in the tree balanced while in the context, and restore them after
+
+    A chain of n ANDs, ORs, ||s or +s is parsed as a tree n levels deep, which recursive traversals can't walk when n
+    is in the thousands. In the context, each chain of at least `min_length` operands is a balanced tree of new
+    operator nodes over the same operands, about log2(n) levels deep. The tree can be changed in the context, except
+    for the operator nodes of the balanced trees: the chains are restored over the operands they have at the end."""
+    chains = []
+    try:
+        stack = [expression]
+        while stack:
+            node = stack.pop()
+            if not _is_link(node, type(node)) or _is_link(node.parent, type(node)) or node.parent is None:
+                stack.extend(child for _, child in node.iter_expressions())
+                continue
+            operands = _chain(node)
+            stack.extend(operand for operand, _, _ in operands)
+            if len(operands) >= min_length:
+                operators = set()
+                balanced = _balanced(type(node), [operand for operand, _, _ in operands], operators)
+                node.replace(balanced)
+                chains.append((node, operands, balanced, operators))
+        yield expression
+    finally:
+        for top, operands, balanced, operators in reversed(chains):
+            if balanced.parent is None:  # the whole chain was replaced
+                continue
+            for (_, link, key), operand in zip(operands, _operands(balanced, operators)):
+                link.set(key, operand)
+            balanced.replace(top)
+
+
+def _is_link(node, operator):
+    """Whether the node is a binary operator node of the type, with only the two operands as arguments"""
+    return (
+        type(node) is operator
+        and isinstance(node, exp.Binary)
+        and all(value is None for key, value in node.args.items() if key not in ("this", "expression"))
+    )
+
+
+def _chain(top):
+    """The operands of the chain from its top node, from left to right, each with the operator node and argument it's
+    in"""
+    operands = []
+    stack = [(top, None, None)]
+    while stack:
+        node, link, key = stack.pop()
+        if node is top or _is_link(node, type(top)):
+            stack.extend(((node.expression, node, "expression"), (node.this, node, "this")))
+        else:
+            operands.append((node, link, key))
+    return operands
+
+
+def _balanced(operator, operands, operators):
+    """A balanced tree of new `operator` nodes over the operands, which are added to `operators`"""
+    if len(operands) == 1:
+        return operands[0]
+    middle = len(operands) // 2
+    node = operator(
+        this=_balanced(operator, operands[:middle], operators),
+        expression=_balanced(operator, operands[middle:], operators),
+    )
+    operators.add(id(node))
+    return node
+
+
+def _operands(balanced, operators):
+    """The operands of a balanced tree from left to right, given the ids of its operator nodes"""
+    stack = [balanced]
+    while stack:
+        node = stack.pop()
+        if id(node) in operators:
+            stack.extend((node.expression, node.this))
+        else:
+            yield node
@@ -0,0 +1,102 @@
+from contextlib import contextmanager, nullcontext
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from time import perf_counter
+
+_observer = ContextVar("harmonizer_observer", default=None)
+_disabled = nullcontext()
+
+
+class TranslationObserver:
+    """Receives timings and counters from translations
+
+    Subclass this and override the methods for the events you're interested in, then pass an instance to the
+    `translate_` functions as `observer`, or use `observe` to set it for a block of code."""
+
+    def on_stage(self, stage: str, seconds: float):
+        """Called after each stage of a translation: parse, transforms, spell_fixes, generate and postprocess"""
+
+    def on_rule(self, rule: str, seconds: float, nodes_visited: int, nodes_rewritten: int):
+        """Called for each transform rule, after the traversal of the query tree that applied it
+
+        Rewritten nodes are those the rule replaced with a new node; changes made in place aren't counted.
+        Rules that were skipped, since they can't apply to the query, are reported as visiting no nodes."""
+
+
+@dataclass
+class RuleStats:
+    calls: int = 0
+    seconds: float = 0.0
+    nodes_visited: int = 0
+    nodes_rewritten: int = 0
+
+
+@dataclass
+class TranslationStats(TranslationObserver):
+    """An observer that sums up the time per stage, and the time and counters per rule, over all translations"""
+
+    stages: dict[str, float] = field(default_factory=dict)
+    rules: dict[str, RuleStats] = field(default_factory=dict)
+
+    def on_stage(self, stage, seconds):
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def on_rule(self, rule, seconds, nodes_visited, nodes_rewritten):
+        stats = self.rules.setdefault(rule, RuleStats())
+        stats.calls += 1
+        stats.seconds += seconds
+        stats.nodes_visited += nodes_visited
+        stats.nodes_rewritten += nodes_rewritten
+
+
+@contextmanager
+def observe(observer):
+    """Report the translations done in this block (in this thread or asyncio task) to the observer"""
+    token = _observer.set(observer)
+    try:
+        yield observer
+    finally:
+        _observer.reset(token)
+
+
+def current_observer():
+    return _observer.get()
+
+
+class _TimedStage:
+    def __init__(self, observer, name):
+        self.observer = observer
+        self.name = name
+
+    def __enter__(self):
+        self.start = perf_counter()
+
+    def __exit__(self, *exc_info):
+        self.observer.on_stage(self.name, perf_counter() - self.start)
+
+
+def stage(name):
+    """Time a stage of the translation and report it to the current observer, if there is one"""
+    observer = _observer.get()
+    if observer is None:
+        return _disabled
+    return _TimedStage(observer, name)
+
+
+class RuleCounter:
+    """Wraps a rule's transform to count the nodes it visits and rewrites, and the time it takes"""
+
+    def __init__(self, transform):
+        self.transform = transform
+        self.seconds = 0.0
+        self.nodes_visited = 0
+        self.nodes_rewritten = 0
+
+    def __call__(self, node):
+        start = perf_counter()
+        new_node = self.transform(node)
+        self.seconds += perf_counter() - start
+        self.nodes_visited += 1
+        if new_node is not node:
+            self.nodes_rewritten += 1
+        return new_node
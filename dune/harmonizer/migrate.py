@@ -0,0 +1,310 @@
+"""Translate a whole corpus of saved queries into a SQLite database of results, resuming where a previous run stopped
+
+The corpus is a file of JSON lines like the input of the `harmonizer` command, or with `--table`, a table in a SQLite
+database with the same columns: `id` and `query`, and optionally `dialect`, `dataset` and `syntax_only`. It is split
+into shards of consecutive queries, which are translated by a pool of worker processes. The results of a shard are
+written to the results database in one transaction, along with a checkpoint of the shard, so a run that crashed or
+was stopped is resumed by running it again with the same arguments: only the shards without a checkpoint are
+translated.
+
+The results database has a `results` table, with the position of each query in the corpus, its id, and either the
+translated query or the error, the error type and class (`error_class`), and the time the translation took. At the
+end, a summary of the results is printed: the throughput of the run, the percentiles of the translation times, and
+the number of translation errors of each class.
+
+    python -m dune.harmonizer.migrate queries.jsonl results.db --workers 8
+"""
+import argparse
+import itertools
+import json
+import os
+import re
+import sqlite3
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, as_completed, wait
+from contextlib import closing
+from dataclasses import dataclass, field
+from typing import Optional
+
+from dune.harmonizer.batch import translate_line, translate_record
+from dune.harmonizer.cache import harmonizer_version
+from dune.harmonizer.constants import SQLGLOT_POSTGRES
+from dune.harmonizer.errors import DuneTranslationError
+from dune.harmonizer.table_replacements import TableMappingIndex
+
+_schema = """
+create table if not exists settings (name text primary key, value text);
+create table if not exists shards (shard integer primary key, queries integer, seconds real, finished_at real);
+create table if not exists results (
+    position integer primary key,
+    shard integer,
+    id,
+    query text,
+    error text,
+    error_type text,
+    error_class text,
+    seconds real
+);
+"""
+
+_percentiles = (50, 90, 99, 99.9)
+
+
+@dataclass
+class MigrationSummary:
+    """The results of a corpus in a results database, and the throughput of the run that finished it"""
+
+    queries: int = 0
+    errors: int = 0
+    # Queries translated by this run, and the time it took, which exclude the shards of earlier runs
+    run_queries: int = 0
+    run_seconds: float = 0.0
+    # Percentiles of the translation time of a query, in seconds
+    latency: dict = field(default_factory=dict)
+    # Number of errors by error class, for `DuneTranslationError`s, and by error type for any other errors
+    error_classes: dict = field(default_factory=dict)
+    error_types: dict = field(default_factory=dict)
+
+    @property
+    def queries_per_second(self):
+        return self.run_queries / self.run_seconds if self.run_seconds else 0.0
+
+    def format(self, max_error_classes=20):
+        lines = [
+            f"queries: {self.queries}, errors: {self.errors}",
+            f"this run: {self.run_queries} queries in {self.run_seconds:.1f}s ({self.queries_per_second:.1f}/s)",
+            "latency: " + ", ".join(f"p{p:g} {seconds * 1000:.1f}ms" for p, seconds in self.latency.items()),
+        ]
+        if self.error_types:
+            lines.append("errors by type:")
+            lines.extend(f"  {count:>8} {error_type}" for error_type, count in self.error_types.items())
+        if self.error_classes:
+            lines.append(f"{DuneTranslationError.__name__} by class:")
+            classes = list(self.error_classes.items())
+            lines.extend(f"  {count:>8} {error_class}" for error_class, count in classes[:max_error_classes])
+            if len(classes) > max_error_classes:
+                lines.append(f"  {sum(count for _, count in classes[max_error_classes:]):>8} (other classes)")
+        return "\n".join(lines)
+
+
+def error_class(detail):
+    """The class of a translation error: the first line of its message, with numbers left out
+
+    This leaves out the part of the query that the message of a parse error goes on with."""
+    first_line = detail.split("\n", 1)[0]
+    return re.sub(r"\d+", "N", first_line).strip()
+
+
+def migrate(
+    input_path,
+    results_path,
+    input_table=None,
+    workers=None,
+    shard_size=1000,
+    dialect=SQLGLOT_POSTGRES,
+    dataset="ethereum",
+    table_mapping_index: Optional[TableMappingIndex] = None,
+    max_in_flight=None,
+):
+    """Translate the queries in the corpus at `input_path` into the results database at `results_path`
+
+    The corpus is a file of JSON lines, or the table `input_table` in a SQLite database. Shards that have been
+    translated into the results database before are skipped. With `workers=1`, the queries are translated in the
+    current process, otherwise over a pool of `workers` processes, with at most `max_in_flight` shards read ahead.
+    Returns the `MigrationSummary` of the results database."""
+    start = time.perf_counter()
+    run_queries = 0
+    with closing(_connect(results_path)) as connection:
+        _check_settings(connection, input_path, input_table, shard_size, dialect, dataset, table_mapping_index)
+        done = {shard for shard, in connection.execute("select shard from shards")}
+        shards = (
+            (shard, records)
+            for shard, records in enumerate(_shards(_read_records(input_path, input_table), shard_size))
+            if shard not in done
+        )
+        args = (shard_size, dialect, dataset, table_mapping_index)
+        if workers == 1:
+            translated = (_translate_shard(shard, records, *args) for shard, records in shards)
+        else:
+            translated = _translate_shards(shards, args, workers, max_in_flight)
+        for shard, results, seconds in translated:
+            _write_shard(connection, shard, results, seconds)
+            run_queries += len(results)
+        summary = summarize(connection)
+    summary.run_queries = run_queries
+    summary.run_seconds = time.perf_counter() - start
+    return summary
+
+
+def _translate_shards(shards, args, workers, max_in_flight):
+    """Translate shards over a pool of processes, yielding each as soon as it's done"""
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        max_in_flight = max_in_flight or 2 * (workers or os.cpu_count() or 1)
+        in_flight = set()
+        for shard, records in shards:
+            in_flight.add(pool.submit(_translate_shard, shard, records, *args))
+            while len(in_flight) >= max_in_flight:
+                done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                yield from (future.result() for future in done)
+        yield from (future.result() for future in as_completed(in_flight))
+
+
+def _translate_shard(shard, records, shard_size, dialect, dataset, table_mapping_index):
+    start = time.perf_counter()
+    results = []
+    for position, record in enumerate(records, start=shard * shard_size):
+        if isinstance(record, str):
+            result = translate_line(record, dialect, dataset, table_mapping_index)
+        else:
+            result = translate_record(record, dialect, dataset, table_mapping_index)
+        result["position"] = position
+        if result.get("error_type") == DuneTranslationError.__name__:
+            result["error_class"] = error_class(result["error"])
+        results.append(result)
+    return shard, results, time.perf_counter() - start
+
+
+def _write_shard(connection, shard, results, seconds):
+    # The results and the checkpoint of a shard are written together, or not at all
+    with connection:
+        connection.executemany(
+            "insert or replace into results values (?, ?, ?, ?, ?, ?, ?, ?)",
+            [
+                (
+                    r["position"],
+                    shard,
+                    _sqlite_value(r["id"]),
+                    r.get("query"),
+                    r.get("error"),
+                    r.get("error_type"),
+                    r.get("error_class"),
+                    r["seconds"],
+                )
+                for r in results
+            ],
+        )
+        connection.execute("insert into shards values (?, ?, ?, ?)", (shard, len(results), seconds, time.time()))
+
+
+def summarize(results):
+    """The `MigrationSummary` of a results database, given as a path or a connection"""
+    if not isinstance(results, sqlite3.Connection):
+        with closing(sqlite3.connect(results)) as connection:
+            return summarize(connection)
+    latencies = [seconds for seconds, in results.execute("select seconds from results order by seconds")]
+    summary = MigrationSummary(
+        queries=len(latencies),
+        errors=results.execute("select count(*) from results where error_type is not null").fetchone()[0],
+        latency={p: latencies[min(len(latencies) - 1, int(len(latencies) * p / 100))] for p in _percentiles}
+        if latencies
+        else {},
+    )
+    summary.error_classes = dict(
+        results.execute(
+            "select error_class, count(*) as n from results where error_class is not null "
+            "group by error_class order by n desc, error_class"
+        )
+    )
+    summary.error_types = dict(
+        results.execute(
+            "select error_type, count(*) as n from results where error_type is not null "
+            "group by error_type order by n desc, error_type"
+        )
+    )
+    return summary
+
+
+def _connect(path):
+    connection = sqlite3.connect(path)
+    connection.execute("pragma journal_mode=wal")
+    connection.executescript(_schema)
+    return connection
+
+
+def _check_settings(connection, input_path, input_table, shard_size, dialect, dataset, table_mapping_index):
+    """Record the settings that the shards depend on, and check that a resumed run has the same ones
+
+    Besides the corpus and its sharding, that's the translation settings and the version of the harmonizer, so that a
+    resumed run doesn't mix the results of two configurations. The table mappings are recorded by their digest."""
+    settings = {
+        "input": str(input_path),
+        "input_table": input_table or "",
+        "shard_size": str(shard_size),
+        "dialect": dialect,
+        "dataset": dataset or "",
+        "table_mapping_digest": table_mapping_index.digest if table_mapping_index is not None else "",
+        "harmonizer_version": harmonizer_version(),
+    }
+    with connection:
+        stored = dict(connection.execute("select name, value from settings"))
+        for name, value in settings.items():
+            if name in stored and stored[name] != value:
+                raise ValueError(f"The results database was started with {name} {stored[name]!r}, not {value!r}")
+        connection.executemany("insert or ignore into settings values (?, ?)", settings.items())
+
+
+def _read_records(path, table=None):
+    """The records of the corpus, in order: JSON lines, which are parsed by the workers, or rows as dictionaries"""
+    if table is None:
+        with open(path) as f:
+            yield from (line for line in f if line.strip())
+        return
+    with closing(sqlite3.connect(path)) as connection:
+        connection.row_factory = sqlite3.Row
+        for row in connection.execute(f"select * from {table} order by rowid"):
+            # A column that is null is left out, so the default applies
+            yield {key: row[key] for key in row.keys() if row[key] is not None}
+
+
+def _shards(records, shard_size):
+    while True:
+        shard = list(itertools.islice(records, shard_size))
+        if not shard:
+            return
+        yield shard
+
+
+def _sqlite_value(value):
+    # Ids are usually numbers or strings, anything else is stored as JSON
+    if value is None or isinstance(value, (int, float, str)):
+        return value
+    return json.dumps(value)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m dune.harmonizer.migrate",
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument("input", help="file with JSON lines of queries, or SQLite database with --table")
+    parser.add_argument("results", help="SQLite database to write the results to, and resume from")
+    parser.add_argument("--table", help="table with the queries, if the input is a SQLite database")
+    parser.add_argument("-j", "--workers", type=int, help="number of worker processes (default: one per CPU)")
+    parser.add_argument("--shard-size", type=int, default=1000, help="number of queries in a shard")
+    parser.add_argument("--max-in-flight", type=int, help="max number of shards being translated at once")
+    parser.add_argument("--dialect", default=SQLGLOT_POSTGRES, help="dialect for queries that don't set one")
+    parser.add_argument("--dataset", default="ethereum", help="dataset for queries that don't set one")
+    parser.add_argument("--table-mapping-file", help="JSON file or SQLite database to load the table mappings from")
+    parser.add_argument("--table-mapping-table", help="table with the table mappings, if the file is a SQLite database")
+    args = parser.parse_args(argv)
+
+    table_mapping_index = None
+    if args.table_mapping_file:
+        table_mapping_index = TableMappingIndex.load(args.table_mapping_file, args.table_mapping_table)
+    summary = migrate(
+        args.input,
+        args.results,
+        input_table=args.table,
+        workers=args.workers,
+        shard_size=args.shard_size,
+        dialect=args.dialect,
+        dataset=args.dataset,
+        table_mapping_index=table_mapping_index,
+        max_in_flight=args.max_in_flight,
+    )
+    print(summary.format())
+
+
+if __name__ == "__main__":
+    main()
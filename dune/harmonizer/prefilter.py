@@ -0,0 +1,209 @@
+"""Find constructs that we know can't be translated, by scanning the tokens of a query, before it's parsed
+
+Parsing and transforming a query costs a lot more than tokenizing it, and some queries are bound to fail, like those
+with `encode(x, 'hex')`, which DuneSQL has no equivalent of. Each `PrefilterRule` looks for one such construct in the
+tokens of the query, and either rejects the query, with the same error its translation would end with, or flags it,
+with a description of the problem. Translation checks the rules that reject before parsing the query, so those queries
+fail fast, and `scan` returns all the matches, to classify the queries of a corpus without translating them. Since
+the query isn't parsed, a query that is rejected and also has a syntax error fails with the error of the rule, not the
+parse error its translation would end with.
+
+The rules are in `prefilter_rules`, which more rules can be added to. A query is only tokenized if it contains one of
+the words of a rule, so queries without any of them pay for a substring search per word.
+"""
+import re
+from dataclasses import dataclass
+from typing import Callable, Optional
+
+from sqlglot import exp
+from sqlglot.dialects.dialect import Dialect
+from sqlglot.tokens import Token, TokenType
+
+from dune.harmonizer.custom_transforms import generated_view_warning
+from dune.harmonizer.dunesql.dunepostgres import DunePostgres, bytea_to_hex_strings
+from dune.harmonizer.dunesql.dunespark import DuneSpark
+from dune.harmonizer.errors import DuneTranslationError
+from dune.harmonizer.instrumentation import stage
+
+
+@dataclass(frozen=True)
+class PrefilterRule:
+    """A check of the tokens of a query, which returns the detail of the problem it finds, or None
+
+    The rule is only checked on queries that contain one of its `words` (in lower case), or on every query if it has
+    none. A rule that rejects must only match queries whose translation fails, and return the detail of the
+    `DuneTranslationError` it fails with; that's the error the translation raises instead. A rule that doesn't
+    reject only flags the query, for `scan`."""
+
+    name: str
+    match: Callable[[list[Token]], Optional[str]]
+    words: tuple[str, ...] = ()
+    reject: bool = False
+
+    def might_match(self, lowered_query):
+        return not self.words or any(word in lowered_query for word in self.words)
+
+
+@dataclass(frozen=True)
+class PrefilterMatch:
+    rule: str
+    detail: str
+    reject: bool
+
+
+def _arguments(tokens, start):
+    """The arguments of the function call with its opening parenthesis at `start`, as lists of tokens, or None if
+    there's no call there"""
+    if start >= len(tokens) or tokens[start].token_type != TokenType.L_PAREN:
+        return None
+    arguments = [[]]
+    depth = 0
+    for token in tokens[start:]:
+        if token.token_type in (TokenType.L_PAREN, TokenType.L_BRACKET):
+            depth += 1
+            if depth == 1:
+                continue
+        elif token.token_type in (TokenType.R_PAREN, TokenType.R_BRACKET):
+            depth -= 1
+            if depth == 0:
+                return arguments
+        elif token.token_type == TokenType.COMMA and depth == 1:
+            arguments.append([])
+            continue
+        arguments[-1].append(token)
+    return None
+
+
+# Only plain names of charsets, since other strings could be changed by the translation, like '0x...', dates or
+# booleans
+_charset_name = re.compile(r"(?!(?:true|false)$)[a-z][a-z0-9_-]*", re.IGNORECASE)
+
+
+def unsupported_charset(tokens):
+    """`encode` and `decode` with a charset other than UTF-8, which DuneSQL has no functions for"""
+    for i, token in enumerate(tokens):
+        if token.token_type != TokenType.VAR or token.text.lower() not in ("encode", "decode"):
+            continue
+        # A call like x.encode(...) is a different function
+        if i > 0 and tokens[i - 1].token_type == TokenType.DOT:
+            continue
+        arguments = _arguments(tokens, i + 1)
+        if arguments is None or len(arguments) != 2 or not arguments[0] or len(arguments[1]) != 1:
+            continue
+        charset = arguments[1][0]
+        if charset.token_type == TokenType.STRING and _charset_name.fullmatch(charset.text):
+            if charset.text.lower() != "utf-8":
+                # The message of the error that generating DuneSQL raises for these functions
+                return f"Unsupported charset {exp.Literal.string(charset.text)}"
+    return None
+
+
+# Keywords that are often meant as column names, but can't be used as names without quotes
+_name_keywords = {
+    "always",
+    "cube",
+    "glob",
+    "lock",
+    "overlaps",
+    "qualify",
+    "regexp",
+    "replace",
+    "returning",
+    "rlike",
+    "rollback",
+    "rollup",
+    "use",
+}
+_names = {TokenType.VAR, TokenType.IDENTIFIER, TokenType.STRING}
+_before_name = {
+    TokenType.L_PAREN,
+    TokenType.COMMA,
+    TokenType.SELECT,
+    TokenType.WHERE,
+    TokenType.AND,
+    TokenType.OR,
+    TokenType.GROUP_BY,
+    TokenType.ORDER_BY,
+}
+_after_name = {
+    TokenType.R_PAREN,
+    TokenType.COMMA,
+    TokenType.FROM,
+    TokenType.EQ,
+    TokenType.NEQ,
+    TokenType.GT,
+    TokenType.GTE,
+    TokenType.LT,
+    TokenType.LTE,
+    TokenType.SEMICOLON,
+}
+
+
+def keyword_as_name(tokens):
+    """A keyword used as a column name, where a name is expected, which fails to parse"""
+    for i, token in enumerate(tokens):
+        if token.token_type in _names or token.text.lower() not in _name_keywords:
+            continue
+        if i == 0 or tokens[i - 1].token_type not in _before_name:
+            continue
+        if i + 1 == len(tokens) or tokens[i + 1].token_type in _after_name:
+            return f"{token.text} is a keyword, and needs to be quoted to be used as a name"
+    return None
+
+
+def generated_view(tokens):
+    """Views in dune_user_generated, which don't exist in DuneSQL, and get a warning in the translated query"""
+    if any(token.text.lower() == "dune_user_generated" for token in tokens):
+        return generated_view_warning
+    return None
+
+
+prefilter_rules = [
+    PrefilterRule("unsupported_charset", unsupported_charset, words=("encode", "decode"), reject=True),
+    PrefilterRule("keyword_as_name", keyword_as_name, words=tuple(sorted(_name_keywords))),
+    PrefilterRule("generated_view", generated_view, words=("dune_user_generated",)),
+]
+
+
+def _tokenize(query, sqlglot_dialect):
+    """The tokens of the query, like parsing it would see them, or None if it can't be tokenized"""
+    try:
+        if sqlglot_dialect == "postgres":
+            return DunePostgres().tokenize(bytea_to_hex_strings(query))
+        elif sqlglot_dialect == "spark":
+            return DuneSpark().tokenize(query)
+        return Dialect.get_or_raise(sqlglot_dialect)().tokenize(query)
+    except ValueError:
+        # Like an unterminated string, which the parse reports
+        return None
+
+
+def _matches(query, sqlglot_dialect, rules):
+    lowered = query.lower()
+    rules = [rule for rule in rules if rule.might_match(lowered)]
+    if not rules:
+        return
+    tokens = _tokenize(query, sqlglot_dialect)
+    if tokens is None:
+        return
+    for rule in rules:
+        detail = rule.match(tokens)
+        if detail is not None:
+            yield PrefilterMatch(rule.name, detail, rule.reject)
+
+
+def scan(query, sqlglot_dialect, rules=None):
+    """All the matches of the rules (by default `prefilter_rules`) in the query, in the order of the rules"""
+    return list(_matches(query, sqlglot_dialect, prefilter_rules if rules is None else rules))
+
+
+def check(query, sqlglot_dialect, rules=None):
+    """Raise the `DuneTranslationError` of the first rule that rejects the query, if any
+
+    This runs before parsing, so the error of a rule takes precedence over a syntax error elsewhere in the query."""
+    rules = [rule for rule in (prefilter_rules if rules is None else rules) if rule.reject]
+    if not any(rule.might_match(query.lower()) for rule in rules):
+        return
+    with stage("prefilter"):
+        for match in _matches(query, sqlglot_dialect, rules):
+            raise DuneTranslationError(match.detail)
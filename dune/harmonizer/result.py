@@ -0,0 +1,76 @@
+from sqlglot.errors import SqlglotError
+
+from dune.harmonizer.custom_transforms import translation_warnings
+from dune.harmonizer.dunesql import serialize
+from dune.harmonizer.dunesql.dunesql import DuneSQL, to_dunesql
+from dune.harmonizer.dunesql.parameters import parameter_names
+from dune.harmonizer.errors import DuneTranslationError
+
+
+class TranslationResult:
+    """A translated query, as a tree that is only generated as DuneSQL when its SQL is asked for
+
+    `expression` is the tree of the DuneSQL query, to optimize or inspect without parsing the SQL. `sql()` is the
+    query as DuneSQL, pretty printed by default, with the warnings the `translate_` functions put at the top of the
+    query (see `warnings`). `parameters` are the names of the Dune parameters in the query. Some constructs are only
+    found to be unsupported while generating DuneSQL, so `sql()` and `expression` can raise `DuneTranslationError`.
+
+    `to_bytes` gives a compact binary form of the result, which `from_bytes` loads without parsing any SQL. Results
+    are pickled in that form, so they can be passed between processes."""
+
+    def __init__(self, tree):
+        self._tree = tree
+        self._expression = None
+        self._sql = {}
+        self._parameters = None
+
+    @property
+    def expression(self):
+        """The translated query as a DuneSQL tree, like parsing its SQL would give"""
+        if self._expression is None:
+            self._expression = _generating(to_dunesql, self._tree)
+        return self._expression
+
+    def sql(self, pretty=True, warnings=True):
+        """The translated query as DuneSQL, with the warnings about it at the top unless `warnings=False`"""
+        if pretty not in self._sql:
+            self._sql[pretty] = _generating(self._tree.sql, dialect=DuneSQL, pretty=pretty)
+        if not warnings:
+            return self._sql[pretty]
+        return "".join(f"{warning}\n\n" for warning in self.warnings) + self._sql[pretty]
+
+    @property
+    def warnings(self):
+        """Warnings about things in the query that the translation doesn't fix, as SQL comments"""
+        return translation_warnings(self.sql(warnings=False))
+
+    @property
+    def parameters(self):
+        """The names of the Dune parameters in the query, like `start date` for `{{ start date }}`"""
+        if self._parameters is None:
+            self._parameters = parameter_names(self._tree)
+        return list(self._parameters)
+
+    def to_bytes(self):
+        return serialize.dumps(self._tree)
+
+    @classmethod
+    def from_bytes(cls, data):
+        return cls(serialize.loads(data))
+
+    def __reduce__(self):
+        return TranslationResult.from_bytes, (self.to_bytes(),)
+
+    def __str__(self):
+        return self.sql()
+
+    def __repr__(self):
+        return f"TranslationResult({self.sql(pretty=False, warnings=False)!r})"
+
+
+def _generating(fn, *args, **kwargs):
+    # Generating DuneSQL does the last transforms of the translation, so errors are reported like translation errors
+    try:
+        return fn(*args, **kwargs)
+    except SqlglotError as e:
+        raise DuneTranslationError(str(e))
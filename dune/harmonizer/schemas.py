@@ -1,8 +1,13 @@
+import os
 import sqlite3
-from collections import defaultdict
+import threading
+from collections import OrderedDict, defaultdict
 from contextlib import closing
 from itertools import groupby
 
+from sqlglot import exp
+from sqlglot.schema import TABLE_ARGS, Schema, ensure_column_mapping
+
 
 def schema_from_sqlite(path, schema_table_name):
     """Load a SQLGlot compatible dictionary of table schemas from a SQLite database.
@@ -22,3 +27,131 @@ def schema_from_sqlite(path, schema_table_name):
         for _, column_name, column_type in columns:
             schema[table_name][column_name] = column_type
     return schema
+
+
+class SQLiteSchema(Schema):
+    """A SQLGlot schema that looks up the column types of tables in a SQLite database as they're needed
+
+    The database has the same layout as for `schema_from_sqlite`. Unlike that function, this doesn't load the
+    whole table: the columns of each table are fetched the first time a query refers to it, through an index on
+    `table_name` (which is created if it's missing and the database is writable). The `max_tables` most recently
+    used tables are kept in memory.
+
+    A table is looked up by its qualified name (e.g. `ethereum.transactions`) first, then by its name only.
+    Table and column names are case insensitive.
+
+    The schema can be shared between threads, and used in forked or spawned worker processes; each thread in
+    each process gets its own connection to the database.
+    """
+
+    def __init__(self, path, schema_table_name, max_tables=1024, dialect=None):
+        self.path = str(path)
+        self.schema_table_name = schema_table_name
+        self.max_tables = max_tables
+        self.dialect = dialect
+        self._added = {}
+        self._reset()
+
+    def __getstate__(self):
+        # Only the configuration is sent to other processes, they open their own connections
+        return {
+            "path": self.path,
+            "schema_table_name": self.schema_table_name,
+            "max_tables": self.max_tables,
+            "dialect": self.dialect,
+        }
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._tables = OrderedDict()
+        self._types = {}
+
+    @property
+    def supported_table_args(self):
+        return TABLE_ARGS
+
+    @property
+    def empty(self):
+        return False
+
+    def add_table(self, table, column_mapping=None, dialect=None):
+        """Add a table that isn't in the database, or override the columns of one that is"""
+        columns = {name.lower(): column_type for name, column_type in ensure_column_mapping(column_mapping).items()}
+        self._added[_table_key(exp.maybe_parse(table, into=exp.Table, dialect=dialect or self.dialect))] = columns
+
+    def column_names(self, table, only_visible=False, dialect=None):
+        return list(self._columns(table, dialect) or {})
+
+    def get_column_type(self, table, column, dialect=None):
+        columns = self._columns(table, dialect) or {}
+        name = column if isinstance(column, str) else column.name
+        column_type = columns.get(name.lower())
+        if column_type is None:
+            return exp.DataType.build("unknown")
+        if isinstance(column_type, exp.DataType):
+            return column_type
+        return self._to_data_type(column_type, dialect)
+
+    def _columns(self, table, dialect):
+        """The columns of the table, as a dictionary from column name to type, or None if it's not in the schema"""
+        key = _table_key(exp.maybe_parse(table, into=exp.Table, dialect=dialect or self.dialect))
+        if key in self._added:
+            return self._added[key]
+        if self._pid != os.getpid():  # forked, the lock and connections belong to the parent
+            self._reset()
+        with self._lock:
+            if key in self._tables:
+                self._tables.move_to_end(key)
+                return self._tables[key]
+
+        columns = self._fetch(key)
+        with self._lock:
+            self._tables[key] = columns
+            while len(self._tables) > self.max_tables:
+                self._tables.popitem(last=False)
+        return columns
+
+    def _fetch(self, key):
+        cursor = self._connection().cursor()
+        for name in dict.fromkeys((".".join(key), key[-1])):
+            rows = cursor.execute(
+                f"select column_name, sqlglot_type from {self.schema_table_name} where lower(table_name) = ?",
+                (name,),
+            ).fetchall()
+            if rows:
+                return {column_name.lower(): column_type for column_name, column_type in rows}
+        return None
+
+    def _connection(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path)
+            _create_index(connection, self.schema_table_name)
+            self._local.connection = connection
+        return connection
+
+    def _to_data_type(self, column_type, dialect):
+        if column_type not in self._types:
+            self._types[column_type] = exp.DataType.build(column_type.upper(), dialect=dialect or self.dialect)
+        return self._types[column_type]
+
+
+def _table_key(table):
+    """The lowercased catalog, db and name of a table, of those that are set"""
+    return tuple(table.text(part).lower() for part in reversed(TABLE_ARGS) if table.text(part))
+
+
+def _create_index(connection, schema_table_name):
+    """Index the schema table on (lowercased) table name, so looking up a table doesn't scan the whole table"""
+    try:
+        with connection:
+            connection.execute(
+                f"create index if not exists {schema_table_name}_table_name on {schema_table_name} (lower(table_name))"
+            )
+    except sqlite3.OperationalError:  # a read-only database, look up tables without the index
+        pass
@@ -0,0 +1,192 @@
+"""Translate scripts of many statements, one statement at a time
+
+The `translate_` functions translate a single query, so of a script with several statements, only the first one is
+translated. A script is instead split into statements on the semicolons outside of strings, quoted names and
+comments, without tokenizing or parsing it as a whole, and each statement is translated on its own, as soon as the
+split reaches its end. Scripts can be read from a file, a chunk at a time, so the memory a translation takes depends
+on the size of the largest statement, not of the script.
+"""
+import re
+import time
+from dataclasses import dataclass
+from typing import Iterator, Optional, TextIO, Union
+
+from dune.harmonizer.constants import SQLGLOT_SPARK
+from dune.harmonizer.errors import DuneTranslationError
+from dune.harmonizer.translate import _translate_query
+
+_chunk_size = 1 << 16
+
+# Where a statement could end, or a string, quoted name or comment starts, in which a semicolon doesn't end it
+_special = re.compile(r"[;'\"`]|--|/\*")
+_comment_ends = {"--": re.compile(r"\n"), "/*": re.compile(r"\*/")}
+# The rest of a string or quoted name. In Postgres, a quote in a string is written as two quotes, which is the same as
+# two strings as far as the split is concerned.
+_postgres_quotes = {"'": re.compile(r"[^']*'"), '"': re.compile(r'[^"]*"')}
+# In Spark, both quotes are for strings, with backslash escapes, and backticks are for names
+_spark_quotes = {
+    "'": re.compile(r"(?:[^'\\]|\\.)*'", re.DOTALL),
+    '"': re.compile(r'(?:[^"\\]|\\.)*"', re.DOTALL),
+    "`": re.compile(r"[^`]*`"),
+}
+# In Postgres, a string can also be dollar quoted, between two of the same tag like $$ or $body$, without escapes. A
+# tag can't follow a name, which can have dollar signs in it, and `$1` is a parameter.
+_postgres_special = re.compile(r"[;'\"`]|--|/\*|(?<![\w$])\$(?:[A-Za-z_]\w*)?\$")
+# A tag at the end of the buffer, which could go on in the next chunk
+_partial_dollar_tag = re.compile(r"(?<![\w$])\$(?:[A-Za-z_]\w*)?\Z")
+
+
+@dataclass
+class StatementTranslation:
+    """The translation of a statement of a script, or the error it failed with
+
+    `index` is the position of the statement in the script, counting from 0, and `line` the line it starts on,
+    counting from 1."""
+
+    index: int
+    line: int
+    query: str
+    translated: Optional[str] = None
+    error: Optional[Exception] = None
+    seconds: float = 0.0
+
+
+def _chunks(script, chunk_size):
+    if isinstance(script, str):
+        yield script
+        return
+    while chunk := script.read(chunk_size):
+        yield chunk
+
+
+def split_statements(
+    script: Union[str, TextIO], sqlglot_dialect="postgres", chunk_size=_chunk_size
+) -> Iterator[tuple[int, str]]:
+    """Split a script, given as a string or a text file, into its statements, each with the line it starts on
+
+    Statements are split on semicolons, except those in strings, quoted names and comments, including Postgres dollar
+    quoted strings like `$$ ... $$`. Empty statements, and those with only comments, are left out. A file is read
+    `chunk_size` characters at a time, and only the text of the statement that's being split is kept."""
+    if sqlglot_dialect == SQLGLOT_SPARK:
+        special, quotes = _special, _spark_quotes
+    else:
+        special, quotes = _postgres_special, _postgres_quotes
+    chunks = _chunks(script, chunk_size)
+    buffer = ""
+    # The start of the current statement in the buffer, and how far it has been split
+    start = pos = 0
+    line = 1
+    has_content = False
+    done = False
+    while True:
+        match = special.search(buffer, pos)
+        end = None
+        if match is None:
+            # A '-' or '/' at the end of the buffer could be the start of a comment, and a tag of a dollar quote
+            next_pos = len(buffer) if done else max(pos, len(buffer) - 1)
+            if not done and special is _postgres_special:
+                tag = _partial_dollar_tag.search(buffer, pos)
+                next_pos = min(next_pos, tag.start()) if tag is not None else next_pos
+            has_content = has_content or bool(buffer[pos:next_pos].strip())
+            pos = next_pos
+            if done:
+                end = pos
+        else:
+            token = match.group()
+            has_content = has_content or bool(buffer[pos : match.start()].strip())
+            if token == ";":
+                end, pos = match.start(), match.end()
+            elif token in _comment_ends or token in quotes or token.startswith("$"):
+                if token in _comment_ends:
+                    found = _comment_ends[token].search(buffer, match.end())
+                elif token in quotes:
+                    has_content = True
+                    found = quotes[token].match(buffer, match.end())
+                else:
+                    has_content = True
+                    found = re.compile(re.escape(token)).search(buffer, match.end())
+                if found is not None:
+                    pos = found.end()
+                    continue
+                # The string or comment goes on in the next chunk, or runs to the end of the script
+                pos = match.start()
+                if done:
+                    end = pos = len(buffer)
+            else:
+                # A quote that isn't one in this dialect
+                has_content = True
+                pos = match.end()
+                continue
+
+        if end is not None:
+            if has_content:
+                text = buffer[start:end]
+                stripped = text.lstrip()
+                yield line + text.count("\n", 0, len(text) - len(stripped)), stripped.rstrip()
+            if done and pos >= len(buffer):
+                return
+            line += buffer.count("\n", start, pos)
+            start, has_content = pos, False
+            continue
+
+        chunk = next(chunks, None)
+        if chunk is None:
+            done = True
+        else:
+            # Only the text of the current statement is kept
+            buffer = buffer[start:] + chunk
+            pos -= start
+            start = 0
+
+
+def _translate_script(
+    script,
+    sqlglot_dialect,
+    dataset=None,
+    syntax_only=False,
+    table_mapping=None,
+    cache=None,
+    observer=None,
+    table_mapping_index=None,
+    shape_cache=None,
+    schema=None,
+    sink=None,
+    chunk_size=_chunk_size,
+):
+    """Translate the statements of a script one at a time, yielding a `StatementTranslation` for each
+
+    If a file-like `sink` is given, each translated statement is written to it before it's yielded, ending with a
+    semicolon, so it gets the translated script. A statement that fails to translate is written as it was in the
+    script, after a comment with its error."""
+    for index, (line, query) in enumerate(split_statements(script, sqlglot_dialect, chunk_size)):
+        start = time.perf_counter()
+        statement = StatementTranslation(index=index, line=line, query=query)
+        try:
+            statement.translated = _translate_query(
+                query,
+                sqlglot_dialect,
+                dataset,
+                syntax_only,
+                table_mapping,
+                cache,
+                observer,
+                table_mapping_index=table_mapping_index,
+                shape_cache=shape_cache,
+                schema=schema,
+            )
+        except Exception as e:
+            # Besides a `DuneTranslationError`, like an unterminated string, which fails to tokenize, or a statement
+            # too deep to translate. The statements after it are still translated.
+            statement.error = e
+        statement.seconds = time.perf_counter() - start
+        if sink is not None:
+            sink.write(_script_sql(statement))
+        yield statement
+
+
+def _script_sql(statement):
+    if statement.error is None:
+        return f"{statement.translated};\n\n"
+    detail = statement.error.detail if isinstance(statement.error, DuneTranslationError) else str(statement.error)
+    comment = f"{type(statement.error).__name__} in statement {statement.index + 1}: {detail}".replace("*/", "* /")
+    return f"/* {comment} */\n{statement.query};\n\n"
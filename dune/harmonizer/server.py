@@ -0,0 +1,389 @@
+"""Serve translations over HTTP, from a pool of warm worker processes
+
+Run with `python -m dune.harmonizer.server --port 8000 --workers 4`, or `--unix PATH` to listen on a Unix socket.
+The table mapping and the schema are loaded by each worker when it starts, along with the one-time setup of
+translation, so the first request is as fast as the ones after it.
+
+    POST /translate  {"query": "...", "dialect": "postgres", "dataset": "polygon", "syntax_only": false,
+                      "table_mapping": {...}}  ->  {"query": "..."}
+    POST /optimize   {"query": "...", "scoped": false}  ->  {"query": "..."}
+    GET  /metrics    request counts and latencies, in the Prometheus text format
+
+Only `query` is required. Errors are returned as `{"error": "...", "error_type": "..."}`, with status 400 for
+queries that can't be translated. Identical requests that arrive while one of them is being translated share
+that translation. When `--max-in-flight` distinct requests are being translated or waiting for a worker, new
+ones get a 503 right away, and a request that takes longer than `--timeout` seconds gets a 504.
+"""
+import argparse
+import asyncio
+import functools
+import json
+import os
+import sys
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+import sqlglot
+from sqlglot.errors import SqlglotError
+
+from dune.harmonizer.aio import AsyncTranslator
+from dune.harmonizer.batch import TranslationRequest, _validate_request
+from dune.harmonizer.cache import TranslationCache, settings_digest
+from dune.harmonizer.constants import SQLGLOT_POSTGRES, SQLGLOT_SPARK
+from dune.harmonizer.dunesql.dunesql import DuneSQL
+from dune.harmonizer.errors import DuneTranslationError
+from dune.harmonizer.schemas import SQLiteSchema
+from dune.harmonizer.table_replacements import TableMappingIndex
+from dune.harmonizer.translate import _warmup
+
+# Upper bounds of the buckets of the request latency histogram, in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_REASONS = {
+    200: "OK",
+    400: "Bad Request",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    413: "Payload Too Large",
+    500: "Internal Server Error",
+    503: "Service Unavailable",
+    504: "Gateway Timeout",
+}
+
+# The schema of the worker process, set by `_init_worker`, and kept for the lifetime of the process so the tables
+# it has looked up stay cached
+_worker_schema = None
+
+
+def _init_worker(table_mapping_index=None, schema=None):
+    """Set up a worker process: load the table mapping and the schema, and do the one-time setup of translation
+
+    A table mapping index loaded from a file is loaded when it's sent to the worker, and the requests reuse it."""
+    global _worker_schema
+    _worker_schema = schema
+    _warmup(optimizer=schema is not None)
+
+
+def _optimize_query(query, scoped=False):
+    """Optimize a DuneSQL query with the schema of the worker, returning the optimized query"""
+    from dune.harmonizer.dunesql.optimize import optimize
+
+    if _worker_schema is None:
+        raise ValueError("the server has no schema to optimize queries with")
+    expression = sqlglot.parse_one(query, read=DuneSQL)
+    return optimize(expression, _worker_schema, scoped=scoped).sql(dialect=DuneSQL)
+
+
+def _ping():
+    return True
+
+
+class _HTTPError(Exception):
+    def __init__(self, status, detail, error_type=None, headers=None):
+        super().__init__(detail)
+        self.status = status
+        self.detail = detail
+        self.error_type = error_type or _REASONS[status].replace(" ", "")
+        self.headers = headers or {}
+
+
+class TranslationServer:
+    """Answers translate and optimize requests from a pool of worker processes
+
+    With `threads=True`, the requests are handled by a pool of threads in this process instead. A `TranslationCache`
+    given as `cache` keeps the results of earlier requests."""
+
+    def __init__(
+        self,
+        workers=None,
+        threads=False,
+        max_in_flight=None,
+        timeout=None,
+        table_mapping_index=None,
+        schema=None,
+        cache=None,
+        max_body_bytes=16 * 1024 * 1024,
+    ):
+        self.workers = workers or os.cpu_count() or 1
+        if threads:
+            _init_worker(table_mapping_index, schema)
+            self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="harmonizer")
+        else:
+            self.executor = ProcessPoolExecutor(
+                max_workers=self.workers, initializer=_init_worker, initargs=(table_mapping_index, schema)
+            )
+        self.translator = AsyncTranslator(executor=self.executor)
+        self.max_in_flight = max_in_flight or 4 * self.workers
+        self.timeout = timeout
+        self.table_mapping_index = table_mapping_index
+        self.cache = cache
+        self.max_body_bytes = max_body_bytes
+        self._in_flight = {}
+        self._requests = Counter()
+        self._coalesced = 0
+        self._latency_buckets = Counter()
+        self._latency_sum = Counter()
+
+    async def start_workers(self):
+        """Start the worker processes, and wait until they're set up"""
+        await asyncio.gather(*(self.translator.run(_ping) for _ in range(self.workers)))
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    async def handle(self, method, path, body=b""):
+        """Handle a request, returning the status, content type and body of the response, and extra headers"""
+        start = time.perf_counter()
+        endpoint = path if path in ("/translate", "/optimize", "/metrics") else "other"
+        headers = {}
+        try:
+            if endpoint == "other":
+                raise _HTTPError(404, f"Unknown path: {path}")
+            if endpoint == "/metrics":
+                if method != "GET":
+                    raise _HTTPError(405, "Use GET")
+                status, content_type, payload = 200, "text/plain; version=0.0.4", self.metrics().encode()
+            else:
+                if method != "POST":
+                    raise _HTTPError(405, "Use POST")
+                result = await self._post(endpoint, body)
+                status, content_type, payload = 200, "application/json", json.dumps({"query": result}).encode()
+        except _HTTPError as e:
+            status, content_type = e.status, "application/json"
+            payload = json.dumps({"error": e.detail, "error_type": e.error_type}).encode()
+            headers = e.headers
+        self._record(endpoint, status, time.perf_counter() - start)
+        return status, content_type, payload, headers
+
+    async def _post(self, endpoint, body):
+        try:
+            record = json.loads(body)
+            if endpoint == "/translate":
+                request = _validate_request(
+                    TranslationRequest(
+                        query=record["query"],
+                        dialect=record.get("dialect", SQLGLOT_POSTGRES),
+                        dataset=record.get("dataset", "ethereum"),
+                        syntax_only=record.get("syntax_only", False),
+                        table_mapping=record.get("table_mapping"),
+                        table_mapping_index=self.table_mapping_index,
+                    )
+                )
+                # Requests are coalesced on their exact query, not on the normalized one of a cache key
+                key = settings_digest(
+                    request.query,
+                    request.dialect,
+                    request.dataset,
+                    request.syntax_only,
+                    request.table_mapping,
+                    request.table_mapping_index,
+                )
+                call = functools.partial(self._translate, request)
+            else:
+                query, scoped = record["query"], bool(record.get("scoped", False))
+                key = ("optimize", query, scoped)
+                call = functools.partial(self.translator.run, _optimize_query, query, scoped)
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            raise _HTTPError(400, str(e), type(e).__name__)
+
+        # Identical requests share the call of the first one, which isn't cancelled when one of them goes away
+        job = self._in_flight.get(key)
+        if job is not None:
+            self._coalesced += 1
+        elif len(self._in_flight) >= self.max_in_flight:
+            raise _HTTPError(503, "Too many requests in flight", headers={"Retry-After": "1"})
+        else:
+            job = self._in_flight[key] = asyncio.ensure_future(asyncio.wait_for(call(), self.timeout))
+            job.add_done_callback(functools.partial(self._job_done, key))
+
+        try:
+            return await asyncio.shield(job)
+        except asyncio.TimeoutError:
+            raise _HTTPError(504, f"The request took longer than {self.timeout} seconds")
+        except (DuneTranslationError, ValueError, SqlglotError) as e:
+            detail = e.detail if isinstance(e, DuneTranslationError) else str(e)
+            raise _HTTPError(400, detail, type(e).__name__)
+        except Exception as e:  # a bug in a rule, or a worker that died
+            raise _HTTPError(500, str(e), type(e).__name__)
+
+    def _job_done(self, key, job):
+        del self._in_flight[key]
+        if not job.cancelled():
+            job.exception()  # the requests that shared the job may all be gone, this keeps asyncio from logging it
+
+    async def _translate(self, request):
+        if request.dialect == SQLGLOT_SPARK:
+            return await self.translator.translate_spark(request.query, cache=self.cache)
+        return await self.translator.translate_postgres(
+            request.query,
+            dataset=request.dataset,
+            syntax_only=request.syntax_only,
+            table_mapping=request.table_mapping,
+            cache=self.cache,
+            table_mapping_index=request.table_mapping_index,
+        )
+
+    def _record(self, endpoint, status, seconds):
+        self._requests[endpoint, status] += 1
+        self._latency_sum[endpoint] += seconds
+        for le in (*LATENCY_BUCKETS, "+Inf"):
+            if le == "+Inf" or seconds <= le:
+                self._latency_buckets[endpoint, le] += 1
+
+    def metrics(self):
+        """The metrics of the server, in the Prometheus text format"""
+        lines = [
+            "# TYPE harmonizer_requests_total counter",
+            *(
+                f'harmonizer_requests_total{{endpoint="{endpoint}",status="{status}"}} {count}'
+                for (endpoint, status), count in sorted(self._requests.items())
+            ),
+            "# TYPE harmonizer_request_seconds histogram",
+        ]
+        for endpoint in sorted(self._latency_sum):
+            lines += [
+                f'harmonizer_request_seconds_bucket{{endpoint="{endpoint}",le="{le}"}} '
+                f"{self._latency_buckets[endpoint, le]}"
+                for le in (*LATENCY_BUCKETS, "+Inf")
+            ]
+            lines += [
+                f'harmonizer_request_seconds_sum{{endpoint="{endpoint}"}} {self._latency_sum[endpoint]}',
+                f'harmonizer_request_seconds_count{{endpoint="{endpoint}"}} {self._latency_buckets[endpoint, "+Inf"]}',
+            ]
+        lines += [
+            "# TYPE harmonizer_coalesced_requests_total counter",
+            f"harmonizer_coalesced_requests_total {self._coalesced}",
+            "# TYPE harmonizer_in_flight gauge",
+            f"harmonizer_in_flight {len(self._in_flight)}",
+            "# TYPE harmonizer_max_in_flight gauge",
+            f"harmonizer_max_in_flight {self.max_in_flight}",
+            "# TYPE harmonizer_workers gauge",
+            f"harmonizer_workers {self.workers}",
+        ]
+        if self.cache is not None:
+            lines += [
+                "# TYPE harmonizer_cache_hits_total counter",
+                f"harmonizer_cache_hits_total {self.cache.stats.hits}",
+                "# TYPE harmonizer_cache_misses_total counter",
+                f"harmonizer_cache_misses_total {self.cache.stats.misses}",
+            ]
+        return "\n".join(lines) + "\n"
+
+    async def handle_connection(self, reader, writer):
+        """Serve the HTTP requests of a connection, until the client closes it or asks to"""
+        try:
+            while True:
+                try:
+                    request = await self._read_request(reader)
+                except _HTTPError as e:
+                    body = json.dumps({"error": e.detail, "error_type": e.error_type}).encode()
+                    await _write_response(writer, e.status, "application/json", body, {}, keep_alive=False)
+                    return
+                if request is None:
+                    return
+                method, path, keep_alive, body = request
+                status, content_type, payload, headers = await self.handle(method, path, body)
+                await _write_response(writer, status, content_type, payload, headers, keep_alive)
+                if not keep_alive:
+                    return
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def _read_request(self, reader):
+        """Read the method, path, whether to keep the connection alive, and the body of the next request"""
+        line = await reader.readline()
+        if not line:
+            return None
+        try:
+            method, target, version = line.decode("latin-1").split()
+            headers = {}
+            while (line := await reader.readline()) not in (b"\r\n", b"\n", b""):
+                name, _, value = line.decode("latin-1").partition(":")
+                headers[name.strip().lower()] = value.strip()
+            length = int(headers.get("content-length", 0))
+        except ValueError:
+            raise _HTTPError(400, "Malformed request")
+        if length > self.max_body_bytes:
+            raise _HTTPError(413, f"The body is larger than {self.max_body_bytes} bytes")
+        body = await reader.readexactly(length) if length else b""
+        connection = headers.get("connection", "").lower()
+        keep_alive = connection == "keep-alive" if version == "HTTP/1.0" else connection != "close"
+        return method, urlsplit(target).path, keep_alive, body
+
+
+async def _write_response(writer, status, content_type, body, headers, keep_alive):
+    head = [
+        f"HTTP/1.1 {status} {_REASONS[status]}",
+        f"Content-Type: {content_type}",
+        f"Content-Length: {len(body)}",
+        f"Connection: {'keep-alive' if keep_alive else 'close'}",
+        *(f"{name}: {value}" for name, value in headers.items()),
+    ]
+    writer.write(("\r\n".join(head) + "\r\n\r\n").encode("latin-1") + body)
+    await writer.drain()
+
+
+async def serve(server, host="127.0.0.1", port=8000, unix=None):
+    """Start the workers of the `TranslationServer`, and serve requests on the port or Unix socket until cancelled"""
+    await server.start_workers()
+    if unix is not None:
+        listener = await asyncio.start_unix_server(server.handle_connection, path=unix)
+    else:
+        listener = await asyncio.start_server(server.handle_connection, host=host, port=port)
+    addresses = ", ".join(str(socket.getsockname()) for socket in listener.sockets)
+    print(f"Serving translations on {addresses} with {server.workers} workers", file=sys.stderr)
+    try:
+        async with listener:
+            await listener.serve_forever()
+    finally:
+        server.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m dune.harmonizer.server",
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument("--host", default="127.0.0.1", help="host to listen on")
+    parser.add_argument("--port", type=int, default=8000, help="port to listen on")
+    parser.add_argument("--unix", help="path of a Unix socket to listen on, instead of the host and port")
+    parser.add_argument("-j", "--workers", type=int, help="number of worker processes (default: number of CPUs)")
+    parser.add_argument("--max-in-flight", type=int, help="max number of distinct requests being handled at once")
+    parser.add_argument("--timeout", type=float, help="seconds after which a request gets a 504")
+    parser.add_argument("--table-mapping-file", help="JSON file or SQLite database to load the table mappings from")
+    parser.add_argument("--table-mapping-table", help="table with the table mappings, if the file is a SQLite database")
+    parser.add_argument("--schema-file", help="SQLite database with the schema to optimize queries with")
+    parser.add_argument("--schema-table", default="schemas", help="table with the schema in the SQLite database")
+    parser.add_argument("--cache-entries", type=int, default=10_000, help="number of results to keep, 0 to not cache")
+    parser.add_argument("--cache-file", help="SQLite database to keep the results in, across restarts")
+    args = parser.parse_args(argv)
+
+    table_mapping_index = None
+    if args.table_mapping_file:
+        table_mapping_index = TableMappingIndex.load(args.table_mapping_file, args.table_mapping_table)
+    schema = SQLiteSchema(args.schema_file, args.schema_table) if args.schema_file else None
+    cache = None
+    if args.cache_entries or args.cache_file:
+        cache = TranslationCache(max_entries=args.cache_entries, path=args.cache_file)
+
+    server = TranslationServer(
+        workers=args.workers,
+        max_in_flight=args.max_in_flight,
+        timeout=args.timeout,
+        table_mapping_index=table_mapping_index,
+        schema=schema,
+        cache=cache,
+    )
+    try:
+        asyncio.run(serve(server, host=args.host, port=args.port, unix=args.unix))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+import threading
+from collections import OrderedDict
+
+from sqlglot import exp
+
+from dune.harmonizer.cache import CacheStats, settings_digest
+from dune.harmonizer.custom_transforms import literal_affects_rules
+from dune.harmonizer.dunesql.dunesql import DuneSQL
+
+# Nodes with values that can be rebound into a translated query: numbers, strings and hex strings
+_SLOT_TYPES = (exp.Literal, exp.HexString)
+
+
+class ShapeCache:
+    """A cache of translated query trees, shared by all queries of the same shape, which differ only in literals
+
+    Dune queries are forked a lot, and forks often only change addresses, dates or numbers. The shape of a query is
+    its parsed tree with the values of literals left out, except for the literals the translation rules look at
+    (see `custom_transforms.literal_affects_rules`). The first query of a shape is translated as usual, and its
+    translated tree is kept, along with the literals from the query it still holds. A query of the same shape then
+    skips the transforms: its literals are put in place of those in the kept tree, and the tree is generated as
+    DuneSQL, which applies the conversions that depend on literals, like casting strings that look like dates.
+
+    Literals that a rule replaced, rather than kept, can't be rebound: their values are part of the shape, so
+    queries that differ in those are translated on their own. At most `max_entries` translated trees are kept,
+    in least recently used order."""
+
+    def __init__(self, max_entries=1000):
+        self.max_entries = max_entries
+        self.stats = CacheStats()
+        self._templates = OrderedDict()
+        self._pinned = {}
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        # Only the configuration is sent to other processes, they start with an empty cache
+        return {"max_entries": self.max_entries}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def __len__(self):
+        return len(self._templates)
+
+    def shape(
+        self, query_tree, sqlglot_dialect, dataset=None, syntax_only=False, table_mapping=None, table_mapping_index=None
+    ):
+        """The shape of a parsed query, translated with the given settings, for `translate` and `add`"""
+        fingerprint, literals = _fingerprint(query_tree)
+        key = settings_digest(fingerprint, sqlglot_dialect, dataset, syntax_only, table_mapping, table_mapping_index)
+        return _Shape(key, literals)
+
+    def translate(self, shape):
+        """The query of the shape as DuneSQL, or None if no query of the shape has been translated yet"""
+        with self._lock:
+            pinned = self._pinned.get(shape.key)
+            template = None
+            if pinned is not None:
+                template_key = (shape.key, tuple(shape.values[i] for i in pinned))
+                template = self._templates.get(template_key)
+            if template is None:
+                self.stats.misses += 1
+                return None
+            self._templates.move_to_end(template_key)
+            self.stats.hits += 1
+        return template.generate(shape.literals)
+
+    def add(self, shape, translated_tree):
+        """Keep the translated tree of the query the shape is of, which must not be changed after this"""
+        slots, pinned = _slots(shape.literals, shape.values, translated_tree)
+        with self._lock:
+            if self._pinned.setdefault(shape.key, pinned) != pinned:
+                return  # queries of this shape don't keep the same literals, so they can't share translations
+            self._templates[shape.key, tuple(shape.values[i] for i in pinned)] = _Template(translated_tree, slots)
+            while len(self._templates) > self.max_entries:
+                (key, _), _ = self._templates.popitem(last=False)
+                self.stats.evictions += 1
+                if not any(k == key for k, _ in self._templates):
+                    del self._pinned[key]
+
+
+class _Shape:
+    def __init__(self, key, literals):
+        self.key = key
+        self.literals = literals
+        self.values = [node.this for node in literals]
+
+
+class _Template:
+    """A translated tree, with the literals in it that can be rebound, by their index in the query"""
+
+    def __init__(self, tree, slots):
+        self.tree = tree
+        self.slots = slots
+        self._lock = threading.Lock()
+
+    def generate(self, literals):
+        # Generating DuneSQL doesn't change the tree, so it can be reused with the next query's literals
+        with self._lock:
+            for i, node in self.slots:
+                node.set("this", literals[i].this)
+                node.type = literals[i].type  # types are annotated while parsing, like for index offsets
+            return self.tree.sql(dialect=DuneSQL, pretty=True)
+
+
+def _fingerprint(query_tree):
+    """The tree in depth-first order, with the depth, type and values of each node, except for the values of literals
+    that can be rebound; and the literals of the tree, in the same order"""
+    parts = []
+    literals = []
+    has_parameters = False
+    stack = [(query_tree, 0)]
+    while stack:
+        node, depth = stack.pop()
+        parts.append(f"{depth}:{node.arg_key}:{node.key}")
+        if node.comments:
+            parts.append(repr(node.comments))
+        if isinstance(node.this, str) and "{{" in node.this:
+            has_parameters = True  # like `QueryFeatures.has_parameters`
+        is_literal = isinstance(node, _SLOT_TYPES)
+        if is_literal:
+            literals.append((node, len(parts)))
+            parts.append(None)  # the value, or not, once it's known whether the query has parameters
+        children = []
+        for key, value in node.args.items():
+            if isinstance(value, exp.Expression):
+                children.append(value)
+            elif type(value) is list:
+                children.extend(v for v in value if isinstance(v, exp.Expression))
+                parts.extend(repr(v) for v in value if not isinstance(v, exp.Expression))
+            elif value is not None and not (is_literal and key == "this"):
+                parts.append(f"{key}={value!r}")
+        stack.extend((child, depth + 1) for child in reversed(children))
+
+    for node, i in literals:
+        parts[i] = repr(node.this) if literal_affects_rules(node, has_parameters) else "?"
+    return "\n".join(parts), [node for node, _ in literals]
+
+
+def _slots(literals, values, translated_tree):
+    """The literals that are in the translated tree once, as they were in the query, by their index in the query;
+    and the indices of the other literals"""
+    index = {id(node): i for i, node in enumerate(literals)}
+    seen = {}
+    for node, _, _ in translated_tree.walk():
+        i = index.get(id(node))
+        if i is not None:
+            seen[i] = node if i not in seen and node.this == values[i] else None
+    slots = [(i, node) for i, node in seen.items() if node is not None]
+    pinned = tuple(i for i in range(len(literals)) if seen.get(i) is None)
+    return slots, pinned
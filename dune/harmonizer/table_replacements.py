@@ -1,10 +1,21 @@
+import hashlib
+import json
+from collections import ChainMap
+from functools import cache, cached_property, lru_cache
+from pathlib import Path
+
 import sqlglot
-from sqlglot import to_identifier
-from sqlglot.expressions import TableAlias, replace_tables
+from sqlglot import exp, to_identifier
+from sqlglot.expressions import TableAlias
+
+from dune.harmonizer.dunesql.traversal import balanced_chains
 
 
 def table_replacements(dataset, mapping):
-    """Return a function to do table replacements for Postgres -> DuneSQL, with appropriate dataset"""
+    """Return a function to do table replacements for Postgres -> DuneSQL, with appropriate dataset
+
+    The `mapping` from v1 to v2 table names is indexed by lowercased table name parts, like the mappings that
+    `TableMappingIndex.for_dataset` returns."""
 
     def table_replacement_transform(table_node):
         """Replace table names in the query AST with the appropriate DuneSQL table names"""
@@ -14,15 +25,14 @@ def table_replacements(dataset, mapping):
             return table_node
 
         # Do a case insensitive lookup in the replacement mapping
-        table_node_case_insensitive = sqlglot.exp.Table(
-            this=to_identifier(table_node.name.lower()),
-            db=to_identifier(table_node.db.lower() if table_node.db else None),
-            alias=TableAlias(this=to_identifier(table_node.alias.lower())) if table_node.alias else None,
-        )
-        replaced_table_node = replace_tables(table_node_case_insensitive, mapping)
-
-        # Did replace
-        if replaced_table_node != table_node_case_insensitive:
+        key = (table_node.db.lower(), table_node.name.lower()) if table_node.db else (table_node.name.lower(),)
+        to_table = mapping.get(key)
+
+        # A table mapped to itself isn't replaced
+        if to_table and _table_key(to_table) != key:
+            replaced_table_node = _parse_table(to_table).copy()
+            if table_node.alias:
+                replaced_table_node.set("alias", TableAlias(this=to_identifier(table_node.alias.lower())))
             return replaced_table_node
 
         # If decoded table, add _{dataset} to the table name
@@ -39,6 +49,123 @@ def table_replacements(dataset, mapping):
     return table_replacement_transform
 
 
+def _table_key(name):
+    """The key of a table name like `db.table` in a table mapping index: its lowercased, unquoted parts"""
+    return tuple(part.strip('"').lower() for part in name.split("."))
+
+
+@lru_cache(maxsize=4096)
+def _parse_table(name):
+    """The table node for a table name, parsed once. Copy it before putting it in a query AST."""
+    return exp.to_table(name)
+
+
+def index_table_mapping(mapping):
+    """Index a dictionary from v1 table names (like `erc20.tokens`) to v2 table names by lowercased table name parts"""
+    return {_table_key(from_table): to_table for from_table, to_table in mapping.items()}
+
+
+class TableMappingIndex:
+    """The v1 to v2 table name mappings of each dataset, indexed for case insensitive lookups
+
+    `mappings` is a dictionary from dataset name to a dictionary from v1 table names (like `erc20.tokens`) to v2
+    table names. The mappings of the dataset `*` apply to every dataset, unless the dataset maps the same table.
+    The index of each dataset is built the first time it's used, and reused by every translation after that, so
+    a mapping of thousands of tables costs a dictionary lookup per table in a query, and nothing per query.
+
+    Load a large mapping once with `TableMappingIndex.load`, and pass it to `translate_postgres` as
+    `table_mapping_index`, instead of the built-in mapping of Spellbook tables. A `table_mapping` passed along with
+    it is layered on top, without copying the index.
+
+    An index loaded from a file is sent to worker processes as just the path of the file, and each process loads
+    it once.
+    """
+
+    def __init__(self, mappings):
+        self.mappings = mappings
+        self._datasets = {}
+        self._source = None
+
+    @classmethod
+    def load(cls, path, mapping_table_name=None):
+        """Load the mappings from a JSON file, or from a SQLite database if `mapping_table_name` is given
+
+        The JSON file has an object like the `mappings` dictionary. The table in the SQLite database has columns
+        `dataset`, `v1_table` and `v2_table`, with one row per mapped table."""
+        if mapping_table_name is None:
+            index = cls(json.loads(Path(path).read_text()))
+        else:
+            index = cls(_mappings_from_sqlite(path, mapping_table_name))
+        index._source = (str(path), mapping_table_name)
+        return index
+
+    def __getstate__(self):
+        if self._source is not None:
+            return {"source": self._source}
+        return {"mappings": self.mappings}
+
+    def __setstate__(self, state):
+        if "source" in state:
+            # Reuse the index if this process has loaded the file already, along with the datasets it has built
+            self.__dict__.update(_load_index(*state["source"]).__dict__)
+        else:
+            self.__init__(state["mappings"])
+
+    @cached_property
+    def digest(self):
+        """A digest of the mappings, to tell translations with different mappings apart in a `TranslationCache`"""
+        mappings = sorted((dataset, sorted(mapping.items())) for dataset, mapping in self.mappings.items())
+        return hashlib.sha256(json.dumps(mappings).encode()).hexdigest()
+
+    def for_dataset(self, dataset, table_mapping=None):
+        """The index of the mappings of the dataset, with the tables in `table_mapping` mapped as given there"""
+        index = self._datasets.get(dataset)
+        if index is None:
+            index = self._datasets[dataset] = index_table_mapping(self._dataset_mapping(dataset))
+        if not table_mapping:
+            return index
+        return ChainMap(index_table_mapping(table_mapping), index)
+
+    def _dataset_mapping(self, dataset):
+        return self.mappings.get("*", {}) | self.mappings.get(dataset, {})
+
+
+class _SpellbookMappingIndex(TableMappingIndex):
+    """The built-in mapping of v1 tables to Spellbook tables, for any dataset"""
+
+    def __init__(self):
+        super().__init__({})
+
+    def __reduce__(self):
+        return spellbook_mapping_index, ()
+
+    def _dataset_mapping(self, dataset):
+        return spellbook_mapping(dataset)
+
+
+@cache
+def spellbook_mapping_index():
+    """The index of the built-in mappings from `spellbook_mapping`, shared by all translations in this process"""
+    return _SpellbookMappingIndex()
+
+
+@cache
+def _load_index(path, mapping_table_name):
+    return TableMappingIndex.load(path, mapping_table_name)
+
+
+def _mappings_from_sqlite(path, mapping_table_name):
+    import sqlite3
+    from contextlib import closing
+
+    with closing(sqlite3.connect(path)) as connection:
+        rows = connection.execute(f"select dataset, v1_table, v2_table from {mapping_table_name}").fetchall()
+    mappings = {}
+    for dataset, v1_table, v2_table in rows:
+        mappings.setdefault(dataset, {})[v1_table] = v2_table
+    return mappings
+
+
 def spellbook_mapping(dataset):
     return {
         "erc20.erc20_evt_transfer": f"erc20_{dataset}.evt_Transfer",
@@ -50,3 +177,120 @@ def spellbook_mapping(dataset):
         "prices.layer1_usd_btc": "prices.usd",
         "prices.layer1_usd_eth": "prices.usd",
     }
+
+
+def spellbook_column_mapping():
+    """Columns that were renamed or dropped in the v2 spells, per table
+
+    A column mapped to a set of values was dropped, and every row of the v2 spell had one of those values in it (in
+    lower case), so filters of the column being equal to one of them are removed from the WHERE clause. Any other use
+    of a dropped column is left as it is, and fails when the query is run, rather than returning different rows."""
+    return {
+        "dex.trades": {
+            "exchange_contract_address": "project_contract_address",
+            "token_a_address": "token_sold_address",
+            "token_a_symbol": "token_sold_symbol",
+            "token_a_amount": "token_sold_amount",
+            "token_a_amount_raw": "token_sold_amount_raw",
+            "token_b_address": "token_bought_address",
+            "token_b_symbol": "token_bought_symbol",
+            "token_b_amount": "token_bought_amount",
+            "token_b_amount_raw": "token_bought_amount_raw",
+            # Aggregator trades are in dex_aggregator.trades
+            "category": {"dex"},
+        },
+    }
+
+
+def column_replacements(query_tree, column_mapping):
+    """Rename or drop the columns given by `column_mapping` in the query AST, modifying it in place
+
+    Each column is resolved to the table it's selected from, through table aliases, subqueries and CTEs,
+    so only the columns of tables in the mapping are changed."""
+    mapping = {tuple(table.lower().split(".")): columns for table, columns in column_mapping.items()}
+    if not any((table.text("db").lower(), table.name.lower()) in mapping for table in query_tree.find_all(exp.Table)):
+        return query_tree
+
+    # The optimizer package is slow to import, and most queries don't need it
+    from sqlglot.optimizer.scope import traverse_scope
+
+    # Resolve every column before changing any, since resolving through a subquery uses its original column names.
+    # Building the scopes walks the tree recursively, so long chains of conditions are balanced while it does.
+    replacements = []
+    with balanced_chains(query_tree):
+        for scope in traverse_scope(query_tree):
+            for column in scope.columns:
+                columns = _resolve_column_mapping(scope, column.table, column.name.lower(), mapping, set())
+                if columns is not None:
+                    replacements.append((column, columns[column.name.lower()]))
+
+    for column, new_name in replacements:
+        if isinstance(new_name, str):
+            column.this.set("this", new_name)
+        else:
+            _remove_filter(column, new_name)
+    return query_tree
+
+
+def _resolve_column_mapping(scope, table, name, mapping, seen):
+    """Find the column mapping for the table that column `name` (selected from `table`) comes from, if any"""
+    if (id(scope), table, name) in seen:  # recursive CTEs
+        return None
+    seen.add((id(scope), table, name))
+
+    if table:
+        sources = [scope.selected_sources[table][1]] if table in scope.selected_sources else []
+    else:
+        sources = [source for _, source in scope.selected_sources.values()]
+
+    for source in sources:
+        if isinstance(source, exp.Table):
+            columns = mapping.get((source.db.lower(), source.name.lower()))
+            if columns is not None and name in columns:
+                return columns
+            continue
+        for inner_scope in _leaf_scopes(source):
+            if not isinstance(inner_scope.expression, exp.Select):
+                continue
+            for projection in inner_scope.expression.expressions:
+                # The column only keeps its name if selected by star or without an alias
+                if isinstance(projection, exp.Star):
+                    columns = _resolve_column_mapping(inner_scope, None, name, mapping, seen)
+                elif isinstance(projection, exp.Column) and (projection.is_star or projection.name.lower() == name):
+                    columns = _resolve_column_mapping(inner_scope, projection.table, name, mapping, seen)
+                else:
+                    continue
+                if columns is not None:
+                    return columns
+    return None
+
+
+def _leaf_scopes(scope):
+    """The scopes of the SELECTs that make up a scope, which are several if it's a UNION"""
+    if not scope.union_scopes:
+        return [scope]
+    return [leaf for union_scope in scope.union_scopes for leaf in _leaf_scopes(union_scope)]
+
+
+def _remove_filter(column, values):
+    """Remove the filter of a dropped column being equal to one of the values from the WHERE clause, if it's one of
+    the conditions AND-ed together"""
+    condition = column.parent
+    if not isinstance(condition, exp.EQ):
+        return
+    value = condition.expression if condition.this is column else condition.this
+    if not (isinstance(value, exp.Literal) and value.is_string and value.this.lower() in values):
+        return
+    node = condition
+    while isinstance(node.parent, (exp.And, exp.Paren)):
+        node = node.parent
+    if not isinstance(node.parent, exp.Where):
+        return
+
+    parent = condition.parent
+    while isinstance(parent, exp.Paren):
+        condition, parent = parent, parent.parent
+    if isinstance(parent, exp.Where):
+        parent.pop()
+    else:
+        parent.replace(parent.right if condition is parent.left else parent.left)
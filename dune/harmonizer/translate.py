@@ -4,19 +4,35 @@ import sqlglot
 from sqlglot import ParseError
 from sqlglot.errors import SqlglotError
 
+from dune.harmonizer import prefilter
+from dune.harmonizer.cache import cache_key, harmonizer_version, is_cacheable_schema
 from dune.harmonizer.custom_transforms import (
     add_warnings,
-    fix_bytearray_param,
-    parameter_placeholder,
-    transform_interval_cast,
-    v1_tables_to_v2_tables,
+    apply_rules,
+    v1_rules,
+    v1_spell_fixes,
+    v1_table_rules,
     v1_transforms,
     v2_transforms,
 )
-from dune.harmonizer.dunesql.dunepostgres import DunePostgres
-from dune.harmonizer.dunesql.dunesql import DuneSQL
+from dune.harmonizer.dunesql.dunepostgres import DunePostgres, bytea_to_hex_strings
+from dune.harmonizer.dunesql.dunespark import DuneSpark
+from dune.harmonizer.dunesql.dunesql import DuneSQL, to_dunesql
 from dune.harmonizer.errors import DuneTranslationError
-from dune.harmonizer.table_replacements import spellbook_mapping
+from dune.harmonizer.instrumentation import observe, stage
+from dune.harmonizer.result import TranslationResult
+from dune.harmonizer.table_replacements import spellbook_mapping_index
+
+# Queries that go through most of the rules of each dialect, translated by `_warmup`
+_warmup_postgres_query = r"""WITH t AS (
+    SELECT date_trunc('day', block_time) AS day, token_a_symbol, sum(usd_amount) / count(*) AS avg_usd
+    FROM dex.trades
+    WHERE block_time > now() - interval '7 days' AND tx_from = '\x00'::bytea AND project = '{{project}}'
+    GROUP BY 1, 2
+)
+SELECT day, token_a_symbol, avg_usd, generate_series(1, 3) AS n FROM t ORDER BY 1 DESC LIMIT 10"""
+_warmup_spark_query = """SELECT date_trunc('day', block_time) AS day, sum(amount_usd) / count(*) AS avg_usd
+FROM dex.trades WHERE blockchain = 'ethereum' AND tx_from = '0x00' AND project = '{{project}}' GROUP BY 1"""
 
 
 def _clean_dataset(dataset):
@@ -28,17 +44,13 @@ def _clean_dataset(dataset):
     raise ValueError(f"Unknown dataset: {dataset}")
 
 
-def _handle_parse_error(parameter_map: dict[str, str], e: ParseError) -> str:
+def _handle_parse_error(e: ParseError) -> str:
     # SQLGlot inserts terminal style colors to emphasize error location.
     # We change these to be more Unicode-friendly.
     error_message = (
         str(e).replace("\x1b[4m", ">>>").replace("\x1b[0m", "<<<").replace("[4m", ">>>").replace("[0m", "<<<")
     )
 
-    # Replace any placeholders in the error message with their param
-    for replace, original in parameter_map.items():
-        error_message = error_message.replace(replace, original)
-
     # Remove Line and Column information, since it's outdated due to previous transforms.
     error_message = re.sub(
         ". Line [0-9]+, Col: [0-9]+.",
@@ -48,75 +60,224 @@ def _handle_parse_error(parameter_map: dict[str, str], e: ParseError) -> str:
     return error_message
 
 
-def _translate_query(query, sqlglot_dialect, dataset=None, syntax_only=False, table_mapping=None):
+def _translate_query(
+    query,
+    sqlglot_dialect,
+    dataset=None,
+    syntax_only=False,
+    table_mapping=None,
+    cache=None,
+    observer=None,
+    table_mapping_index=None,
+    shape_cache=None,
+    schema=None,
+):
+    """Translate a query, looking up the result in the `TranslationCache` first if one is given
+
+    If a `TranslationObserver` is given, the timings of the stages and rules of the translation are reported to it.
+    If a `ShapeCache` is given, the translation of an earlier query of the same shape is reused.
+    If a schema is given, the translated query is optimized with it, see `_optimize`.
+    """
+    if observer is not None:
+        with observe(observer):
+            return _translate_query(
+                query,
+                sqlglot_dialect,
+                dataset,
+                syntax_only,
+                table_mapping,
+                cache,
+                table_mapping_index=table_mapping_index,
+                shape_cache=shape_cache,
+                schema=schema,
+            )
+    if cache is None or not is_cacheable_schema(schema):
+        return _translate(
+            query, sqlglot_dialect, dataset, syntax_only, table_mapping, table_mapping_index, shape_cache, schema
+        )
+
+    key = cache_key(query, sqlglot_dialect, dataset, syntax_only, table_mapping, table_mapping_index, schema)
+    cached = cache.get(key)
+    if isinstance(cached, DuneTranslationError):
+        raise DuneTranslationError(cached.detail)
+    if cached is not None:
+        return cached
+    try:
+        translated = _translate(
+            query, sqlglot_dialect, dataset, syntax_only, table_mapping, table_mapping_index, shape_cache, schema
+        )
+    except DuneTranslationError as e:
+        cache.put(key, e)
+        raise
+    cache.put(key, translated)
+    return translated
+
+
+def _translate(
+    query,
+    sqlglot_dialect,
+    dataset=None,
+    syntax_only=False,
+    table_mapping=None,
+    table_mapping_index=None,
+    shape_cache=None,
+    schema=None,
+):
     """Translate a query using SQLGLot plus custom rules"""
-    # Insert placeholders for the parameters we use in Dune (`{{ param }}`), SQLGlot doesn't handle those
-    parameters = re.findall("({{.*?}})", query, flags=re.IGNORECASE)
-    parameter_map = {parameter_placeholder(p): p for p in parameters}
-    for replace, original in parameter_map.items():
-        query = query.replace(original, replace)
-
-    if sqlglot_dialect == "postgres":
-        # Update bytearray syntax for postgres:
-        # SQLGlot parses x'deadbeef' as a HexString, but it doesn't parse \x as a hex string,
-        # because it's just a general byte array notation. But we want to always parse it as a hex string.
-        query = query.replace(r"'\x", "x'")
-
-        # SQLGlot is unable to tokenize x'' so work around it
-        query = query.replace("x''", "'x'")
+    # Queries with constructs that can't be translated fail before they're parsed
+    prefilter.check(query, sqlglot_dialect)
+    query_tree = _parse(query, sqlglot_dialect)
+
+    # A query of the same shape as one translated before only needs its literals put in that translation. Not with a
+    # schema though, since the casts the optimizer adds depend on the types of literals, and on whether strings are hex.
+    shape = None
+    if shape_cache is not None and schema is None:
+        with stage("shape"):
+            shape = shape_cache.shape(
+                query_tree, sqlglot_dialect, dataset, syntax_only, table_mapping, table_mapping_index
+            )
         try:
-            query = transform_interval_cast(query)
-        except ParseError as e:
-            raise DuneTranslationError(_handle_parse_error(parameter_map, e))
+            with stage("generate"):
+                query = shape_cache.translate(shape)
         except SqlglotError as e:
             raise DuneTranslationError(str(e))
+        if query is not None:
+            with stage("postprocess"):
+                return add_warnings(query)
 
-    # Parse query using SQLGlot
+    query_tree = _transform(query_tree, sqlglot_dialect, dataset, syntax_only, table_mapping, table_mapping_index)
+    if schema is not None:
+        query_tree = _optimize(query_tree, schema)
+    query = _generate(query_tree)
+    if shape is not None:
+        shape_cache.add(shape, query_tree)
+
+    with stage("postprocess"):
+        return add_warnings(query)
+
+
+def _translate_result(
+    query,
+    sqlglot_dialect,
+    dataset=None,
+    syntax_only=False,
+    table_mapping=None,
+    observer=None,
+    table_mapping_index=None,
+    schema=None,
+):
+    """Translate a query into a `TranslationResult`, which generates the SQL of the translated tree when asked"""
+    if observer is not None:
+        with observe(observer):
+            return _translate_result(
+                query,
+                sqlglot_dialect,
+                dataset,
+                syntax_only,
+                table_mapping,
+                table_mapping_index=table_mapping_index,
+                schema=schema,
+            )
+    prefilter.check(query, sqlglot_dialect)
+    query_tree = _parse(query, sqlglot_dialect)
+    query_tree = _transform(query_tree, sqlglot_dialect, dataset, syntax_only, table_mapping, table_mapping_index)
+    if schema is not None:
+        query_tree = _optimize(query_tree, schema)
+    return TranslationResult(query_tree)
+
+
+def _parse(query, sqlglot_dialect):
+    """Parse query using SQLGlot, with the Dune dialects that parse the parameters we use in Dune (`{{ param }}`)"""
     try:
-        if sqlglot_dialect == "postgres":
-            query_tree = sqlglot.parse_one(query, read=DunePostgres)
-        else:
-            query_tree = sqlglot.parse_one(query, read=sqlglot_dialect)
+        with stage("parse"):
+            if sqlglot_dialect == "postgres":
+                return sqlglot.parse_one(bytea_to_hex_strings(query), read=DunePostgres)
+            elif sqlglot_dialect == "spark":
+                return sqlglot.parse_one(query, read=DuneSpark)
+            else:
+                return sqlglot.parse_one(query, read=sqlglot_dialect)
     except ParseError as e:
-        raise DuneTranslationError(_handle_parse_error(parameter_map, e))
+        raise DuneTranslationError(_handle_parse_error(e))
     except SqlglotError as e:
         raise DuneTranslationError(str(e))
 
-    # Perform custom transformations on the AST. Transforms depend on the dataset; for legacy Postgres datasets
-    # we need to do table mappings as well.
+
+def _transform(
+    query_tree, sqlglot_dialect, dataset=None, syntax_only=False, table_mapping=None, table_mapping_index=None
+):
+    """Perform custom transformations on the AST, in place
+
+    Transforms depend on the dataset; for legacy Postgres datasets we need to do table mappings as well."""
     if sqlglot_dialect == "spark":
         try:
-            query_tree = v2_transforms(query_tree)
+            with stage("transforms"):
+                query_tree = v2_transforms(query_tree, copy=False)
         except SqlglotError as e:
             raise DuneTranslationError(str(e))
         if syntax_only:
             raise ValueError("the `syntax_only` flag does not apply for Spark queries")
     elif sqlglot_dialect == "postgres":
-        try:
-            query_tree = v1_transforms(query_tree)
-        except SqlglotError as e:
-            raise DuneTranslationError(str(e))
-        if not syntax_only:
-            # Add provided table mapping to the default mapping
-            mapping = spellbook_mapping(dataset)
-            if table_mapping is not None:
-                mapping = mapping | table_mapping
+        if syntax_only:
             try:
-                query_tree = v1_tables_to_v2_tables(query_tree, dataset, mapping)
+                with stage("transforms"):
+                    query_tree = v1_transforms(query_tree, copy=False)
             except SqlglotError as e:
                 raise DuneTranslationError(str(e))
+        else:
+            # Layer the provided table mapping on top of the index of the default (or given) mapping
+            if table_mapping_index is None:
+                table_mapping_index = spellbook_mapping_index()
+            mapping = table_mapping_index.for_dataset(dataset, table_mapping)
+            try:
+                # The syntax transforms and the table replacements are done in a single traversal, and timed together
+                with stage("transforms"):
+                    query_tree = apply_rules(query_tree, v1_rules + v1_table_rules(dataset, mapping), copy=False)
+                with stage("spell_fixes"):
+                    query_tree = v1_spell_fixes(query_tree, dataset)
+            except SqlglotError as e:
+                raise DuneTranslationError(str(e))
+
+    return query_tree
+
+
+def _optimize(query_tree, schema):
+    """Qualify the translated query with the schema, and cast operands of comparisons to the same type
+
+    Like generating the query, parsing it as DuneSQL and optimizing that with `dunesql.optimize.optimize`, but on the
+    tree: the transforms that generating DuneSQL does are done first, so the optimizer sees the same tree, like hex
+    strings where there were 0x strings, and generating the optimized tree gives the same SQL."""
+    from sqlglot.errors import OptimizeError
+
+    from dune.harmonizer.dunesql.optimize import optimize
+
+    try:
+        with stage("optimize"):
+            try:
+                return optimize(to_dunesql(query_tree), schema)
+            except OptimizeError:
+                # The generator makes a few more changes, like turning set-returning functions in FROM into UNNEST,
+                # without which some columns can't be resolved. Those queries take the round trip through SQL.
+                return optimize(sqlglot.parse_one(query_tree.sql(dialect=DuneSQL), read=DuneSQL), schema)
+    except SqlglotError as e:
+        raise DuneTranslationError(str(e))
+
 
-    # Output the query as DuneSQL
+def _generate(query_tree):
+    """Output the query as DuneSQL"""
     try:
-        query = query_tree.sql(dialect=DuneSQL, pretty=True)
+        with stage("generate"):
+            return query_tree.sql(dialect=DuneSQL, pretty=True)
     except SqlglotError as e:
         raise DuneTranslationError(str(e))
 
-    # Replace placeholders with Dune params again
-    for replace, original in parameter_map.items():
-        query = query.replace(replace, original)
 
-    # Non-SQLGlot transforms
-    query = fix_bytearray_param(query)
+def _warmup(optimizer=False):
+    """Do the one-time setup of translation up front, by translating a query in each dialect"""
+    harmonizer_version()
+    _translate(_warmup_spark_query, "spark")
+    _translate(_warmup_postgres_query, "postgres", "ethereum")
+    if optimizer:
+        from dune.harmonizer.dunesql.optimize import optimize
 
-    return add_warnings(query)
+        query_tree = sqlglot.parse_one("SELECT * FROM t WHERE a = '0x00' AND b = 0x00", read=DuneSQL)
+        optimize(query_tree, schema={"t": {"a": "varbinary", "b": "varchar"}}).sql(DuneSQL)
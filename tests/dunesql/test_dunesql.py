@@ -1,6 +1,10 @@
+import pytest
 import sqlglot
 
+from dune.harmonizer.dunesql.dunepostgres import DunePostgres
+from dune.harmonizer.dunesql.dunespark import DuneSpark
 from dune.harmonizer.dunesql.dunesql import DuneSQL
+from dune.harmonizer.dunesql.parameters import QueryParameter
 from dune.harmonizer.dunesql.transform import _looks_like_timestamp
 
 
@@ -183,3 +187,84 @@ def test_concat_of_0x_strings():
         "SELECT BYTEARRAY_CONCAT(BYTEARRAY_CONCAT(0x10, 0x20), 0x30)"
         == sqlglot.transpile("SELECT '0x10' || '0x20' || '0x30'", read="spark", write=DuneSQL)[0]
     )
+
+
+@pytest.mark.parametrize(
+    "query",
+    [
+        "SELECT {{ param }} FROM {{table}} LIMIT {{n}}",
+        "SELECT * FROM erc20_{{chain}}.tokens_{{x}}_y",
+        "SELECT INTERVAL '1' {{3 - Time Granularity}}",
+        "SELECT '{{a}}' /* {{c}} */",
+    ],
+)
+def test_parameters(query):
+    assert sqlglot.transpile(query, read=DuneSQL, write=DuneSQL)[0] == query
+    assert sqlglot.transpile(query, read=DunePostgres, write=DuneSQL)[0] == query
+    assert sqlglot.transpile(query, read=DuneSpark, write=DuneSQL)[0] == query
+
+
+def test_parameters_as_nodes():
+    assert isinstance(sqlglot.parse_one("SELECT {{ a }}", read=DuneSQL).selects[0], QueryParameter)
+    assert not sqlglot.parse_one("SELECT '{{ a }}'", read=DuneSQL).find(QueryParameter)
+
+
+@pytest.mark.parametrize(
+    "template",
+    [
+        "SELECT {}",
+        "SELECT (SELECT {} FROM t) FROM u",
+        "WITH c AS (SELECT * FROM (SELECT {} FROM t)) SELECT * FROM c",
+    ],
+)
+def test_nested_selects(template):
+    expressions = ["'0xdead' || '0x01'", "lower('0xdead')", "bytea2numeric(a)", "'true'", "'2023-01-01'"]
+    query = sqlglot.parse_one(template.format(", ".join(expressions)), read="spark")
+    original = query.copy()
+    assert query.sql(DuneSQL) == template.format(
+        "BYTEARRAY_CONCAT(0xdead, 0x01), 0xdead, BYTEARRAY_TO_BIGINT(a), TRUE, CAST('2023-01-01' AS TIMESTAMP)"
+    )
+    # Generating DuneSQL transforms a copy of the query
+    assert query == original
+
+
+@pytest.mark.parametrize(
+    "expression, expected",
+    [
+        # Each select around calls on a hex string removes the innermost call that's left
+        ("lower(lower('0xab'))", ["LOWER(0xab)", "0xab", "0xab"]),
+        ("lower(lower(lower('0xab')))", ["LOWER(LOWER(0xab))", "LOWER(0xab)", "0xab"]),
+        ("unhex(lower('0xab'))", ["FROM_HEX(0xab)", "0xab", "0xab"]),
+        (
+            "lower(lower('0x01')) || '0x02'",
+            ["CONCAT(CAST(LOWER(0x01) AS VARCHAR), CAST(0x02 AS VARCHAR))"] + ["BYTEARRAY_CONCAT(0x01, 0x02)"] * 2,
+        ),
+        # and renames the outermost bytea2numeric call that's left
+        (
+            "bytea2numeric(bytea2numeric(bytea2numeric(a)))",
+            [
+                "BYTEARRAY_TO_BIGINT(BYTEA2NUMERIC(BYTEA2NUMERIC(a)))",
+                "BYTEARRAY_TO_BIGINT(BYTEARRAY_TO_BIGINT(BYTEA2NUMERIC(a)))",
+                "BYTEARRAY_TO_BIGINT(BYTEARRAY_TO_BIGINT(BYTEARRAY_TO_BIGINT(a)))",
+            ],
+        ),
+        ("bytea2numeric((SELECT bytea2numeric(a)))", ["BYTEARRAY_TO_BIGINT((SELECT BYTEARRAY_TO_BIGINT(a)))"] * 3),
+    ],
+)
+def test_nested_selects_rewritten_per_select(expression, expected):
+    # Generating a select transforms all of it, selects nested in it included, so these are rewritten once per select
+    templates = [
+        "SELECT {} AS x",
+        "SELECT * FROM (SELECT {} AS x) AS s",
+        "WITH c AS (SELECT (SELECT {}) AS x) SELECT * FROM c",
+    ]
+    for template, sql in zip(templates, expected):
+        query = sqlglot.parse_one(template.format(expression), read="spark")
+        assert query.sql(DuneSQL) == template.format(sql)
+
+
+def test_long_arithmetic_chains():
+    sums = " + ".join(f"a{i}" for i in range(3000))
+    products = " * ".join(f"a{i}" for i in range(3000))
+    sql = sqlglot.parse_one(f"SELECT {sums}, {products} FROM t", read=DuneSQL).sql(DuneSQL)
+    assert sql == f"SELECT {sums}, {products} FROM t"
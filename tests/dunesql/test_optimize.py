@@ -1,5 +1,6 @@
 import pytest
 import sqlglot
+from sqlglot.optimizer.qualify import qualify
 from sqlglot.optimizer.qualify_columns import validate_qualify_columns
 
 from dune.harmonizer.dunesql.dunesql import DuneSQL
@@ -99,3 +100,74 @@ def test_optimize_cast(tc):
     optimized = optimize(dune_sql_expr, schema=tc["schema"])
     validate_qualify_columns(optimized)
     assert tc["out"] == optimized.sql(DuneSQL)
+
+
+@pytest.mark.parametrize("tc", testcases)
+def test_optimize_cast_scoped(tc):
+    # The scoped mode adds the same casts, but doesn't qualify the query
+    dune_sql_expr = sqlglot.parse_one(tc["in"], read=DuneSQL)
+    optimized = optimize(dune_sql_expr, schema=tc["schema"], scoped=True)
+    assert tc["out"] == qualify(optimized, schema=tc["schema"]).sql(DuneSQL)
+
+
+@pytest.mark.parametrize(
+    "query, expected",
+    [
+        (
+            "SELECT * FROM tbl WHERE col = '0xdeadbeef' AND col2 = 0xdeadbeef",
+            "SELECT * FROM tbl WHERE col = FROM_HEX('0xdeadbeef') AND col2 = CAST(0xdeadbeef AS VARCHAR)",
+        ),
+        (
+            "WITH t AS (SELECT col AS c FROM tbl) SELECT s.* FROM (SELECT * FROM t) AS s WHERE c = 'a'",
+            "WITH t AS (SELECT col AS c FROM tbl) SELECT s.* FROM (SELECT * FROM t) AS s "
+            "WHERE c = CAST('a' AS VARBINARY)",
+        ),
+        (
+            "SELECT x FROM (SELECT col AS x FROM tbl UNION ALL SELECT col FROM tbl) AS u WHERE x <> 'a'",
+            "SELECT x FROM (SELECT col AS x FROM tbl UNION ALL SELECT col FROM tbl) AS u "
+            "WHERE x <> CAST('a' AS VARBINARY)",
+        ),
+    ],
+)
+def test_optimize_scoped_through_stars_and_subqueries(query, expected):
+    schema = {"tbl": {"col": "varbinary", "col2": "varchar"}}
+    assert optimize(sqlglot.parse_one(query, read=DuneSQL), schema=schema, scoped=True).sql(DuneSQL) == expected
+
+
+@pytest.mark.parametrize(
+    "query",
+    [
+        "SELECT * FROM tbl WHERE EXISTS (SELECT 1 FROM t2 WHERE t2.a = tbl.col)",
+        "SELECT * FROM tbl WHERE EXISTS (SELECT 1 FROM t2 WHERE a = col AND b = '0x01')",
+        "SELECT * FROM tbl AS x WHERE col IN (SELECT b FROM t2 WHERE EXISTS (SELECT 1 FROM t2 AS y WHERE y.a = x.col))",
+        "SELECT (SELECT MAX(b) FROM t2 WHERE t2.b = tbl.col2) FROM tbl",
+    ],
+)
+def test_optimize_scoped_correlated_subqueries(query):
+    # Columns of the outer query are resolved like the full mode does
+    schema = {"tbl": {"col": "varbinary", "col2": "varchar"}, "t2": {"a": "varchar", "b": "varbinary"}}
+    expected = optimize(sqlglot.parse_one(query, read=DuneSQL), schema=schema).sql(DuneSQL)
+    optimized = optimize(sqlglot.parse_one(query, read=DuneSQL), schema=schema, scoped=True)
+    assert "CAST(" in expected and qualify(optimized, schema=schema).sql(DuneSQL) == expected
+
+
+def test_optimize_scoped_using_join():
+    # The columns of a USING join aren't cast, since that needs the join to be turned into an ON condition
+    schema = {"tbl": {"col": "varbinary", "k": "int"}, "u": {"col": "varchar", "z": "int"}}
+    query = "SELECT * FROM tbl JOIN u USING (col) WHERE col = 'a'"
+    full = optimize(sqlglot.parse_one(query, read=DuneSQL), schema=schema).sql(DuneSQL)
+    scoped = optimize(sqlglot.parse_one(query, read=DuneSQL), schema=schema, scoped=True)
+    assert 'ON CAST("tbl"."col" AS VARCHAR) = "u"."col"' in full
+    assert scoped.sql(DuneSQL) == "SELECT * FROM tbl JOIN u USING (col) WHERE col = CAST('a' AS VARBINARY)"
+    assert qualify(scoped, schema=schema).sql(DuneSQL) == full.replace('CAST("tbl"."col" AS VARCHAR)', '"tbl"."col"')
+
+
+@pytest.mark.parametrize("scoped, n", [(False, 1000), (True, 5000)])
+def test_optimize_long_chains(scoped, n):
+    # Qualifying, annotating and building the scopes recurse once per level of the tree
+    schema = {"tbl": {"col": "varbinary", "col2": "varchar"}}
+    conditions = " OR ".join(f"col = 'a{i}'" for i in range(n))
+    optimized = optimize(sqlglot.parse_one(f"SELECT * FROM tbl WHERE {conditions}", read=DuneSQL), schema, scoped)
+    column = "col" if scoped else '"tbl"."col"'
+    casts = " OR ".join(f"{column} = CAST('a{i}' AS VARBINARY)" for i in range(n))
+    assert optimized.sql(DuneSQL).endswith(f" WHERE {casts}")
@@ -0,0 +1,87 @@
+import sqlglot
+from sqlglot import exp
+
+from dune.harmonizer.dunesql.dunesql import DuneSQL
+from dune.harmonizer.dunesql.traversal import balanced_chains, copy_tree, transform, transform_post_order
+
+queries = [
+    "SELECT a, b AS c FROM t JOIN u ON t.x = u.y WHERE a = '0x01' OR (b = 'true' AND c = '2022-01-01')",
+    "WITH c AS (SELECT * FROM t) SELECT x FROM (SELECT * FROM c) AS s WHERE s.x IN (1, 2) UNION SELECT 1",
+    "SELECT lower('0x01') || '0x02' || x, CAST('0x03' AS VARBINARY) FROM t /* comment */ WHERE NOT a <> b",
+]
+
+
+def _rename_columns(e):
+    return exp.column(e.name.upper()) if isinstance(e, exp.Column) else e
+
+
+def _wrap_literals(e):
+    return exp.Paren(this=e) if isinstance(e, exp.Literal) and not isinstance(e.parent, exp.Paren) else e
+
+
+def test_copy_tree():
+    for query in queries:
+        tree = sqlglot.parse_one(query, read=DuneSQL)
+        copy = copy_tree(tree)
+        assert copy == tree and copy.sql(DuneSQL) == tree.sql(DuneSQL)
+        assert all(a is not b for a, b in zip(copy.walk(), tree.walk()))
+        assert all(node.parent is parent for node, parent, _ in copy.walk() if parent is not None)
+
+
+def test_transform_like_sqlglot():
+    for query in queries:
+        for fun in (_rename_columns, _wrap_literals):
+            tree = sqlglot.parse_one(query, read=DuneSQL)
+            expected = tree.transform(fun).sql(DuneSQL)
+            assert transform(tree, fun).sql(DuneSQL) == expected
+            assert tree.sql(DuneSQL) == sqlglot.parse_one(query, read=DuneSQL).sql(DuneSQL)  # not modified
+            assert transform(tree, fun, copy=False).sql(DuneSQL) == expected
+
+
+def test_transform_post_order():
+    tree = sqlglot.parse_one("SELECT (1 + 2) * 3", read=DuneSQL)
+    visited = []
+    transform_post_order(tree, lambda e: visited.append(e.key) or e)
+    assert visited == ["literal", "literal", "add", "paren", "literal", "mul", "select"]
+
+
+def test_deep_trees():
+    n = 5000
+    conditions = " OR ".join(f"x = {i}" for i in range(n))
+    tree = sqlglot.parse_one(f"SELECT * FROM t WHERE {conditions}", read=DuneSQL)
+    copy = copy_tree(tree)
+    transformed = transform(copy, _wrap_literals)
+    assert len(list(transformed.find_all(exp.Paren))) == n
+    assert transformed.sql(DuneSQL).endswith(f"x = ({n - 1})")
+
+
+def _depth(node):
+    depth = 0
+    while node.parent is not None:
+        node, depth = node.parent, depth + 1
+    return depth
+
+
+def test_balanced_chains():
+    conditions = " OR ".join(f"x = {i}" for i in range(1000))
+    tree = sqlglot.parse_one(f"SELECT a || b || c FROM t WHERE y AND ({conditions})", read=DuneSQL)
+    original = copy_tree(tree)
+    nodes = [node for node, _, _ in tree.walk(bfs=True)]
+    with balanced_chains(tree, min_length=3):
+        assert max(_depth(column) for column in tree.find_all(exp.Column)) < 20
+        assert isinstance(tree.find(exp.Paren).this.expression, exp.Or)
+        assert {id(e) for e in tree.find_all(exp.EQ)} == {id(e) for e in nodes if isinstance(e, exp.EQ)}
+    assert tree.sql(DuneSQL) == original.sql(DuneSQL)
+    assert all(a is b for a, (b, _, _) in zip(nodes, tree.walk(bfs=True)))
+    assert all(node.parent is parent for node, parent, _ in tree.walk(bfs=True) if parent is not None)
+
+
+def test_balanced_chains_with_replaced_operands():
+    conditions = " OR ".join(f"x = {i}" for i in range(1000))
+    tree = sqlglot.parse_one(f"SELECT * FROM t WHERE {conditions}", read=DuneSQL)
+    with balanced_chains(tree):
+        for eq in list(tree.find_all(exp.EQ)):
+            eq.replace(exp.NEQ(this=eq.this, expression=eq.expression))
+    assert tree.sql(DuneSQL) == f"SELECT * FROM t WHERE {conditions.replace('=', '<>')}"
+    assert max(_depth(column) for column in tree.find_all(exp.Column)) > 1000
+    assert all(node.parent is parent for node, parent, _ in tree.walk(bfs=True) if parent is not None)
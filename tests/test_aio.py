@@ -0,0 +1,120 @@
+import asyncio
+import threading
+
+import pytest
+import sqlglot
+
+from dune.harmonizer import (
+    TranslationCache,
+    TranslationObserver,
+    TranslationStats,
+    atranslate_postgres,
+    atranslate_spark,
+    translate_postgres,
+    translate_spark,
+)
+from dune.harmonizer.aio import AsyncTranslator
+from dune.harmonizer.dunesql.dunesql import DuneSQL
+from dune.harmonizer.dunesql.optimize import aoptimize, optimize
+from dune.harmonizer.errors import DuneTranslationError
+from tests.cases import postgres_test_cases, spark_test_cases
+from tests.helpers import canonicalize, read_test_case
+
+
+async def _translate_all(translator=None):
+    postgres = [
+        atranslate_postgres(read_test_case(tc)[0], dataset=tc.dataset, translator=translator)
+        for tc in postgres_test_cases
+    ]
+    spark = [atranslate_spark(read_test_case(tc)[0], translator=translator) for tc in spark_test_cases]
+    return await asyncio.gather(*postgres, *spark, return_exceptions=True)
+
+
+@pytest.mark.parametrize("processes", [False, True])
+def test_atranslate_matches_translate(processes):
+    async def translate_all():
+        async with AsyncTranslator(max_workers=2, processes=processes) as translator:
+            return await _translate_all(translator)
+
+    outputs = asyncio.run(translate_all())
+    expected = [translate_postgres(read_test_case(tc)[0], dataset=tc.dataset) for tc in postgres_test_cases] + [
+        translate_spark(read_test_case(tc)[0]) for tc in spark_test_cases
+    ]
+    assert outputs == expected
+
+
+def test_atranslate_default_translator():
+    # The default translator is shared between event loops
+    assert asyncio.run(_translate_all()) == asyncio.run(_translate_all())
+    assert canonicalize(asyncio.run(atranslate_spark("select '0xdeadbeef'"))) == "select 0xdeadbeef"
+
+
+@pytest.mark.parametrize("processes", [False, True])
+def test_atranslate_errors_and_cache(processes):
+    async def translate():
+        cache = TranslationCache()
+        async with AsyncTranslator(max_workers=1, processes=processes) as translator:
+            for _ in range(2):
+                with pytest.raises(DuneTranslationError):
+                    await atranslate_postgres("select encode(account, 'hex')", cache=cache, translator=translator)
+                output = await atranslate_postgres("select * from tbl", cache=cache, translator=translator)
+                assert canonicalize(output) == "select * from tbl"
+            with pytest.raises(ValueError):
+                await atranslate_postgres("select 1", dataset="not a dataset", translator=translator)
+        return cache.stats
+
+    stats = asyncio.run(translate())
+    assert (stats.hits, stats.misses) == (2, 2)
+
+
+class _BlockingObserver(TranslationObserver):
+    def __init__(self):
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+    def on_stage(self, stage, seconds):
+        self.started.set()
+        self.release.wait(10)
+
+
+def test_atranslate_timeout_and_cancellation():
+    async def translate():
+        async with AsyncTranslator(max_workers=1) as translator:
+            blocking = _BlockingObserver()
+            first = asyncio.create_task(translator.translate_postgres("select 1", observer=blocking))
+            await asyncio.to_thread(blocking.started.wait, 10)
+
+            # The only slot is taken, so this times out before it gets a worker, and is never run
+            stats = TranslationStats()
+            with pytest.raises(asyncio.TimeoutError):
+                await translator.translate_postgres("select 2", observer=stats, timeout=0.05)
+            assert stats.stages == {}
+
+            # The running call can be cancelled, but its slot is only freed once it's done
+            first.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await first
+            waiting = asyncio.create_task(translator.translate_postgres("select 3", observer=stats))
+            await asyncio.sleep(0.05)
+            assert not waiting.done() and stats.stages == {}
+            blocking.release.set()
+            assert canonicalize(await asyncio.wait_for(waiting, 10)) == "select 3"
+
+    asyncio.run(translate())
+
+
+def test_atranslate_observer_in_processes():
+    async def translate():
+        async with AsyncTranslator(max_workers=1, processes=True) as translator:
+            await translator.translate_spark("select 1", observer=TranslationStats())
+
+    with pytest.raises(ValueError):
+        asyncio.run(translate())
+
+
+def test_aoptimize():
+    schema = {"tbl": {"col": "varchar"}}
+    query = "SELECT col = 0xdeadbeef FROM tbl"
+    expected = optimize(sqlglot.parse_one(query, read=DuneSQL), schema).sql(DuneSQL)
+    optimized = asyncio.run(aoptimize(sqlglot.parse_one(query, read=DuneSQL), schema, timeout=10))
+    assert optimized.sql(DuneSQL) == expected
@@ -0,0 +1,69 @@
+import pytest
+
+from dune.harmonizer import (
+    TranslationRequest,
+    translate_many,
+    translate_many_postgres,
+    translate_many_spark,
+    translate_postgres,
+    translate_spark,
+)
+from dune.harmonizer.errors import DuneTranslationError
+from tests.cases import postgres_test_cases, spark_test_cases
+from tests.helpers import canonicalize, read_test_case
+
+
+def test_translate_many_matches_single_translation():
+    requests = [
+        TranslationRequest(query=read_test_case(tc)[0], dialect="postgres", dataset=tc.dataset)
+        for tc in postgres_test_cases
+    ] + [TranslationRequest(query=read_test_case(tc)[0], dialect="spark", dataset=None) for tc in spark_test_cases]
+    outputs = translate_many(requests, max_workers=2, chunksize=4)
+    assert len(outputs) == len(requests)
+    for request, output in zip(requests, outputs):
+        if request.dialect == "spark":
+            expected = translate_spark(request.query)
+        else:
+            expected = translate_postgres(request.query, dataset=request.dataset)
+        assert canonicalize(output) == canonicalize(expected)
+
+
+def test_translate_many_keeps_going_on_errors():
+    queries = ["select 1", "select encode(account, 'hex')", "select 2"]
+    outputs = translate_many_postgres(queries, max_workers=1)
+    assert canonicalize(outputs[0]) == "select 1"
+    assert isinstance(outputs[1], DuneTranslationError)
+    assert canonicalize(outputs[2]) == "select 2"
+
+
+@pytest.mark.parametrize("max_workers", [1, 2])
+def test_translate_many_returns_other_errors(max_workers):
+    deep = "select " + "(" * 2000 + "1" + ")" * 2000
+    queries = ["select 1", "select lower('\\x{{a}}')", deep, "select 2"]
+    outputs = translate_many_postgres(queries, max_workers=max_workers)
+    assert canonicalize(outputs[0]) == "select 1"
+    assert isinstance(outputs[1], ValueError)
+    assert isinstance(outputs[2], RecursionError)
+    assert canonicalize(outputs[3]) == "select 2"
+
+
+def test_translate_many_per_item_table_mapping():
+    requests = [
+        TranslationRequest(query="select * from tbl", table_mapping={"tbl": "a.new_tbl"}),
+        TranslationRequest(query="select * from tbl", table_mapping={"tbl": "b.new_tbl"}),
+    ]
+    outputs = translate_many(requests, max_workers=2)
+    assert canonicalize(outputs[0]) == "select * from a.new_tbl"
+    assert canonicalize(outputs[1]) == "select * from b.new_tbl"
+
+
+def test_translate_many_spark():
+    outputs = translate_many_spark(["select '0xdeadbeef'", "select 1"], max_workers=1)
+    assert [canonicalize(o) for o in outputs] == ["select 0xdeadbeef", "select 1"]
+
+
+def test_translate_many_invalid_arguments():
+    with pytest.raises(ValueError):
+        translate_many_postgres(["select 1"], dataset="not a dataset")
+    with pytest.raises(ValueError):
+        translate_many([TranslationRequest(query="select 1", dialect="spark", syntax_only=True)])
@@ -0,0 +1,102 @@
+import pickle
+
+import pytest
+
+from dune.harmonizer import TranslationCache, translate_many_postgres, translate_postgres, translate_spark
+from dune.harmonizer.cache import _normalize_query, cache_key
+from dune.harmonizer.errors import DuneTranslationError
+
+
+def test_normalize_query():
+    assert _normalize_query("select  'a  b',\n\t\"x  y\"   from t") == "select 'a  b', \"x  y\" from t"
+    assert _normalize_query("select 1 -- comment\n  from t") == "select 1 -- comment\n from t"
+    assert _normalize_query("select {{ param  name }}") == "select {{ param  name }}"
+
+
+@pytest.mark.parametrize(
+    "dialect, query",
+    [
+        ("spark", "select `a  b` from t"),
+        ("spark", "select 'it\\'s  a'"),
+        ("postgres", "select $$a  b$$"),
+        ("postgres", "select $x$a  b$x$"),
+        ("postgres", "select E'a\\'  b'"),
+        ("postgres", "select E'a  b'"),
+    ],
+)
+def test_normalize_query_keeps_quoted_whitespace(dialect, query):
+    assert _normalize_query(query, dialect) == query
+    assert cache_key(query, dialect) != cache_key(query.replace("  ", " "), dialect)
+    translate = translate_spark if dialect == "spark" else translate_postgres
+    cache = TranslationCache()
+    for q in (query, query.replace("  ", " ")):
+        try:
+            expected = translate(q)
+        except (DuneTranslationError, ValueError):
+            continue
+        assert translate(q, cache=cache) == expected
+
+
+def test_cache_key():
+    assert cache_key("select 1", "postgres", "ethereum") == cache_key("select\n   1 ", "postgres", "ethereum")
+    assert cache_key("select 1", "postgres", "ethereum") != cache_key("select 1", "postgres", "polygon")
+    assert cache_key("select 1", "postgres", "ethereum") != cache_key("select 1", "spark")
+    assert cache_key("select 1", "postgres", "ethereum", table_mapping={"a": "b"}) != cache_key(
+        "select 1", "postgres", "ethereum", table_mapping={"a": "c"}
+    )
+    assert cache_key("select 1", "spark", schema={"t": {"a": "int"}}) != cache_key("select 1", "spark")
+    assert cache_key("select 1", "spark", schema={"t": {"a": "int", "b": "int"}}) == cache_key(
+        "select 1", "spark", schema={"t": {"b": "int", "a": "int"}}
+    )
+
+
+def test_cache_hits():
+    cache = TranslationCache()
+    output = translate_postgres("select * from erc20.tokens", cache=cache)
+    assert translate_postgres("select *\nfrom erc20.tokens", cache=cache) == output
+    assert translate_spark("select * from erc20.tokens", cache=cache) != output
+    assert (cache.stats.hits, cache.stats.misses) == (1, 2)
+
+
+def test_cache_errors():
+    cache = TranslationCache()
+    for _ in range(2):
+        with pytest.raises(DuneTranslationError) as e:
+            translate_postgres("select encode(account, 'hex')", cache=cache)
+    assert e.value.detail == "Unsupported charset 'hex'"
+    assert (cache.stats.hits, cache.stats.misses) == (1, 1)
+
+
+def test_cache_eviction():
+    cache = TranslationCache(max_entries=2)
+    for i in range(3):
+        cache.put(str(i), f"select {i}")
+    assert len(cache) == 2 and cache.get("0") is None and cache.get("2") == "select 2"
+    assert cache.stats.evictions == 1
+
+    cache = TranslationCache(max_bytes=100)
+    cache.put("a", "x" * 60)
+    cache.put("b", "x" * 60)
+    assert cache.get("a") is None and cache.get("b") is not None
+
+
+def test_persistent_cache(tmp_path):
+    path = tmp_path / "cache.db"
+    cache = TranslationCache(path=path)
+    cache.put("query", "select 1")
+    cache.put("error", DuneTranslationError("bad query"))
+
+    # A copy in another process starts with an empty in-memory cache, and finds the entries in the database
+    other = pickle.loads(pickle.dumps(cache))
+    assert len(other) == 0
+    assert other.get("query") == "select 1"
+    assert other.get("error").detail == "bad query"
+    assert other.stats.persistent_hits == 2
+
+
+def test_translate_many_with_cache():
+    cache = TranslationCache()
+    translate_many_postgres(["select 1", "select 2"], max_workers=1, cache=cache)
+    outputs = translate_many_postgres(["select 1", "select 3"], max_workers=1, cache=cache)
+    assert [o.strip().split()[-1] for o in outputs] == ["1", "3"]
+    assert (cache.stats.hits, cache.stats.misses) == (1, 3)
@@ -0,0 +1,56 @@
+import json
+
+import pytest
+
+from dune.harmonizer import translate_postgres, translate_spark
+from dune.harmonizer.cli import main, translate_lines
+from tests.helpers import canonicalize
+
+
+def _lines(records):
+    return [json.dumps(record) + "\n" for record in records]
+
+
+RECORDS = [
+    {"id": 1, "dialect": "postgres", "dataset": "polygon", "query": "SELECT * FROM erc20.tokens"},
+    {"id": 2, "dialect": "spark", "query": "SELECT '0xdeadbeef'"},
+    {"id": 3, "dialect": "postgres", "query": "select encode(account, 'hex')"},
+    {"id": 4, "query": "select 1"},
+]
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_translate_lines(workers):
+    results = {r["id"]: r for r in translate_lines(_lines(RECORDS), workers=workers)}
+    assert set(results) == {1, 2, 3, 4}
+    assert canonicalize(results[1]["query"]) == canonicalize(
+        translate_postgres("SELECT * FROM erc20.tokens", dataset="polygon")
+    )
+    assert canonicalize(results[2]["query"]) == canonicalize(translate_spark("SELECT '0xdeadbeef'"))
+    assert results[3]["error_type"] == "DuneTranslationError"
+    assert "hex" in results[3]["error"]
+    assert canonicalize(results[4]["query"]) == "select 1"
+    assert all(r["seconds"] >= 0 for r in results.values())
+
+
+def test_translate_lines_ordered():
+    records = [{"id": i, "query": f"select {i}"} for i in range(20)]
+    results = list(translate_lines(_lines(records), workers=2, ordered=True, max_in_flight=3))
+    assert [r["id"] for r in results] == list(range(20))
+
+
+def test_translate_lines_bad_input():
+    lines = ["not json\n", "\n", json.dumps({"id": 1, "dialect": "mysql", "query": "select 1"}) + "\n"]
+    results = list(translate_lines(lines))
+    assert len(results) == 2
+    assert results[0]["id"] is None and results[0]["error_type"] == "JSONDecodeError"
+    assert results[1]["id"] == 1 and results[1]["error"] == "Unknown dialect: mysql"
+
+
+def test_main(tmp_path):
+    input_path = tmp_path / "queries.jsonl"
+    output_path = tmp_path / "results.jsonl"
+    input_path.write_text("".join(_lines(RECORDS)))
+    main([str(input_path), "-o", str(output_path), "--dataset", "gnosis", "--ordered"])
+    results = [json.loads(line) for line in output_path.read_text().splitlines()]
+    assert [r["id"] for r in results] == [1, 2, 3, 4]
@@ -0,0 +1,75 @@
+import pytest
+import sqlglot
+from sqlglot import exp
+
+from dune.harmonizer.custom_transforms import Rule, apply_rules, v1_rules, v1_table_rules, v2_rules
+from dune.harmonizer.dunesql.dunepostgres import DunePostgres, bytea_to_hex_strings
+from dune.harmonizer.dunesql.dunespark import DuneSpark
+from dune.harmonizer.table_replacements import spellbook_mapping_index
+from tests.cases import postgres_test_cases, spark_test_cases
+from tests.helpers import read_test_case
+
+
+def _apply_sequentially(query_tree, rules):
+    for rule in rules:
+        query_tree = query_tree.transform(rule.transform)
+    return query_tree
+
+
+@pytest.mark.parametrize(
+    "query",
+    [
+        "SELECT (a / b) / c, x[0][1] FROM t",
+        "SELECT sequence(1, 2), a / b FROM t WHERE c = '{{start date}}'",
+    ],
+)
+def test_apply_rules_matches_sequential_transforms(query):
+    query_tree = sqlglot.parse_one(query, read="spark")
+    assert apply_rules(query_tree, v2_rules) == _apply_sequentially(query_tree, v2_rules)
+
+
+@pytest.mark.parametrize("test_case", postgres_test_cases)
+def test_apply_rules_matches_sequential_transforms_postgres_cases(test_case):
+    query, _ = read_test_case(test_case)
+    query_tree = sqlglot.parse_one(bytea_to_hex_strings(query), read=DunePostgres)
+    for rules in (
+        v1_rules,
+        v1_rules + v1_table_rules(test_case.dataset, spellbook_mapping_index().for_dataset(test_case.dataset)),
+    ):
+        assert apply_rules(query_tree, rules) == _apply_sequentially(query_tree, rules)
+
+
+@pytest.mark.parametrize("test_case", spark_test_cases)
+def test_apply_rules_matches_sequential_transforms_spark_cases(test_case):
+    query, _ = read_test_case(test_case)
+    query_tree = sqlglot.parse_one(query, read=DuneSpark)
+    assert apply_rules(query_tree, v2_rules) == _apply_sequentially(query_tree, v2_rules)
+
+
+def test_apply_rules_dispatches_on_node_type():
+    visited = []
+
+    def visit(node):
+        visited.append(type(node))
+        return node
+
+    apply_rules(sqlglot.parse_one("SELECT a / b, 1 FROM t"), (Rule(visit, (exp.Div, exp.Literal)),))
+    assert visited == [exp.Div, exp.Literal]
+
+
+def test_apply_rules_skips_rules_that_cant_apply():
+    def fail(node):
+        raise AssertionError("rule should have been skipped")
+
+    query_tree = sqlglot.parse_one("SELECT a + 1 FROM t")
+    rules = (Rule(fail, (exp.Div,)), Rule(fail, applies=lambda features: "sequence" in features.names))
+    assert apply_rules(query_tree, rules) == query_tree
+
+
+def test_apply_rules_enables_rules_for_new_nodes():
+    # The first rule brings in a division, which the second rule must then see
+    rules = (
+        Rule(lambda node: sqlglot.parse_one("a / b") if node.name == "x" else node, (exp.Column,)),
+        Rule(lambda node: exp.Anonymous(this="div", expressions=[node.left, node.right]), (exp.Div,)),
+    )
+    assert apply_rules(sqlglot.parse_one("SELECT x + y FROM t"), rules).sql() == "SELECT DIV(a, b) + y FROM t"
@@ -0,0 +1,28 @@
+from dune.harmonizer import TranslationObserver, TranslationStats, observe, translate_postgres, translate_spark
+
+
+def test_stages_and_rules_are_reported():
+    stats = TranslationStats()
+    translate_postgres("SELECT * FROM erc20.tokens WHERE a / 2 > 1", dataset="ethereum", observer=stats)
+    assert list(stats.stages) == ["parse", "transforms", "spell_fixes", "generate", "postprocess"]
+    assert stats.rules["table_replacement_transform"].nodes_rewritten == 1
+    assert stats.rules["cast_division_to_double"].nodes_visited == 1
+    # Skipped, since there are no parameters in the query
+    assert stats.rules["cast_timestamp_parameters"].nodes_visited == 0
+    # Rules that are partial functions are reported by the name of the function
+    assert stats.rules["chain_where_blockchain"].nodes_visited == 1
+
+
+def test_observe_context():
+    class StageNames(TranslationObserver):
+        def __init__(self):
+            self.names = []
+
+        def on_stage(self, stage, seconds):
+            self.names.append(stage)
+
+    observer = StageNames()
+    with observe(observer):
+        translate_spark("SELECT 1")
+    translate_spark("SELECT 2")
+    assert observer.names == ["parse", "transforms", "generate", "postprocess"]
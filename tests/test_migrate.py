@@ -0,0 +1,118 @@
+import json
+import sqlite3
+from contextlib import closing
+
+import pytest
+
+from dune.harmonizer import TableMappingIndex, translate_postgres, translate_spark
+from dune.harmonizer import migrate as migrate_module
+from dune.harmonizer.migrate import error_class, main, migrate, summarize
+
+RECORDS = [
+    {"id": 1, "dialect": "postgres", "dataset": "polygon", "query": "SELECT * FROM erc20.tokens"},
+    {"id": 2, "dialect": "spark", "query": "SELECT '0xdeadbeef'"},
+    {"id": 3, "query": "select encode(account, 'hex')"},
+    {"id": "four", "query": "select encode(x, 'escape')"},
+    {"id": 5, "query": "select * from"},
+    {"id": 6, "query": "select 1"},
+    {"id": 7, "query": "select * from t where x = 'a"},
+]
+
+
+@pytest.fixture
+def corpus(tmp_path):
+    path = tmp_path / "queries.jsonl"
+    path.write_text("".join(json.dumps(record) + "\n" for record in RECORDS) + "\nnot json\n")
+    return path
+
+
+def _results(path):
+    with closing(sqlite3.connect(path)) as connection:
+        return {row[0]: row[1:] for row in connection.execute("select id, query, error, error_class from results")}
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_migrate(corpus, tmp_path, workers):
+    results_path = tmp_path / "results.db"
+    summary = migrate(corpus, results_path, workers=workers, shard_size=3)
+    results = _results(results_path)
+    assert results[1][0] == translate_postgres("SELECT * FROM erc20.tokens", dataset="polygon")
+    assert results[2][0] == translate_spark("SELECT '0xdeadbeef'")
+    assert results[3][1:] == ("Unsupported charset 'hex'", "Unsupported charset 'hex'")
+    assert results[5][2] == "Expected table name but got None."
+    assert results[None][1].startswith("Expecting value")
+
+    assert (summary.queries, summary.errors, summary.run_queries) == (8, 5, 8)
+    assert summary.error_classes == {
+        "Expected table name but got None.": 1,
+        "Unsupported charset 'escape'": 1,
+        "Unsupported charset 'hex'": 1,
+    }
+    assert summary.error_types == {"DuneTranslationError": 3, "JSONDecodeError": 1, "ValueError": 1}
+    assert list(summary.latency) == [50, 90, 99, 99.9] and summary.queries_per_second > 0
+    assert "DuneTranslationError by class:\n         1 Expected table name" in summary.format()
+
+
+def test_migrate_resumes(corpus, tmp_path, monkeypatch):
+    results_path = tmp_path / "results.db"
+    write_shard = migrate_module._write_shard
+
+    def crash_after_first_shard(connection, shard, *args):
+        if shard > 0:
+            raise KeyboardInterrupt
+        write_shard(connection, shard, *args)
+
+    monkeypatch.setattr(migrate_module, "_write_shard", crash_after_first_shard)
+    with pytest.raises(KeyboardInterrupt):
+        migrate(corpus, results_path, workers=1, shard_size=3)
+    assert summarize(results_path).queries == 3
+
+    monkeypatch.setattr(migrate_module, "_write_shard", write_shard)
+    summary = migrate(corpus, results_path, workers=1, shard_size=3)
+    assert (summary.queries, summary.run_queries) == (8, 5)
+    assert migrate(corpus, results_path, workers=1, shard_size=3).run_queries == 0
+    with pytest.raises(ValueError):
+        migrate(corpus, results_path, workers=1, shard_size=4)
+
+
+@pytest.mark.parametrize(
+    "name, settings",
+    [
+        ("shard_size", {"shard_size": 4}),
+        ("dialect", {"dialect": "spark"}),
+        ("dataset", {"dataset": "polygon"}),
+        ("table_mapping_digest", {"table_mapping_index": TableMappingIndex({"ethereum": {"erc20.tokens": "t"}})}),
+    ],
+)
+def test_migrate_resume_checks_settings(corpus, tmp_path, name, settings):
+    results_path = tmp_path / "results.db"
+    migrate(corpus, results_path, workers=1, shard_size=3)
+    assert migrate(corpus, results_path, workers=1, shard_size=3).run_queries == 0
+    with pytest.raises(ValueError, match=f"started with {name} "):
+        migrate(corpus, results_path, **{"workers": 1, "shard_size": 3, **settings})
+
+
+def test_migrate_resume_checks_version(corpus, tmp_path, monkeypatch):
+    results_path = tmp_path / "results.db"
+    migrate(corpus, results_path, workers=1, shard_size=3)
+    monkeypatch.setattr(migrate_module, "harmonizer_version", lambda: "0.0.0")
+    with pytest.raises(ValueError, match="started with harmonizer_version .*, not '0.0.0'"):
+        migrate(corpus, results_path, workers=1, shard_size=3)
+
+
+def test_migrate_from_sqlite(tmp_path, capsys):
+    input_path = tmp_path / "queries.db"
+    with closing(sqlite3.connect(input_path)) as connection, connection:
+        connection.execute("create table queries (id, query, dialect, dataset)")
+        connection.executemany(
+            "insert into queries values (?, ?, ?, ?)",
+            [(r["id"], r["query"], r.get("dialect"), r.get("dataset")) for r in RECORDS],
+        )
+    main([str(input_path), str(tmp_path / "results.db"), "--table", "queries", "-j", "1", "--shard-size", "2"])
+    assert _results(tmp_path / "results.db")[6][0] == translate_postgres("select 1")
+    assert "queries: 7, errors: 4" in capsys.readouterr().out
+
+
+def test_error_class():
+    assert error_class("Expecting ).\n  select foo>>>(<<<") == "Expecting )."
+    assert error_class("Invalid interval unit 12 days") == "Invalid interval unit N days"
@@ -0,0 +1,104 @@
+import pytest
+
+from dune.harmonizer import (
+    prefilter,
+    translate_postgres,
+    translate_postgres_result,
+    translate_spark,
+    translate_spark_result,
+)
+from dune.harmonizer.custom_transforms import generated_view_warning
+from dune.harmonizer.errors import DuneTranslationError
+from dune.harmonizer.prefilter import PrefilterMatch, PrefilterRule, check, scan
+
+
+def _translation_error(query, dialect, monkeypatch):
+    with monkeypatch.context() as m:
+        m.setattr(prefilter, "prefilter_rules", [])
+        with pytest.raises(DuneTranslationError) as e:
+            translate_spark(query) if dialect == "spark" else translate_postgres(query)
+    return e.value.detail
+
+
+@pytest.mark.parametrize("dialect", ["postgres", "spark"])
+@pytest.mark.parametrize(
+    "query",
+    [
+        "select encode(account, 'hex') from t",
+        "select DECODE(substr(x, 1, 2), 'Base64') from t where y = '\\x00'",
+        "with a as (select 1 as x) select encode(array[x, 2], 'escape') || decode(x, 'utf-8') from a",
+    ],
+)
+def test_rejected_like_translation(query, dialect, monkeypatch):
+    detail = _translation_error(query, dialect, monkeypatch)
+    with pytest.raises(DuneTranslationError) as e:
+        check(query, dialect)
+    assert e.value.detail == detail
+
+
+@pytest.mark.parametrize("dialect", ["postgres", "spark"])
+@pytest.mark.parametrize("query", ["select encode(account, 'hex') from t", "select lower(replace) from t"])
+def test_rejected_like_result(query, dialect):
+    translate, translate_result = {
+        "postgres": (translate_postgres, translate_postgres_result),
+        "spark": (translate_spark, translate_spark_result),
+    }[dialect]
+    with pytest.raises(DuneTranslationError) as e:
+        translate(query)
+    with pytest.raises(DuneTranslationError) as result_error:
+        translate_result(query)
+    assert result_error.value.detail == e.value.detail
+
+
+@pytest.mark.parametrize("dialect", ["postgres", "spark"])
+def test_rejected_before_syntax_errors(dialect, monkeypatch):
+    query = "select encode(x, 'hex') from t where"
+    assert _translation_error(query, dialect, monkeypatch) != "Unsupported charset 'hex'"
+    with pytest.raises(DuneTranslationError) as e:
+        check(query, dialect)
+    assert e.value.detail == "Unsupported charset 'hex'"
+
+
+@pytest.mark.parametrize(
+    "query",
+    [
+        "select decode(x, 'utf-8') from t",
+        "select t.encode(x, 'hex') from t",
+        "select encode(x, 'true') from t",
+        "select encode(x, '0x00') from t",
+        "select encode(x, 'hex', 1) from t",
+        "select 'encode(x, ''hex'')' from t -- encode(x, 'hex')",
+        "select encode(x, 'hex' from t where y = 'unterminated",
+    ],
+)
+def test_not_rejected(query):
+    check(query, "postgres")
+
+
+def test_scan():
+    matches = scan("select replace, encode(x, 'hex') from dune_user_generated.v", "postgres")
+    assert matches == [
+        PrefilterMatch("unsupported_charset", "Unsupported charset 'hex'", reject=True),
+        PrefilterMatch("keyword_as_name", "replace is a keyword, and needs to be quoted to be used as a name", False),
+        PrefilterMatch("generated_view", generated_view_warning, reject=False),
+    ]
+    assert scan('select replace(a, b, c), "replace", t.replace from t group by rollup (a)', "spark") == []
+
+
+@pytest.mark.parametrize(
+    "query", ["select lower(replace) from t", "select a from t where cube = 1", "select a from t order by lock"]
+)
+def test_keywords_as_names_fail(query, monkeypatch):
+    assert [m.rule for m in scan(query, "postgres")] == ["keyword_as_name"]
+    assert _translation_error(query, "postgres", monkeypatch)
+
+
+def test_custom_rule(monkeypatch):
+    def select_star(tokens):
+        return "No SELECT *" if any(token.text == "*" for token in tokens) else None
+
+    rule = PrefilterRule("select_star", select_star, words=("*",), reject=True)
+    assert [m.rule for m in scan("select * from t", "spark", rules=[rule])] == ["select_star"]
+    monkeypatch.setattr(prefilter, "prefilter_rules", prefilter.prefilter_rules + [rule])
+    with pytest.raises(DuneTranslationError, match="No SELECT"):
+        translate_spark("select * from t")
@@ -0,0 +1,76 @@
+import pickle
+
+import pytest
+import sqlglot
+from sqlglot import exp
+
+from dune.harmonizer import (
+    TranslationResult,
+    prefilter,
+    translate_postgres,
+    translate_postgres_result,
+    translate_spark,
+    translate_spark_result,
+)
+from dune.harmonizer.dunesql.dunesql import DuneSQL
+from dune.harmonizer.dunesql.optimize import optimize
+from dune.harmonizer.errors import DuneTranslationError
+from tests.cases import postgres_test_cases, spark_test_cases
+from tests.helpers import read_test_case
+
+
+@pytest.mark.parametrize("test_case", postgres_test_cases + spark_test_cases)
+def test_result_matches_translation(test_case):
+    query = read_test_case(test_case)[0]
+    if test_case in spark_test_cases:
+        expected, result = translate_spark(query), translate_spark_result(query)
+    else:
+        expected = translate_postgres(query, dataset=test_case.dataset)
+        result = translate_postgres_result(query, dataset=test_case.dataset)
+    assert result.sql() == str(result) == expected
+    # The expression is the tree of the DuneSQL query, and generates the same SQL
+    assert result.expression.sql(DuneSQL, pretty=True) == result.sql(warnings=False)
+    data = pickle.dumps(result)
+    assert len(data) < len(pickle.dumps(result._tree))
+    loaded = pickle.loads(data)
+    assert loaded.sql() == expected and loaded.sql(pretty=False) == result.sql(pretty=False)
+
+
+def test_result_expression():
+    result = translate_spark_result("SELECT * FROM tbl WHERE col = '0xdeadbeef' AND day > '2022-01-01'")
+    assert isinstance(result.expression.find(exp.HexString), exp.HexString)
+    assert result.expression.find(exp.Cast).to.this == exp.DataType.Type.TIMESTAMP
+    schema = {"tbl": {"col": "varchar", "day": "timestamp"}}
+    expected = optimize(sqlglot.parse_one(result.sql(), read=DuneSQL), schema).sql(DuneSQL)
+    assert optimize(result.expression, schema).sql(DuneSQL) == expected
+    assert [t.name for t in result.expression.find_all(exp.Table)] == ["tbl"]
+
+
+def test_result_parameters_and_warnings():
+    result = translate_postgres_result(
+        "SELECT * FROM dune_user_generated.t WHERE a = lower('{{addr}}') AND b > {{ start date }} LIMIT {{n}}"
+    )
+    assert sorted(result.parameters) == ["addr", "n", "start date"]
+    assert len(result.warnings) == 1 and result.sql().startswith("/* !Generated view warning")
+    assert result.sql(pretty=False, warnings=False).startswith("SELECT * FROM dune_user_generated.t WHERE")
+    assert translate_spark_result("SELECT 1").warnings == []
+
+
+def test_result_errors(monkeypatch):
+    with pytest.raises(DuneTranslationError):
+        translate_postgres_result("select * from")
+    # Some errors are only found while generating the SQL, if the prefilter doesn't catch them before parsing
+    monkeypatch.setattr(prefilter, "prefilter_rules", [])
+    result = translate_postgres_result("select encode(account, 'hex')")
+    with pytest.raises(DuneTranslationError):
+        result.sql()
+
+
+def test_result_bytes():
+    # Very deep trees, which can't be pickled as they are
+    conditions = " OR ".join(f"x = '0x{i:04x}' -- {i}\n" for i in range(3000))
+    result = translate_postgres_result(f"SELECT * FROM ethereum.transactions WHERE {conditions}", dataset="ethereum")
+    data = result.to_bytes()
+    assert TranslationResult.from_bytes(data).sql() == result.sql()
+    with pytest.raises(ValueError):
+        TranslationResult.from_bytes(data.replace(b"Column", b"Kolumn"))
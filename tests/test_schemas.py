@@ -1,10 +1,15 @@
 import sqlite3
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from contextlib import closing
 from pathlib import Path
 
 import pytest
+import sqlglot
+from sqlglot import exp
 
-from dune.harmonizer.schemas import schema_from_sqlite
+from dune.harmonizer.dunesql.dunesql import DuneSQL
+from dune.harmonizer.dunesql.optimize import optimize
+from dune.harmonizer.schemas import SQLiteSchema, schema_from_sqlite
 
 
 @pytest.fixture
@@ -27,3 +32,37 @@ def test_schema_from_sqlite(schema_db):
     db, name = schema_db
     schema = schema_from_sqlite(db, name)
     assert schema["tbl"]["col"] == "int"
+
+
+def test_sqlite_schema(schema_db):
+    db, name = schema_db
+    schema = SQLiteSchema(db, name)
+    assert schema.column_names("tbl") == ["col", "x"]
+    assert schema.get_column_type("TBL", "X").this == exp.DataType.Type.BOOLEAN
+    assert schema.get_column_type("tbl", "missing").this == exp.DataType.Type.UNKNOWN
+    assert schema.column_names("missing_tbl") == []
+
+
+def test_sqlite_schema_evicts_least_recently_used(schema_db):
+    db, name = schema_db
+    schema = SQLiteSchema(db, name, max_tables=1)
+    schema.column_names("tbl")
+    schema.column_names("other_tbl")
+    assert list(schema._tables) == [("other_tbl",)]
+
+
+def test_sqlite_schema_optimize(schema_db):
+    db, name = schema_db
+    query = "SELECT col FROM tbl WHERE col = '1'"
+    expected = optimize(sqlglot.parse_one(query, read=DuneSQL), schema=schema_from_sqlite(db, name)).sql(DuneSQL)
+    optimized = optimize(sqlglot.parse_one(query, read=DuneSQL), schema=SQLiteSchema(db, name)).sql(DuneSQL)
+    assert optimized == expected
+
+
+def test_sqlite_schema_threads_and_processes(schema_db):
+    db, name = schema_db
+    schema = SQLiteSchema(db, name)
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        assert list(pool.map(schema.column_names, ["tbl"] * 8)) == [["col", "x"]] * 8
+    with ProcessPoolExecutor(max_workers=2) as pool:
+        assert list(pool.map(schema.column_names, ["tbl", "other_tbl"])) == [["col", "x"], ["z"]]
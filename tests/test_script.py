@@ -0,0 +1,94 @@
+import io
+import tracemalloc
+
+import pytest
+
+from dune.harmonizer import translate_postgres, translate_script_postgres, translate_script_spark, translate_spark
+from dune.harmonizer.errors import DuneTranslationError
+from dune.harmonizer.script import split_statements
+
+SCRIPT = """-- the tokens; and the trades
+SELECT * FROM erc20.tokens WHERE symbol = 'a;b';
+select encode(x, 'hex') from t; /* done; */
+
+SELECT "a;" FROM t -- trailing;
+;;
+-- only a comment;
+"""
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 7, 1 << 16])
+def test_split_statements(chunk_size):
+    expected = [
+        (1, "-- the tokens; and the trades\nSELECT * FROM erc20.tokens WHERE symbol = 'a;b'"),
+        (3, "select encode(x, 'hex') from t"),
+        (3, '/* done; */\n\nSELECT "a;" FROM t -- trailing;'),
+    ]
+    assert list(split_statements(SCRIPT)) == expected
+    assert list(split_statements(io.StringIO(SCRIPT), chunk_size=chunk_size)) == expected
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 3, 5, 1 << 16])
+def test_split_dollar_quoted_statements(chunk_size):
+    script = (
+        "select $$a; 'b$$, $x$c;$$;$x$ from t;\n"
+        "select a$b$ from t where x = $1; select $body$ $ $b$ ;$body$;\n"
+        "select $$ $"
+    )
+    expected = [
+        (1, "select $$a; 'b$$, $x$c;$$;$x$ from t"),
+        (2, "select a$b$ from t where x = $1"),
+        (2, "select $body$ $ $b$ ;$body$"),
+        (3, "select $$ $"),
+    ]
+    assert list(split_statements(script)) == expected
+    assert list(split_statements(io.StringIO(script), chunk_size=chunk_size)) == expected
+    assert [query for _, query in split_statements("select $$;$$", "spark")] == ["select $$", "$$"]
+
+
+def test_split_spark_statements():
+    script = "select 'it\\'s;', \"a;\" from t; select `b;` from t; select 'unterminated;"
+    assert [query for _, query in split_statements(script, "spark")] == [
+        "select 'it\\'s;', \"a;\" from t",
+        "select `b;` from t",
+        "select 'unterminated;",
+    ]
+
+
+def test_translate_script():
+    sink = io.StringIO()
+    statements = list(translate_script_postgres(SCRIPT, dataset="polygon", sink=sink))
+    assert [s.index for s in statements] == [0, 1, 2]
+    assert statements[0].translated == translate_postgres(statements[0].query, dataset="polygon")
+    assert statements[1].translated is None and isinstance(statements[1].error, DuneTranslationError)
+    assert statements[1].error.detail == "Unsupported charset 'hex'"
+    assert sink.getvalue() == (
+        f"{statements[0].translated};\n\n"
+        "/* DuneTranslationError in statement 2: Unsupported charset 'hex' */\n"
+        "select encode(x, 'hex') from t;\n\n"
+        f"{statements[2].translated};\n\n"
+    )
+    statements = translate_script_spark("SELECT '0xdeadbeef'; SELECT * FROM; SELECT 1")
+    assert next(statements).translated == translate_spark("SELECT '0xdeadbeef'")
+    assert next(statements).error is not None
+    assert next(statements).translated == translate_spark("SELECT 1")
+
+
+def test_translate_script_other_errors():
+    deep = "select " + "lower(" * 400 + "x" + ")" * 400
+    sink = io.StringIO()
+    statements = list(translate_script_postgres(f"select 1; {deep}; select 2", sink=sink))
+    assert isinstance(statements[1].error, RecursionError) and statements[1].translated is None
+    assert statements[0].translated == translate_postgres("select 1")
+    assert statements[2].translated == translate_postgres("select 2")
+    assert "/* RecursionError in statement 2: " in sink.getvalue()
+
+
+def test_split_large_script_in_bounded_memory():
+    script = io.StringIO("".join(f"SELECT {i} FROM t WHERE a = '{i};'; -- {i}\n" for i in range(20_000)))
+    tracemalloc.start()
+    try:
+        assert sum(1 for _ in split_statements(script, chunk_size=4096)) == 20_000
+        assert tracemalloc.get_traced_memory()[1] < 100_000
+    finally:
+        tracemalloc.stop()
@@ -0,0 +1,150 @@
+import asyncio
+import json
+import threading
+
+import pytest
+
+from dune.harmonizer import TranslationCache, translate_postgres, translate_spark
+from dune.harmonizer.server import TranslationServer, _optimize_query
+from tests.helpers import canonicalize
+
+
+async def _post(server, path, record):
+    status, content_type, body, headers = await server.handle("POST", path, json.dumps(record).encode())
+    return status, json.loads(body), headers
+
+
+@pytest.mark.parametrize("threads", [True, False])
+def test_translate(threads):
+    async def translate():
+        server = TranslationServer(workers=2, threads=threads, cache=TranslationCache())
+        try:
+            await server.start_workers()
+            postgres = await _post(server, "/translate", {"query": "SELECT * FROM erc20.tokens", "dataset": "polygon"})
+            spark = await _post(server, "/translate", {"query": "SELECT '0xdeadbeef'", "dialect": "spark"})
+            error = await _post(server, "/translate", {"query": "select encode(account, 'hex')"})
+            bad_dataset = await _post(server, "/translate", {"query": "select 1", "dataset": "not a dataset"})
+            return postgres, spark, error, bad_dataset
+        finally:
+            server.close()
+
+    postgres, spark, error, bad_dataset = asyncio.run(translate())
+    assert postgres == (200, {"query": translate_postgres("SELECT * FROM erc20.tokens", dataset="polygon")}, {})
+    assert spark == (200, {"query": translate_spark("SELECT '0xdeadbeef'")}, {})
+    assert error[0] == 400 and error[1]["error_type"] == "DuneTranslationError" and "hex" in error[1]["error"]
+    assert bad_dataset[0] == 400 and bad_dataset[1]["error_type"] == "ValueError"
+
+
+def test_bad_requests():
+    async def requests():
+        server = TranslationServer(workers=1, threads=True)
+        try:
+            return [
+                await server.handle("GET", "/nothing"),
+                await server.handle("GET", "/translate"),
+                await server.handle("POST", "/translate", b"not json"),
+                await server.handle("POST", "/translate", b'{"dialect": "spark"}'),
+                await server.handle("POST", "/optimize", b'{"query": "SELECT 1"}'),
+            ]
+        finally:
+            server.close()
+
+    assert [status for status, *_ in asyncio.run(requests())] == [404, 405, 400, 400, 400]
+
+
+def test_coalescing_and_backpressure():
+    started = threading.Event()
+    release = threading.Event()
+
+    class BlockingCache(TranslationCache):
+        def put(self, key, result):
+            started.set()
+            release.wait(10)
+            super().put(key, result)
+
+    async def requests():
+        server = TranslationServer(workers=1, threads=True, max_in_flight=2, cache=BlockingCache())
+        try:
+            same = [_post(server, "/translate", {"query": "select 1"}) for _ in range(5)]
+            waiting = asyncio.ensure_future(asyncio.gather(*same, _post(server, "/translate", {"query": "select 2"})))
+            await asyncio.to_thread(started.wait, 10)
+            # Two distinct requests are in flight, so a third one is turned away
+            rejected = await _post(server, "/translate", {"query": "select 3"})
+            release.set()
+            return await waiting, rejected, server.metrics()
+        finally:
+            server.close()
+
+    responses, rejected, metrics = asyncio.run(requests())
+    assert [canonicalize(body["query"]) for _, body, _ in responses] == ["select 1"] * 5 + ["select 2"]
+    assert rejected[0] == 503 and rejected[2] == {"Retry-After": "1"}
+    assert "harmonizer_coalesced_requests_total 4" in metrics
+    assert 'harmonizer_requests_total{endpoint="/translate",status="200"} 6' in metrics
+    assert 'harmonizer_requests_total{endpoint="/translate",status="503"} 1' in metrics
+    assert 'harmonizer_request_seconds_count{endpoint="/translate"} 7' in metrics
+    assert "harmonizer_in_flight 0" in metrics
+
+
+def test_coalescing_exact_queries():
+    async def requests():
+        server = TranslationServer(workers=1, threads=True)
+        try:
+            queries = ["select $$a  b$$", "select $$a b$$", "select 'a'", "select  'a'"]
+            responses = await asyncio.gather(*(_post(server, "/translate", {"query": query}) for query in queries))
+            return queries, responses, server.metrics()
+        finally:
+            server.close()
+
+    queries, responses, metrics = asyncio.run(requests())
+    assert [body["query"] for _, body, _ in responses] == [translate_postgres(query) for query in queries]
+    assert "harmonizer_coalesced_requests_total 0" in metrics
+
+
+def test_timeout():
+    release = threading.Event()
+
+    class BlockingCache(TranslationCache):
+        def put(self, key, result):
+            release.wait(10)
+
+    async def request():
+        server = TranslationServer(workers=1, threads=True, timeout=0.05, cache=BlockingCache())
+        try:
+            return await _post(server, "/translate", {"query": "select 1"})
+        finally:
+            release.set()
+            server.close()
+
+    status, body, _ = asyncio.run(request())
+    assert status == 504
+
+
+def test_optimize(monkeypatch):
+    monkeypatch.setattr("dune.harmonizer.server._worker_schema", {"tbl": {"col": "varchar"}})
+    assert _optimize_query("SELECT col = 0xdeadbeef FROM tbl", scoped=True) == (
+        "SELECT col = CAST(0xdeadbeef AS VARCHAR) FROM tbl"
+    )
+
+
+def test_http():
+    async def request():
+        server = TranslationServer(workers=1, threads=True)
+        listener = await asyncio.start_server(server.handle_connection, host="127.0.0.1", port=0)
+        port = listener.sockets[0].getsockname()[1]
+        try:
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            body = json.dumps({"query": "select 1"}).encode()
+            for connection in ("keep-alive", "close"):
+                head = f"POST /translate HTTP/1.1\r\nContent-Length: {len(body)}\r\nConnection: {connection}\r\n\r\n"
+                writer.write(head.encode() + body)
+            await writer.drain()
+            response = await reader.read()
+            writer.close()
+            return response.decode()
+        finally:
+            listener.close()
+            server.close()
+
+    response = asyncio.run(request())
+    assert response.count("HTTP/1.1 200 OK") == 2
+    assert response.endswith('{"query": "SELECT\\n  1"}')
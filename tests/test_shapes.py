@@ -0,0 +1,79 @@
+import pytest
+
+from dune.harmonizer import ShapeCache, TranslationStats, translate_postgres, translate_spark
+from tests.cases import postgres_test_cases, spark_test_cases
+from tests.helpers import read_test_case
+
+
+def test_shape_cache_matches_translation():
+    cache = ShapeCache()
+    for _ in range(2):
+        for tc in postgres_test_cases:
+            query = read_test_case(tc)[0]
+            expected = translate_postgres(query, dataset=tc.dataset)
+            assert translate_postgres(query, dataset=tc.dataset, shape_cache=cache) == expected
+        for tc in spark_test_cases:
+            query = read_test_case(tc)[0]
+            assert translate_spark(query, shape_cache=cache) == translate_spark(query)
+    assert cache.stats.hits > 0
+
+
+@pytest.mark.parametrize(
+    "template,values",
+    [
+        # Literals that are converted while generating DuneSQL: dates, booleans and 0x strings
+        ("SELECT * FROM t WHERE a > {} AND b = {} LIMIT {}", ["'2022-01-01'", "'abc'", "10"]),
+        ("SELECT * FROM t WHERE a > {} AND b = {} LIMIT {}", ["'abc'", "'true'", "3.5"]),
+        ("SELECT * FROM t WHERE a > {} AND b = {} LIMIT {}", ["'2023-05-01 10:00'", "'0xdeadbeef'", "1"]),
+        ("SELECT lower({}) || {} FROM erc20.tokens WHERE c = {}", ["'0xab'", "'0xcd'", "'\\x00'"]),
+        ("SELECT lower({}) || {} FROM erc20.tokens WHERE c = {}", ["'ab'", "'0xcd'", "'\\xff'"]),
+        # Literals the rules look at
+        ("SELECT {}::interval, {} FROM t WHERE x = {}", ["'1 day'", "'{{param}}'", "'0x10'"]),
+        ("SELECT {}::interval, {} FROM t WHERE x = {}", ["'2 weeks'", "'{{start date}}'", "'x'"]),
+        ("SELECT {}::interval, {} FROM t WHERE x = {}", ["'nonsense'", "'sequence'", "'{{x}}'"]),
+        ("SELECT x[{}], x[{}] FROM t", ["1", "2.5"]),
+        ("SELECT x[{}], x[{}] FROM t", ["1.5", "2"]),
+    ],
+)
+def test_shape_cache_rebinds_literals(template, values):
+    cache = ShapeCache()
+    first = template.format(*("'first'" if v.startswith("'") else "0" for v in values))
+    query = template.format(*values)
+    for translate in (translate_spark, lambda q, **kwargs: translate_postgres(q, dataset="polygon", **kwargs)):
+        translate(first, shape_cache=cache)
+        assert translate(query, shape_cache=cache) == translate(query)
+
+
+def test_shape_cache_dropped_column_filters():
+    # Whether the filter is removed depends on the value the dropped column is compared to
+    cache = ShapeCache()
+    template = "SELECT * FROM dex.trades WHERE category = {} AND project = 'Uniswap'"
+    for value in ("'Aggregator'", "'DEX'", "'dex'", "'Aggregator'"):
+        query = template.format(value)
+        assert translate_postgres(query, dataset="ethereum", shape_cache=cache) == translate_postgres(query, "ethereum")
+    assert "category" not in translate_postgres(template.format("'DEX'"), dataset="ethereum", shape_cache=cache)
+
+
+def test_shape_cache_hit():
+    cache = ShapeCache()
+    stats = TranslationStats()
+    translate_spark("SELECT * FROM t WHERE a = '0x01' AND b > '2022-01-01'", shape_cache=cache)
+    output = translate_spark("SELECT * FROM t WHERE a = 'x' AND b > '2023-02-03'", shape_cache=cache, observer=stats)
+    assert (cache.stats.hits, cache.stats.misses) == (1, 1)
+    assert list(stats.stages) == ["parse", "shape", "generate", "postprocess"]
+    assert "b > CAST('2023-02-03' AS TIMESTAMP)" in output and "a = 'x'" in output
+
+
+def test_shape_cache_settings():
+    cache = ShapeCache()
+    query = "SELECT * FROM erc20.tokens WHERE symbol = 'ABC'"
+    assert translate_postgres(query, dataset="polygon", shape_cache=cache) == translate_postgres(query, "polygon")
+    assert translate_postgres(query, dataset="gnosis", shape_cache=cache) == translate_postgres(query, "gnosis")
+    assert cache.stats.hits == 0
+
+
+def test_shape_cache_eviction():
+    cache = ShapeCache(max_entries=2)
+    for i in range(3):
+        translate_spark(f"SELECT {', '.join(['a'] * (i + 1))} FROM t WHERE b = 1", shape_cache=cache)
+    assert len(cache) == 2 and cache.stats.evictions == 1
@@ -0,0 +1,69 @@
+import json
+import pickle
+import sqlite3
+
+from dune.harmonizer import TableMappingIndex, TranslationRequest, translate_many, translate_postgres
+from dune.harmonizer.cache import cache_key
+from dune.harmonizer.table_replacements import spellbook_mapping_index
+from tests.helpers import canonicalize
+
+mappings = {
+    "*": {"erc20.tokens": "tokens.erc20", "Prices.USD": "prices.usd_v2"},
+    "polygon": {"erc20.erc20_evt_transfer": "erc20_polygon.evt_Transfer", "prices.usd": "prices.polygon_usd"},
+}
+
+
+def test_table_mapping_index():
+    index = TableMappingIndex(mappings)
+    assert index.for_dataset("polygon") == {
+        ("erc20", "tokens"): "tokens.erc20",
+        ("prices", "usd"): "prices.polygon_usd",
+        ("erc20", "erc20_evt_transfer"): "erc20_polygon.evt_Transfer",
+    }
+    assert index.for_dataset("polygon") is index.for_dataset("polygon")  # built once
+
+    query = "SELECT * FROM ERC20.Tokens t JOIN prices.usd AS P ON TRUE, erc20.erc20_evt_transfer"
+    output = translate_postgres(query, dataset="ethereum", table_mapping_index=index)
+    assert "from tokens.erc20 as t join prices.usd_v2 as p on true, erc20_ethereum.erc20_evt_transfer" in canonicalize(
+        output
+    )
+    output = translate_postgres(query, dataset="polygon", table_mapping_index=index)
+    assert "join prices.polygon_usd as p on true, erc20_polygon.evt_transfer" in canonicalize(output)
+
+
+def test_table_mapping_layered_on_index():
+    index = TableMappingIndex(mappings)
+    output = translate_postgres(
+        "SELECT * FROM erc20.tokens, prices.usd, tbl",
+        dataset="polygon",
+        table_mapping={"Prices.USD": "prices.mine", "tbl": "new.tbl"},
+        table_mapping_index=index,
+    )
+    assert "from tokens.erc20, prices.mine, new.tbl" in canonicalize(output)
+    assert index.for_dataset("polygon")[("prices", "usd")] == "prices.polygon_usd"  # the index isn't changed
+
+
+def test_load_table_mapping_index(tmp_path):
+    json_path = tmp_path / "mappings.json"
+    json_path.write_text(json.dumps(mappings))
+    sqlite_path = tmp_path / "mappings.db"
+    with sqlite3.connect(sqlite_path) as db:
+        db.execute("CREATE TABLE mappings (dataset TEXT, v1_table TEXT, v2_table TEXT)")
+        rows = [(d, v1, v2) for d, mapping in mappings.items() for v1, v2 in mapping.items()]
+        db.executemany("INSERT INTO mappings VALUES (?, ?, ?)", rows)
+
+    for index in (TableMappingIndex.load(json_path), TableMappingIndex.load(sqlite_path, "mappings")):
+        assert index.mappings == mappings
+        assert index.digest == TableMappingIndex(mappings).digest
+        # Sent to other processes as the file it was loaded from
+        assert str(json_path if index._source[1] is None else sqlite_path) in str(pickle.dumps(index))
+        assert pickle.loads(pickle.dumps(index)).for_dataset("bnb") == index.for_dataset("bnb")
+
+    requests = [TranslationRequest(query="SELECT * FROM erc20.tokens", table_mapping_index=index)] * 2
+    assert all("from tokens.erc20" in canonicalize(r) for r in translate_many(requests, max_workers=2))
+
+
+def test_table_mapping_index_cache_key():
+    key = cache_key("SELECT 1", "postgres", "ethereum")
+    assert cache_key("SELECT 1", "postgres", "ethereum", table_mapping_index=TableMappingIndex(mappings)) != key
+    assert pickle.loads(pickle.dumps(spellbook_mapping_index())) is spellbook_mapping_index()
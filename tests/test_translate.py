@@ -1,6 +1,13 @@
+import subprocess
+import sys
+
 import pytest
+import sqlglot
+from sqlglot.schema import MappingSchema
 
-from dune.harmonizer import translate_postgres, translate_spark
+from dune.harmonizer import TranslationCache, TranslationStats, translate_postgres, translate_spark, warmup
+from dune.harmonizer.dunesql.dunesql import DuneSQL
+from dune.harmonizer.dunesql.optimize import optimize
 from dune.harmonizer.errors import DuneTranslationError
 from tests.cases import nlq_test_cases, postgres_test_cases, spark_test_cases
 from tests.helpers import canonicalize, read_test_case
@@ -46,3 +53,164 @@ def test_translate_with_mapping():
 def test_translate_errors(query):
     with pytest.raises(DuneTranslationError):
         translate_postgres(query=query, dataset="ethereum")
+
+
+def test_translate_blockchain_filter():
+    query = " ".join(
+        (
+            "SELECT * FROM dex.trades t JOIN (SELECT * FROM prices.usd WHERE a OR b) p ON true",
+            "UNION SELECT * FROM nft.trades",
+        )
+    )
+    expected_output = " ".join(
+        (
+            "SELECT * FROM dex.trades AS t",
+            "JOIN (SELECT * FROM prices.usd WHERE blockchain = 'polygon' AND (a OR b)) AS p ON TRUE",
+            "WHERE t.blockchain = 'polygon'",
+            "UNION SELECT * FROM nft.trades WHERE blockchain = 'polygon'",
+        )
+    )
+    output = translate_postgres(query=query, dataset="polygon")
+    assert canonicalize(output).replace("( ", "(").replace(" )", ")") == canonicalize(expected_output)
+
+
+def test_translate_dex_trades_columns():
+    query = " ".join(
+        (
+            "SELECT x.token_a_symbol, token_b_amount AS amount, t.token_a_address",
+            "FROM (SELECT * FROM dex.trades d WHERE d.category = 'DEX' AND exchange_contract_address = '\\x01') x",
+            "JOIN tokens t ON x.token_a_address = t.token_a_address",
+        )
+    )
+    expected_output = " ".join(
+        (
+            "SELECT x.token_sold_symbol, token_bought_amount AS amount, t.token_a_address",
+            "FROM (SELECT * FROM dex.trades AS d WHERE d.blockchain = 'ethereum' AND project_contract_address = 0x01)",
+            "AS x JOIN tokens AS t ON x.token_sold_address = t.token_a_address",
+        )
+    )
+    output = translate_postgres(query=query, dataset="ethereum")
+    assert canonicalize(output).replace("( ", "(").replace(" )", ")") == canonicalize(expected_output)
+
+
+@pytest.mark.parametrize(
+    "condition",
+    ["category = 'Aggregator'", "category <> 'DEX'", "category IN ('DEX', 'Aggregator')", "lower(category) = 'dex'"],
+)
+def test_translate_dex_trades_other_category_filters(condition):
+    # Only the filter on DEX trades is removed, since the v2 table only has those
+    query = f"SELECT * FROM dex.trades WHERE 'DEX' = category AND {condition} AND block_time > '2022-01-01'"
+    output = translate_postgres(query=query, dataset="ethereum")
+    assert canonicalize(output) == canonicalize(
+        sqlglot.transpile(
+            f"SELECT * FROM dex.trades WHERE blockchain = 'ethereum' AND {condition} "
+            "AND block_time > CAST('2022-01-01' AS TIMESTAMP)",
+            write=DuneSQL,
+        )[0]
+    )
+
+
+@pytest.mark.parametrize(
+    "query,expected_output",
+    [
+        ("SELECT '1 day'::interval", "SELECT INTERVAL '1' day"),
+        ("SELECT x::interval FROM t", "SELECT TRY_CAST(x AS INTERVAL) AS x FROM t"),
+    ],
+)
+def test_translate_interval_cast(query, expected_output):
+    assert canonicalize(translate_postgres(query=query, dataset="ethereum")) == canonicalize(expected_output)
+
+
+@pytest.mark.parametrize(
+    "query,expected_output",
+    [
+        ("SELECT * FROM erc20_{{chain}}.tokens LIMIT {{n}}", "SELECT * FROM erc20_{{chain}}.tokens LIMIT {{n}}"),
+        ("SELECT now() - interval '1' {{unit}}", "SELECT CURRENT_TIMESTAMP - INTERVAL '1' {{unit}}"),
+        (
+            "SELECT * FROM t WHERE a = concat('0x', substring(\"{{Address}}\" from 3))",
+            "SELECT * FROM t WHERE a = {{Address}}",
+        ),
+        ("SELECT lower('{{x}}'), '{{start date}}'", "SELECT {{x}}, CAST('{{start date}}' AS TIMESTAMP)"),
+    ],
+)
+def test_translate_parameters(query, expected_output):
+    output = translate_postgres(query=query, dataset="ethereum")
+    assert canonicalize(output.split("*/")[-1]) == canonicalize(expected_output)
+
+
+def test_import_is_lazy():
+    # The optimizer, SQLite, process pools and asyncio are only imported when they're used, to keep the import fast
+    lazy_modules = ["sqlglot.optimizer", "sqlite3", "concurrent.futures.process", "importlib.metadata", "asyncio"]
+    script = f"import sys, dune.harmonizer; print([m for m in {lazy_modules} if m in sys.modules])"
+    output = subprocess.run([sys.executable, "-c", script], capture_output=True, check=True, text=True).stdout
+    assert output.strip() == "[]"
+
+
+def test_warmup():
+    warmup(optimizer=True)
+    assert canonicalize(translate_postgres("select '\\x00'::bytea")) == "select 0x00"
+
+
+def test_translate_long_chains():
+    # Long chains of operators are parsed as very deep trees, which must not hit the recursion limit
+    conditions = " OR ".join(f"x = '0x{i:04x}'" for i in range(3000))
+    output = translate_postgres(f"SELECT * FROM ethereum.transactions WHERE {conditions}", dataset="ethereum")
+    assert output.count(" OR ") == 2999 and output.rstrip().endswith("x = 0x0bb7")
+    hex_strings = " || ".join(f"'0x{i:04x}'" for i in range(1000))
+    output = translate_spark(f"SELECT {hex_strings}")
+    assert output.lower().count("bytearray_concat(") == 999 and "0x03e7" in output
+    # Tables with column mappings are resolved through the scopes of the query
+    conditions = " OR ".join(f"token_a_address = '\\x{i:04x}'" for i in range(5000))
+    output = translate_postgres(f"SELECT * FROM dex.trades WHERE {conditions}", dataset="ethereum")
+    assert output.count("token_sold_address = ") == 5000 and "token_a_address" not in output
+
+
+_schema = {
+    "tokens": {"erc20": {"contract_address": "varbinary", "symbol": "varchar", "blockchain": "varchar"}},
+    "ethereum": {"transactions": {"to": "varbinary", "block_time": "timestamp"}},
+}
+
+
+@pytest.mark.parametrize(
+    "translate, query",
+    [
+        (
+            translate_postgres,
+            "SELECT * FROM erc20.tokens t JOIN ethereum.transactions tx ON tx.to = t.contract_address "
+            "WHERE symbol = '0xab' AND contract_address = '\\xdeadbeef' AND tx.block_time > '2022-01-01'",
+        ),
+        (translate_spark, "SELECT symbol FROM tokens.erc20 WHERE contract_address = 'USDC' OR symbol = '0x01'"),
+        # Set-returning functions in FROM only become UNNEST when generating DuneSQL
+        (
+            translate_postgres,
+            (
+                "select block_time, dt from ethereum.transactions "
+                "cross join generate_series(block_time, now(), '1 day'::interval) dt"
+            ),
+        ),
+    ],
+)
+def test_translate_with_schema(translate, query):
+    # The same as optimizing the translated query, without generating and parsing it in between
+    stats = TranslationStats()
+    expected = optimize(sqlglot.parse_one(translate(query), read=DuneSQL), _schema).sql(DuneSQL, pretty=True)
+    assert translate(query, schema=_schema, observer=stats) == expected
+    assert "optimize" in stats.stages
+
+
+def test_translate_long_chains_with_schema():
+    # Optimizing qualifies and annotates the query, which recurse once per level of the tree
+    conditions = " OR ".join(f"\"to\" = '\\x{i:04x}'" for i in range(5000))
+    output = translate_postgres(f"SELECT * FROM ethereum.transactions WHERE {conditions}", schema=_schema)
+    assert output.count('"transactions"."to" = 0x') == 5000 and output.rstrip().endswith("= 0x1387")
+
+
+def test_translate_with_schema_cache():
+    cache = TranslationCache()
+    query = "SELECT * FROM tokens.erc20 WHERE symbol = 'a'"
+    with pytest.raises(DuneTranslationError):
+        translate_spark(query, schema={"tokens": {"erc20": {"name": "varchar"}}}, cache=cache)
+    for _ in range(2):
+        assert '"erc20"."symbol" = \'a\'' in translate_spark(query, schema=_schema, cache=cache)
+        translate_spark(query, schema=MappingSchema(_schema), cache=cache)
+    assert (cache.stats.hits, cache.stats.misses) == (1, 2)